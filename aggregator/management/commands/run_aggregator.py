@@ -6,6 +6,6 @@ import processor.aggregator.server as aggregator
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
+        aggregator.start()
         print("Aggregator running. Receiving requests.")
-        while True:
-            aggregator.receive_request()
\ No newline at end of file
+        aggregator.run()
\ No newline at end of file
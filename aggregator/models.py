@@ -4,4 +4,7 @@ class ConsumptionData(models.Model):
     home_id = models.IntegerField()
     start_time = models.DateTimeField()
     end_time = models.DateTimeField()
-    power = models.IntegerField()
\ No newline at end of file
+    power = models.IntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['home_id', 'start_time', 'end_time'], name='consumption_home_period')]
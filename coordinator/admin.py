@@ -11,10 +11,14 @@ class ExecutionAdmin(admin.ModelAdmin):
     @admin.action(description="Schedule execution")
     def schedule_execution(self, request, queryset):
         updated = 0
-        for execution in queryset:
-            res = core.schedule_execution(execution, execution.request_time)
-            if res != -1:
-                updated += 1
+        homes = {}
+        for execution in queryset.select_related('home'):
+            homes.setdefault(execution.home_id, []).append(execution)
+        # batches start at their earliest request time, so each execution is still placed from its own
+        for executions in homes.values():
+            request_time = min(execution.request_time for execution in executions)
+            res = core.schedule_executions(executions[0].home, executions, request_time)
+            updated += len([strategy for strategy in res if strategy != -1])
         self.message_user(request, ngettext(
                 '%d execution was successfully scheduled.',
                 '%d executions were successfully scheduled.',
@@ -0,0 +1,103 @@
+import io
+import os
+import json
+import random
+import contextlib
+
+import processor.core as coordinator
+import processor.external_energy as ext
+import processor.aggregator.client as cli
+import processor.benchmark as benchmark
+from processor.simulation import Simulation
+
+from django.test import TestCase, tag
+from django.utils import timezone
+
+# Parameters can be overridden through environment variables, e.g. BENCHMARK_HOMES=20
+PARAMETERS = {
+    "seed": 1,
+    "homes": 5,
+    "appliances": 10,
+    "profiles_per_appliance": 2,
+    "pv_share": 0.5,
+    "bss_share": 0.5,
+    "requests_per_hour": 2.0,
+    "hours": 24
+}
+OUTPUT = os.environ.get("BENCHMARK_OUTPUT", "benchmark_results.json")
+BASELINE = os.environ.get("BENCHMARK_BASELINE")
+
+def get_parameters():
+    return {name: type(value)(os.environ.get(f"BENCHMARK_{name.upper()}", value)) for name, value in PARAMETERS.items()}
+
+# All benchmarks of a run are recorded together, and saved and compared once they have run
+@tag('benchmark')
+class SchedulerBenchmarkTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.parameters = get_parameters()
+        cls.benchmark = benchmark.Benchmark(**cls.parameters)
+
+    @classmethod
+    def tearDownClass(cls):
+        try:
+            if cls.benchmark.samples:
+                cls.save()
+        finally:
+            super().tearDownClass()
+
+    def setUp(self):
+        self.midnight = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) + timezone.timedelta(days=1)
+        rng = random.Random(self.parameters["seed"])
+        self.homes = [benchmark.generate_home(rng, self.parameters["appliances"], self.parameters["profiles_per_appliance"],
+            rng.random() < self.parameters["pv_share"], rng.random() < self.parameters["bss_share"]) for _ in range(self.parameters["homes"])]
+        self.requests = sorted([execution for home in self.homes for execution in benchmark.generate_requests(rng, home, self.midnight,
+            self.parameters["hours"], self.parameters["requests_per_hour"])], key=lambda e: (e.request_time, e.id))
+
+    def test_benchmark_scheduler(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for home in self.homes:
+                if hasattr(home, "batterystoragesystem"):
+                    self.benchmark.measure("schedule_battery_charge", ext.schedule_battery_charge, home, self.midnight + timezone.timedelta(hours=2), True)
+            hour = self.midnight
+            for execution in self.requests:
+                while hour + timezone.timedelta(hours=1) <= execution.request_time:
+                    hour += timezone.timedelta(hours=1)
+                    for home in self.homes:
+                        self.benchmark.measure("anticipate_pending_executions", coordinator.anticipate_pending_executions, home, hour, True)
+                self.benchmark.measure("schedule_execution", coordinator.schedule_execution, execution, execution.request_time, True)
+
+    # Same requests on in-memory copies of the homes (processor.simulation), without the database
+    def test_benchmark_simulation(self):
+        simulation = Simulation()
+        homes = {home.id: simulation.copy_home(home.id) for home in self.homes}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for execution in self.requests:
+                home = homes[execution.home_id]
+                appliance = home.appliances[execution.appliance_id]
+                profile = simulation.profiles[execution.profile_id]
+                simulated = simulation.create_execution(home, appliance, profile, execution.request_time)
+                self.benchmark.measure("simulated_schedule_execution", coordinator.schedule_execution, simulated, simulated.request_time, True)
+
+    # Aggregator must be running for this benchmark
+    @tag('aggregator')
+    def test_benchmark_aggregator(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for home in self.homes:
+                coordinator.start_aggregator_client(home, False)
+            for execution in self.requests:
+                coordinator.schedule_execution(execution, execution.request_time, True)
+                home = execution.home
+                self.benchmark.measure("aggregator_update", cli.send_update_schedule, home, execution.request_time)
+                periods = coordinator.get_available_execution_times(execution, execution.request_time)
+                if periods:
+                    self.benchmark.measure("aggregator_choice", cli.send_choice_request, periods)
+
+    @classmethod
+    def save(cls):
+        results = cls.benchmark.save(OUTPUT)
+        print(json.dumps(results["benchmarks"], indent=2))
+        if BASELINE is not None:
+            with open(BASELINE) as file:
+                print(json.dumps(benchmark.compare(json.load(file), results), indent=2))
@@ -0,0 +1,22 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from coordinator.settings import METRICS_FILE
+import processor.metrics as metrics
+
+class Command(BaseCommand):
+    help = "Print the scheduler metrics last exported by the coordinator."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", default=METRICS_FILE, help="Metrics file (defaults to METRICS_FILE)")
+        parser.add_argument("--format", choices=["text", "json"], default="text")
+
+    def handle(self, *args, **options):
+        if options["file"] is None:
+            raise CommandError("No metrics file: set METRICS_FILE or pass --file.")
+        try:
+            with open(options["file"]) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            raise CommandError(f"Metrics file {options['file']} not found.")
+        self.stdout.write(json.dumps(data, indent=2) if options["format"] == "json" else metrics.to_text(data))
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+import processor.background as aps
+import processor.shards as shards
+import processor.core as core
+
+class Command(BaseCommand):
+    help = "Run the coordinator for every home, or for the homes of one shard when several processes share them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shard", type=int, default=shards.shard, help="Shard of this process (defaults to COORDINATOR_SHARD)")
+        parser.add_argument("--shards", type=int, default=shards.count, help="Number of coordinator processes (defaults to COORDINATOR_SHARDS)")
+
+    def handle(self, *args, **options):
+        try:
+            shards.configure(options["shard"], options["shards"])
+        except ValueError as error:
+            raise CommandError(error)
+        core.start()
+        print(f"Coordinator running shard {shards.shard} of {shards.count}.")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            aps.stop()
@@ -0,0 +1,140 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:13
+
+import datetime
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Appliance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('maximum_delay', models.DurationField(default=datetime.timedelta(seconds=3600), null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Home',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('outside_id', models.IntegerField(null=True)),
+                ('consumption_threshold', models.IntegerField(help_text='Consumption threshold (W)')),
+                ('accept_recommendations', models.BooleanField(default=False)),
+                ('strategy', models.IntegerField(choices=[(0, 'Schedule ASAP'), (1, 'Schedule to lowest consumption period, within maximum delay')], default=0)),
+                ('is_running', models.BooleanField()),
+                ('state_changed', models.DateTimeField(blank=True, db_index=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Profile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('schedulability', models.IntegerField(choices=[(0, 'Interruptible'), (1, 'Non-interruptible')])),
+                ('priority', models.IntegerField(choices=[(0, 'Immediate'), (1, 'Normal'), (2, 'Low-priority')])),
+                ('maximum_duration_of_usage', models.DurationField(null=True)),
+                ('rated_power', models.IntegerField(help_text='Rated power (W)')),
+                ('hidden', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BatteryStorageSystem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_energy_capacity', models.IntegerField(help_text='Total energy capacity (Wh)')),
+                ('continuous_power', models.IntegerField(help_text='Continuous charge/discharge power (W)')),
+                ('last_full_charge_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('depth_of_discharge', models.FloatField(default=1, help_text='Maximum depth-of-discharge (between 0 and 1)')),
+                ('appliance', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='coordinator.appliance')),
+                ('home', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='coordinator.home')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appliance',
+            name='home',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coordinator.home'),
+        ),
+        migrations.CreateModel(
+            name='HomeSnapshot',
+            fields=[
+            ],
+            options={
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('coordinator.home',),
+        ),
+        migrations.CreateModel(
+            name='PhotovoltaicSystem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('tilt', models.IntegerField()),
+                ('azimuth', models.IntegerField()),
+                ('capacity', models.IntegerField(help_text='System nameplate capacity (Wdc)')),
+                ('home', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='coordinator.home')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Execution',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('request_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('end_time', models.DateTimeField(blank=True, null=True)),
+                ('previous_progress_time', models.DurationField(default=datetime.timedelta(0))),
+                ('previous_waiting_time', models.DurationField(default=datetime.timedelta(0))),
+                ('is_started', models.BooleanField(default=False)),
+                ('is_interrupted', models.BooleanField(default=False)),
+                ('is_finished', models.BooleanField(default=False)),
+                ('appliance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coordinator.appliance')),
+                ('home', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coordinator.home')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coordinator.profile')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appliance',
+            name='profiles',
+            field=models.ManyToManyField(to='coordinator.profile'),
+        ),
+        migrations.CreateModel(
+            name='BatteryCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('energy', models.IntegerField(help_text='Energy stored (Wh)')),
+                ('battery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coordinator.batterystoragesystem')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('battery', 'time'), name='unique_battery_checkpoint_time')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductionData',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.IntegerField(choices=[(1, 'January'), (2, 'February'), (3, 'March'), (4, 'April'), (5, 'May'), (6, 'June'), (7, 'July'), (8, 'August'), (9, 'September'), (10, 'October'), (11, 'November'), (12, 'December')])),
+                ('hour', models.IntegerField()),
+                ('average_power_generated', models.IntegerField()),
+                ('system', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='coordinator.photovoltaicsystem')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('system', 'month', 'hour'), name='unique_system_hourly_value')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='appliance',
+            constraint=models.UniqueConstraint(fields=('home', 'name'), name='unique_house_name'),
+        ),
+    ]
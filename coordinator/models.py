@@ -13,31 +13,40 @@ class Home(models.Model):
     accept_recommendations = models.BooleanField(default=False)
     strategy = models.IntegerField(choices=STRATEGY_OPTIONS, default=PEAK_SHAVING)
     is_running = models.BooleanField()
+    # Last change made outside the coordinator process running the home (see processor.shards)
+    state_changed = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def set_outside_id(self, new_val):
         with transaction.atomic():
             self.outside_id = new_val
-            self.save()        
+            self.save(update_fields=['outside_id'])        
 
     def set_consumption_threshold(self, new_val):
         with transaction.atomic():
             self.consumption_threshold = new_val
-            self.save()
+            self.save(update_fields=['consumption_threshold'])
 
     def set_accept_recommendations(self, new_val):
         with transaction.atomic():
             self.accept_recommendations = new_val
-            self.save()
+            self.save(update_fields=['accept_recommendations'])
 
     def set_strategy(self, new_val):
         with transaction.atomic():
             self.strategy = new_val
-            self.save()        
+            self.save(update_fields=['strategy'])        
 
     def set_running(self, new_val):
         with transaction.atomic():
             self.is_running = new_val
-            self.save()
+            self.save(update_fields=['is_running'])
+
+    # state_changed is only written by processor.shards, so saves of a loaded home never overwrite it
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None and not kwargs.get("force_insert"):
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "state_changed"]
+        super().save(*args, **kwargs)
 
     def compare_BSS_appliance(self, appliance):
         if not hasattr(self, "batterystoragesystem"):
@@ -45,9 +54,39 @@ class Home(models.Model):
         else:
             return self.batterystoragesystem.appliance.id == appliance.id
 
+    # Executions read from the in-memory state of a home get it attached, so following them runs no query
+    def attach(self, execution):
+        execution.home = self
+        return execution
+
     def __str__(self):
         return "Home"
 
+'''
+HomeSnapshot class
+Home loaded together with its BSS, PV system, appliances and profiles
+in a few bulk queries, so the scheduler can read them without further queries.
+Usable anywhere a Home is expected.
+'''
+class HomeSnapshot(Home):
+    class Meta:
+        proxy = True
+
+    @classmethod
+    def load(cls, home_id):
+        home = cls.objects.select_related('batterystoragesystem__appliance', 'photovoltaicsystem').get(pk=home_id)
+        home.appliances = {appliance.id: appliance for appliance in home.appliance_set.prefetch_related('profiles')}
+        home.profiles = {profile.id: profile for appliance in home.appliances.values() for profile in appliance.profiles.all()}
+        return home
+
+    def attach(self, execution):
+        super().attach(execution)
+        if execution.appliance_id in self.appliances:
+            execution.appliance = self.appliances[execution.appliance_id]
+        if execution.profile_id in self.profiles:
+            execution.profile = self.profiles[execution.profile_id]
+        return execution
+
 '''
 Profile class
 Generic profiles for appliances, with rated power and default priority.
@@ -162,6 +201,25 @@ class Execution(models.Model):
             self.request_time = request_time
             self.save()
 
+    # Start time, end time and profile as last loaded or saved, so processor.state can tell what a save changed
+    saved_values = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.keep_saved_values()
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.keep_saved_values()
+
+    def keep_saved_values(self):
+        if self.get_deferred_fields() & {'start_time', 'end_time', 'profile_id'}:
+            self.saved_values = None
+        else:
+            self.saved_values = (self.start_time, self.end_time, self.profile_id)
+
     def status(self):
         if self.is_finished:
             return "Finished"
@@ -212,6 +270,20 @@ def create_bss_appliance(sender, instance, created, **kwargs):
                 )
         instance.save()
 
+'''
+BatteryCheckpoint class
+Energy stored in a battery at a given time.
+Saved periodically and at the end of battery executions, so energy queries
+start from the latest checkpoint instead of the last full charge.
+'''
+class BatteryCheckpoint(models.Model):
+    battery = models.ForeignKey(BatteryStorageSystem, on_delete=models.CASCADE)
+    time = models.DateTimeField()
+    energy = models.IntegerField(help_text="Energy stored (Wh)")
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['battery', 'time'], name='unique_battery_checkpoint_time')]
+
 class PhotovoltaicSystem(models.Model):
     home = models.OneToOneField(Home, on_delete=models.CASCADE)
     latitude = models.FloatField()
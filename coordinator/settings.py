@@ -1,3 +1,6 @@
+import os
+from django.utils import timezone
+
 # Scheduler variables
 
 INTERRUPTIBLE = 0
@@ -23,4 +26,37 @@ PRIORITY_OPTIONS = [
 STRATEGY_OPTIONS = [
     (PEAK_SHAVING, "Schedule ASAP"),
     (LOAD_DISTRIBUTION, "Schedule to lowest consumption period, within maximum delay")
-]
\ No newline at end of file
+]
+
+# Candidate start times are searched within this period after the request
+SCHEDULING_HORIZON = timezone.timedelta(days=2)
+
+# NumPy backend: evaluate candidates on load arrays sampled at their window boundaries (requires numpy)
+VECTORIZED_SCHEDULING = False
+
+# Scheduler metrics (processor.metrics): recorded only when enabled, exported every minute to METRICS_FILE when set
+METRICS_ENABLED = False
+METRICS_FILE = None
+
+# APScheduler job changes are kept in memory and written to the database in batches after this delay
+JOB_STORE_WRITE_DELAY = 1 # seconds
+
+# Per-home serial executors (processor.workers): worker threads shared by all homes and maximum waiting tasks
+HOME_WORKERS = 4
+HOME_QUEUE_SIZE = 1000
+
+# Sharded coordinator (processor.shards): number of coordinator processes and the shard of this one
+COORDINATOR_SHARDS = int(os.environ.get("COORDINATOR_SHARDS", 1))
+COORDINATOR_SHARD = int(os.environ.get("COORDINATOR_SHARD", 0))
+# Homes changed by other processes are looked up this often and reloaded, looking back this far for late commits
+COORDINATOR_SYNC_INTERVAL = 5 # seconds
+COORDINATOR_SYNC_MARGIN = 60 # seconds
+
+# Aggregator wire protocol of this coordinator: "text", the original commands, or "binary" (processor.aggregator.protocol),
+# which aggregators only answer once updated
+AGGREGATOR_PROTOCOL = "text"
+# Binary protocol only: send each home's schedule as changes since the version last acknowledged by the aggregator
+AGGREGATOR_DELTA_UPDATES = True
+# Aggregator (processor.aggregator.server): address it listens on and worker threads answering requests
+AGGREGATOR_ADDRESS = "tcp://*:5555"
+AGGREGATOR_WORKERS = 8
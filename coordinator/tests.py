@@ -1,11 +1,47 @@
-from django.test import TestCase, tag
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, tag
 from home.settings import INF_DATE
-from .settings import INTERRUPTIBLE, LOW_PRIORITY, NONINTERRUPTIBLE, NORMAL, PEAK_SHAVING, URGENT
-from .models import Home, BatteryStorageSystem, Execution, Appliance, PhotovoltaicSystem, ProductionData, Profile
+from .settings import INTERRUPTIBLE, LOW_PRIORITY, NONINTERRUPTIBLE, NORMAL, PEAK_SHAVING, URGENT, SCHEDULING_HORIZON, COORDINATOR_SYNC_INTERVAL
+from .models import Home, BatteryStorageSystem, BatteryCheckpoint, Execution, Appliance, PhotovoltaicSystem, ProductionData, Profile
 import processor.test.core as core
 import processor.test.external_energy as ext
+import processor.core as coordinator
+from processor.intervals import IntervalTree
+from processor.segments import SegmentTree, ExtremaTree
+from processor.timeline import LoadTimeline
+from processor.battery import BatteryLedger
+from processor.tools import power_to_energy
+from processor.simulation import Simulation
+from processor.events import EventScheduler, VirtualClock
+from processor.timers import HomeTimer
+import processor.timers as timers
+import processor.workers as workers
+import processor.shards as shards
+import processor.state as state
+import processor.aggregator.protocol as protocol
+import processor.aggregator.client as client
+import processor.aggregator.server as server
+from aggregator.models import ConsumptionData
+from unittest import mock
+import zmq
+import threading
+from apscheduler.triggers.cron import CronTrigger
+import processor.vectorized as vectorized
+import processor.benchmark as benchmark
+import processor.metrics as metrics
+from processor.background import WriteBehindJobStore, delete_old_job_executions
+from apscheduler.schedulers.background import BackgroundScheduler
+from django_apscheduler.models import DjangoJob
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+import unittest
+import io
+import os
+import tempfile
+import shutil
+from django.core.management import call_command
 from django.utils import timezone
 import time
+import random
 
 # Create your tests here.
 
@@ -232,6 +268,76 @@ class FullSchedulingTestCase(TestCase):
         self.assertEqual(e5.status(), "Pending")
         self.assertGreaterEqual(e5.start_time, e1.end_time)
 
+    """
+    e6 is listed first but has lower priority, so e5 is placed first and displaces e1.
+    """
+    def test_schedule_executions_by_priority(self):
+        e5 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=2),profile=Profile.objects.get(pk=2))
+        e6 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=3),profile=Profile.objects.get(pk=3))
+        status6, status5 = self.coordinator.schedule_executions(self.h1, [e6, e5])
+        e1 = Execution.objects.get(pk=1)
+        e5.refresh_from_db()
+        e6.refresh_from_db()
+        self.assertEqual(status5, 2)
+        self.assertNotEqual(status6, -1)
+        self.assertEqual(e1.status(), "Interrupted")
+        self.assertEqual(e5.status(), "Started")
+        self.assertGreaterEqual(e6.start_time, e5.end_time)
+
+    def test_schedule_executions_from_own_request_times(self):
+        now = timezone.now()
+        e5 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=2), profile=Profile.objects.get(pk=2), request_time=now)
+        e6 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=3), profile=Profile.objects.get(pk=3),
+            request_time=now + timezone.timedelta(hours=3))
+        self.coordinator.schedule_executions(self.h1, [e6, e5], now)
+        e5.refresh_from_db()
+        e6.refresh_from_db()
+        self.assertGreaterEqual(e5.start_time, now)
+        self.assertGreaterEqual(e6.start_time, e6.request_time)
+
+    def test_schedule_executions_of_other_homes(self):
+        h2 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        a2 = Appliance.objects.create(home=h2, name="Test 2", maximum_delay=None)
+        e5 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=2), profile=Profile.objects.get(pk=2))
+        e6 = Execution.objects.create(home=h2, appliance=a2, profile=Profile.objects.get(pk=3))
+        with self.assertRaises(ValueError):
+            self.coordinator.schedule_executions(self.h1, [e5, e6])
+        e5.refresh_from_db()
+        self.assertIsNone(e5.start_time)
+
+    def test_schedule_executions_arms_timer_on_commit(self):
+        job_id = f"home_{self.h1.id}_timer"
+        self.addCleanup(timers.clear, self.h1.id)
+        self.addCleanup(lambda: coordinator.background.get_job(job_id) and coordinator.background.remove_job(job_id))
+        e5 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=2), profile=Profile.objects.get(pk=2))
+        e6 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=3), profile=Profile.objects.get(pk=3))
+        place_execution = coordinator.place_execution
+        def fail_second(execution, request_time, debug=False):
+            if execution.id == e6.id:
+                raise RuntimeError("placement failed")
+            return place_execution(execution, request_time, debug)
+        with self.captureOnCommitCallbacks() as callbacks, mock.patch.object(coordinator, "place_execution", fail_second):
+            with self.assertRaises(RuntimeError):
+                coordinator.schedule_executions(self.h1, [e5, e6])
+        self.assertEqual(callbacks, [])
+        self.assertIsNone(timers.get_timer(self.h1).get_time(e5.id, timers.START))
+        with self.captureOnCommitCallbacks() as callbacks:
+            coordinator.schedule_executions(self.h1, [e5])
+        self.assertIsNone(coordinator.background.get_job(job_id))
+        for callback in callbacks:
+            callback()
+        e5.refresh_from_db()
+        self.assertEqual(coordinator.background.get_job(job_id).trigger.run_date, timers.get_timer(self.h1).get_next_time())
+
+    def test_available_execution_times_by_strategy(self):
+        e5 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=2),profile=Profile.objects.get(pk=2))
+        request_time = timezone.now()
+        strategy_periods = self.coordinator.get_available_execution_times_by_strategy(e5, request_time)
+        self.assertEqual(strategy_periods[0], self.coordinator.get_available_execution_times(e5, request_time, False, False))
+        self.assertEqual(strategy_periods[1], self.coordinator.get_available_execution_times(e5, request_time, True, False))
+        self.assertEqual(strategy_periods[2], self.coordinator.get_available_execution_times(e5, request_time, True, True))
+        self.assertGreater(len(strategy_periods[2]), len(strategy_periods[0]))
+
     @tag('slow')
     def test_previous_progress_time(self):
         time.sleep(2)
@@ -292,7 +398,40 @@ class ComplexSchedulingTestCase(TestCase):
         e3 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=2),profile=Profile.objects.get(pk=3))
         status3 = self.coordinator.schedule_execution(e3)
         self.assertEqual(status3, -1)
-  
+
+    def test_pending_executions_by_priority(self):
+        e1 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=1))
+        e2 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=1))
+        self.coordinator.schedule_execution(e1)
+        self.coordinator.schedule_execution(e2)
+        for appliance, profile in [(2, 2), (3, 4), (1, 6), (3, 2)]:
+            e = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=appliance),profile=Profile.objects.get(pk=profile))
+            self.coordinator.schedule_execution(e)
+        now = timezone.now()
+        expected = sorted(self.coordinator.get_pending_executions(self.h1, now), key=lambda e: self.coordinator.calculate_weighted_priority(e, now), reverse=True)
+        pending = self.coordinator.get_pending_executions_by_priority(self.h1, now)
+        self.assertGreater(len(pending), 1)
+        self.assertEqual([e.id for e in pending], [e.id for e in expected])
+
+    """
+    No power can be freed before e3 starts, so anticipation stops without proposing a schedule.
+    """
+    def test_anticipate_stops_without_freed_power(self):
+        e1 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=1))
+        e2 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=1))
+        e3 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=1))
+        self.coordinator.schedule_execution(e1)
+        self.coordinator.schedule_execution(e2)
+        self.coordinator.schedule_execution(e3)
+        e3.refresh_from_db()
+        now = timezone.now()
+        bound = self.coordinator.get_anticipation_power_bound(self.h1, now, e3.start_time)
+        self.assertLess(bound, e3.profile.rated_power)
+        self.coordinator.anticipate_pending_executions(self.h1, now)
+        start_time = e3.start_time
+        e3.refresh_from_db()
+        self.assertEqual(e3.start_time, start_time)
+
     def test_shift_executions(self):
         e1 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=1))
         e2 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1),profile=Profile.objects.get(pk=2))
@@ -425,6 +564,15 @@ class BSSystemTestCase(TestCase):
         self.assertLess(ext.get_battery_energy(self.h1, e2.end_time), ext.get_battery_energy(self.h1, timezone.now()))
         self.assertEqual(ext.get_battery_energy(self.h1, e2.end_time), ext.get_battery_energy(self.h1, e1.end_time))
 
+    def test_no_discharge_without_power_available(self):
+        start_time = timezone.now() + timezone.timedelta(hours=1)
+        times = [start_time + timezone.timedelta(hours=i) for i in range(3)]
+        periods = {(times[0], times[1]): 0, (times[1], times[2]): 2000}
+        with mock.patch.object(ext.ext, "get_battery_discharge_available_on_high_demand_periods", return_value=periods):
+            ext.schedule_battery_discharge_on_consumption_above_threshold(self.h1, times[0], times[2])
+        discharges = Execution.objects.filter(appliance=self.h1.batterystoragesystem.appliance)
+        self.assertEqual([(e.start_time, e.profile.rated_power) for e in discharges], [(times[1], -2000)])
+
     def test_schedule_battery_charge(self):
         battery = self.h1.batterystoragesystem
         start_time = timezone.now() - timezone.timedelta(hours=4)
@@ -463,6 +611,32 @@ class BSSystemTestCase(TestCase):
         self.assertEqual(ext.get_battery_energy(self.h1, e2.end_time),
             ext.get_battery_energy(self.h1, ext.get_last_battery_execution(self.h1).end_time))
 
+    def test_home_snapshot_battery_queries(self):
+        e1 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1), profile=Profile.objects.get(pk=1))
+        e2 = Execution.objects.create(home=self.h1, appliance=Appliance.objects.get(pk=1), profile=Profile.objects.get(pk=2))
+        self.coordinator.schedule_executions(self.h1, [e1, e2])
+        e2.refresh_from_db()
+        energy = ext.get_battery_energy(self.h1, e2.end_time)
+        snapshot = self.coordinator.get_home_snapshot(self.h1.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(snapshot.compare_BSS_appliance(snapshot.batterystoragesystem.appliance))
+            self.assertEqual(ext.get_battery_energy(snapshot, e2.end_time), energy)
+            self.assertGreater(ext.get_battery_discharge_available(snapshot, e2.end_time, e2.end_time + timezone.timedelta(hours=1)), 0)
+
+    def test_interrupt_battery_charge_queries(self):
+        start_time = timezone.now() + timezone.timedelta(hours=1)
+        ext.create_battery_execution(self.h1, start_time, start_time + timezone.timedelta(hours=2), 3000)
+        snapshot = self.coordinator.get_home_snapshot(self.h1.id)
+        ext.get_battery_energy(snapshot, start_time)
+        with self.assertNumQueries(0):
+            charge = ext.get_battery_charge_within(snapshot, start_time, start_time + timezone.timedelta(hours=1))[0]
+            ext.is_battery_charge_interruptible(charge)
+        # only the new end time is written, without reading anything
+        with CaptureQueriesContext(connection) as queries:
+            core.interrupt_execution(charge, start_time + timezone.timedelta(minutes=30))
+        self.assertEqual([query["sql"] for query in queries if query["sql"].startswith("SELECT")], [])
+        self.assertEqual(Execution.objects.get(id=charge.id).end_time, start_time + timezone.timedelta(minutes=30))
+
     def test_consecutive_schedule_battery_charge(self):
         start_time = timezone.now() - timezone.timedelta(hours=4)
         end_time = timezone.now()
@@ -484,6 +658,40 @@ class PVSystemTestCase(TestCase):
     def test_load_solar_data(self):
         self.assertTrue(ProductionData.objects.all())
 
+    def test_home_snapshot_production_queries(self):
+        start_time = timezone.now()
+        end_time = start_time + timezone.timedelta(days=1)
+        minimum_production = ext.get_minimum_production_within(self.h1, start_time, end_time)
+        production = ext.get_power_production(self.h1, start_time)
+        snapshot = self.coordinator.get_home_snapshot(self.h1.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(ext.get_minimum_production_within(snapshot, start_time, end_time), minimum_production)
+            self.assertEqual(ext.get_power_production(snapshot, start_time), production)
+
+    def test_minimum_production_matches_hourly_values(self):
+        pv = self.h1.photovoltaicsystem
+        start_time = timezone.now().replace(month=3, day=30, hour=17, minute=25)
+        ext.get_power_production(self.h1, start_time)
+        for hours in [0, 1, 3, 7, 24, 40, 48, 60]:
+            end_time = start_time + timezone.timedelta(hours=hours, minutes=10)
+            values = []
+            time = start_time
+            while time < min(end_time, start_time + timezone.timedelta(days=2)):
+                values.append(sum(p.average_power_generated for p in ProductionData.objects.filter(system=pv, month=time.month, hour=time.hour)))
+                time += timezone.timedelta(hours=1)
+            with self.assertNumQueries(0):
+                self.assertEqual(ext.get_minimum_production_within(self.h1, start_time, end_time), min(values))
+
+    def test_production_table_follows_data_changes(self):
+        time = timezone.now().replace(month=6, hour=13)
+        production = ProductionData.objects.get(system=self.h1.photovoltaicsystem, month=6, hour=13)
+        power = ext.get_power_production(self.h1, time)
+        production.average_power_generated += 100
+        production.save()
+        self.assertEqual(ext.get_power_production(self.h1, time), power + 100)
+        production.delete()
+        self.assertEqual(ext.get_power_production(self.h1, time), 0)
+
     def test_battery_charge_on_solar_march(self):
         march_day = timezone.now().replace(month=3, day=21, hour=0, minute=0, second=0, microsecond=0)
         start_time = march_day - timezone.timedelta(hours=4)
@@ -540,4 +748,1293 @@ class MultihouseSystemTestCase(TestCase):
         pass
 
     def test_choose_on_multiple_house_data(self):
-        pass
\ No newline at end of file
+        pass
+
+class LoadTimelineTestCase(TestCase):
+    def setUp(self):
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.coordinator = core
+        self.p1 = Profile.objects.create(name="Test 1", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(seconds=7200), rated_power=2000)
+        self.p2 = Profile.objects.create(name="Test 2", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(seconds=3600), rated_power=1000)
+        self.a1 = Appliance.objects.create(home=self.h1, name="Test 1", maximum_delay=None)
+        self.a1.profiles.set([self.p1, self.p2])
+        self.now = timezone.now().replace(microsecond=0)
+        self.e1 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1,
+            start_time=self.now, end_time=self.now + timezone.timedelta(hours=2))
+        self.e2 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p2,
+            start_time=self.now + timezone.timedelta(hours=1), end_time=self.now + timezone.timedelta(hours=3))
+
+    def test_consumption_queries(self):
+        self.assertEqual(self.coordinator.get_power_consumption(self.h1, self.now), 2000)
+        self.assertEqual(self.coordinator.get_power_consumption(self.h1, self.now + timezone.timedelta(hours=1)), 3000)
+        self.assertEqual(self.coordinator.get_power_consumption(self.h1, self.now + timezone.timedelta(hours=3)), 0)
+        self.assertEqual(self.coordinator.get_maximum_consumption_within(self.h1, self.now, self.now + timezone.timedelta(minutes=30)), 2000)
+        self.assertEqual(self.coordinator.get_maximum_consumption_within(self.h1, self.now, self.now + timezone.timedelta(hours=1)), 3000)
+        self.assertEqual(self.coordinator.get_minimum_consumption_within(self.h1, self.now, self.now + timezone.timedelta(hours=4)), 0)
+        self.assertEqual(self.coordinator.get_minimum_consumption_within(self.h1, self.now, self.now + timezone.timedelta(hours=2)), 1000)
+
+    def test_consumption_queries_without_database(self):
+        self.coordinator.get_power_consumption(self.h1, self.now)
+        with self.assertNumQueries(0):
+            self.coordinator.get_power_consumption(self.h1, self.now + timezone.timedelta(minutes=90))
+            self.coordinator.get_maximum_consumption_within(self.h1, self.now, self.now + timezone.timedelta(hours=3))
+            self.coordinator.get_consumption_reference_times_within(self.h1, self.now, self.now + timezone.timedelta(hours=3))
+
+    def test_timeline_follows_execution_changes(self):
+        self.assertEqual(self.coordinator.get_maximum_consumption_within(self.h1, self.now, INF_DATE), 3000)
+        self.coordinator.interrupt_execution(self.e1, self.now + timezone.timedelta(minutes=30))
+        self.assertEqual(self.coordinator.get_maximum_consumption_within(self.h1, self.now, INF_DATE), 2000)
+        self.assertEqual(self.coordinator.get_power_consumption(self.h1, self.now + timezone.timedelta(minutes=45)), 0)
+        e3 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+        self.coordinator.start_execution(e3, self.now + timezone.timedelta(hours=1))
+        self.assertEqual(self.coordinator.get_power_consumption(self.h1, self.now + timezone.timedelta(hours=1)), 3000)
+        e3.delete()
+        self.assertEqual(self.coordinator.get_power_consumption(self.h1, self.now + timezone.timedelta(hours=1)), 1000)
+
+class LoadTimelineSweepTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(microsecond=0)
+        random.seed(1)
+        profiles = [Profile(rated_power=power) for power in [-1500, 300, 1200, 2000, 4000]]
+        executions = []
+        for i in range(1, 101):
+            start_time = self.now + timezone.timedelta(minutes=random.randint(0, 2880))
+            end_time = start_time + timezone.timedelta(minutes=random.randint(1, 300)) if i % 25 else INF_DATE
+            executions.append(Execution(id=i, start_time=start_time, end_time=end_time, profile=random.choice(profiles)))
+        self.timeline = LoadTimeline(executions)
+        self.start_times = sorted(self.now + timezone.timedelta(minutes=random.randint(-60, 3000)) for _ in range(300))
+
+    def test_sweep_matches_single_windows(self):
+        for minutes in [0, 5, 45, 180, 1500]:
+            duration = timezone.timedelta(minutes=minutes)
+            peaks = self.timeline.get_maximum_within_windows(self.start_times, duration)
+            self.assertEqual(peaks, [self.timeline.get_maximum_within(t, t + duration) for t in self.start_times])
+
+    def test_sweep_without_end(self):
+        peaks = self.timeline.get_maximum_within_windows(self.start_times, None)
+        self.assertEqual(peaks, [self.timeline.get_maximum_within(t, INF_DATE) for t in self.start_times])
+
+class IntervalTreeTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(microsecond=0)
+        random.seed(0)
+        self.executions = []
+        for i in range(1, 201):
+            start_time = self.now + timezone.timedelta(minutes=random.randint(0, 2880))
+            end_time = start_time + timezone.timedelta(minutes=random.randint(0, 600)) if i % 50 else INF_DATE
+            self.executions.append(Execution(id=i, start_time=start_time, end_time=end_time))
+        self.tree = IntervalTree(self.executions)
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.p1 = Profile.objects.create(name="Test 1", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(seconds=3600), rated_power=2000)
+        self.a1 = Appliance.objects.create(home=self.h1, name="Test 1", maximum_delay=timezone.timedelta(hours=4))
+
+    def brute_force_search(self, start_time, end_time=None, closed=False):
+        return [e.id for e in self.executions if (e.end_time > start_time or (closed and e.end_time == start_time))
+            and (end_time is None or e.start_time <= end_time)]
+
+    def test_overlap_queries(self):
+        for _ in range(100):
+            start_time = self.now + timezone.timedelta(minutes=random.randint(-60, 3000))
+            end_time = start_time + timezone.timedelta(minutes=random.randint(0, 300))
+            self.assertEqual(sorted(e.id for e in self.tree.search(start_time, end_time)), sorted(self.brute_force_search(start_time, end_time)))
+            self.assertEqual(sorted(e.id for e in self.tree.search(start_time)), sorted(self.brute_force_search(start_time)))
+        execution = self.executions[10]
+        self.assertIn(execution, self.tree.search(execution.end_time, None, closed=True))
+        self.assertNotIn(execution, self.tree.search(execution.end_time))
+
+    def test_insert_and_delete(self):
+        for execution in self.executions[:100]:
+            self.tree.remove(execution.id)
+        self.executions = self.executions[100:]
+        moved = self.executions[0]
+        moved.start_time = self.now - timezone.timedelta(days=1)
+        moved.end_time = self.now - timezone.timedelta(hours=12)
+        self.tree.add(moved)
+        self.assertEqual(len(self.tree), 100)
+        for _ in range(50):
+            start_time = self.now + timezone.timedelta(minutes=random.randint(-1500, 3000))
+            end_time = start_time + timezone.timedelta(minutes=random.randint(0, 300))
+            self.assertEqual(sorted(e.id for e in self.tree.search(start_time, end_time)), sorted(self.brute_force_search(start_time, end_time)))
+
+    def test_running_executions_without_database(self):
+        e1 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now, end_time=self.now + timezone.timedelta(hours=1))
+        e2 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now + timezone.timedelta(hours=2), end_time=self.now + timezone.timedelta(hours=3))
+        core.get_unfinished_executions(self.h1, self.now)
+        with self.assertNumQueries(0):
+            self.assertEqual(core.get_running_executions_within(self.h1, self.now, self.now + timezone.timedelta(minutes=90)), [e1])
+            self.assertEqual(core.get_pending_executions(self.h1, self.now), [e2])
+            self.assertEqual(core.get_unfinished_executions(self.h1, self.now + timezone.timedelta(hours=1)), [e1, e2])
+
+    def test_rolled_back_executions_leave_state(self):
+        e1 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now, end_time=self.now + timezone.timedelta(hours=1))
+        self.assertEqual(core.get_unfinished_executions(self.h1, self.now), [e1])
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            e2 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now + timezone.timedelta(hours=2), end_time=self.now + timezone.timedelta(hours=3))
+            self.assertEqual(core.get_pending_executions(self.h1, self.now), [e2])
+            raise RuntimeError
+        self.assertEqual(core.get_unfinished_executions(self.h1, self.now), [e1])
+        with transaction.atomic():
+            e3 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now + timezone.timedelta(hours=2), end_time=self.now + timezone.timedelta(hours=3))
+        with self.assertNumQueries(0):
+            self.assertEqual(core.get_pending_executions(self.h1, self.now), [e3])
+
+    def test_state_drops_executions_ended_before_horizon(self):
+        old = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now - timezone.timedelta(days=5), end_time=self.now - timezone.timedelta(days=5, hours=-1))
+        recent = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=self.now - timezone.timedelta(days=1), end_time=self.now - timezone.timedelta(hours=23))
+        home_state = state.get_state(self.h1, self.now - timezone.timedelta(days=6))
+        self.assertEqual(len(home_state.index), 2)
+        with self.assertNumQueries(0):
+            self.assertIs(state.get_state(self.h1, self.now), home_state)
+        self.assertEqual(home_state.since, self.now - SCHEDULING_HORIZON)
+        self.assertEqual([e.id for e in home_state.index.search(self.now - timezone.timedelta(days=6))], [recent.id])
+        self.assertNotIn(old.id, home_state.timeline.executions)
+
+    """
+    Pending executions are dropped as their start times pass, and come back when reading an earlier time.
+    """
+    def test_pending_executions_queue(self):
+        for execution in self.executions:
+            execution.home, execution.appliance, execution.profile, execution.request_time = self.h1, self.a1, self.p1, self.now
+        home_state = state.HomeState(self.h1.id, self.now, self.executions)
+        def brute_force_pending(time):
+            executions = [e for e in self.executions if e.start_time > time]
+            return [e.id for e in sorted(executions, key=lambda e: (-coordinator.calculate_weighted_priority(e, e.start_time), e.end_time, e.id))]
+        for minutes in [0, 600, 600, 1200, 300, 2000, 3000]:
+            time = self.now + timezone.timedelta(minutes=minutes)
+            self.assertEqual([e.id for e in home_state.get_pending_executions(time)], brute_force_pending(time))
+            moved = self.executions[minutes % 200]
+            moved.start_time = time + timezone.timedelta(minutes=random.randint(-60, 60))
+            home_state.update(moved)
+        self.assertEqual(len(home_state.get_pending_executions(self.now - timezone.timedelta(minutes=1))), 200)
+
+class BatteryLedgerTestCase(TestCase):
+    def setUp(self):
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.now = timezone.now().replace(microsecond=0)
+        BatteryStorageSystem.objects.create(home=self.h1, total_energy_capacity=18000, continuous_power=5500, last_full_charge_time=self.now)
+        rng = random.Random(3)
+        for _ in range(12):
+            start_time = self.now + timezone.timedelta(minutes=rng.randrange(-60, 1440, 5))
+            end_time = start_time + timezone.timedelta(minutes=rng.randrange(5, 240, 5))
+            ext.create_battery_execution(self.h1, start_time, end_time, rng.choice([-4500, -2000, 1500, 3000]))
+        self.times = [self.now + timezone.timedelta(minutes=i) for i in range(-90, 1800, 7)]
+
+    def get_energy(self, time):
+        battery = self.h1.batterystoragesystem
+        energy = battery.total_energy_capacity
+        for execution in Execution.objects.filter(appliance=battery.appliance, start_time__gte=battery.last_full_charge_time, start_time__lt=time):
+            energy += power_to_energy(execution.start_time, min(execution.end_time, time), execution.profile.rated_power)
+        return energy
+
+    def test_energy_matches_executions(self):
+        for time in self.times:
+            self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_lowest_and_highest_energy_after(self):
+        battery = self.h1.batterystoragesystem
+        minimum_energy = battery.total_energy_capacity * (1 - battery.depth_of_discharge)
+        energies = [self.get_energy(time) for time in self.times]
+        for i, time in enumerate(self.times):
+            self.assertLessEqual(ext.get_maximum_possible_battery_energy_discharge(self.h1, time), min(energies[i:]) - minimum_energy)
+            self.assertLessEqual(ext.get_maximum_possible_battery_energy_charge(self.h1, time), battery.total_energy_capacity - max(energies[i:]))
+
+    def test_lowest_and_highest_energy_match_executions(self):
+        battery = self.h1.batterystoragesystem
+        ledger = state.get_battery_ledger(self.h1)
+        executions = Execution.objects.filter(appliance=battery.appliance, start_time__gte=battery.last_full_charge_time)
+        energies = {time: self.get_energy(time) for execution in executions for time in (execution.start_time, execution.end_time)}
+        for time in self.times:
+            after = [self.get_energy(time)] + [energy for breakpoint, energy in energies.items() if breakpoint > time]
+            self.assertEqual(ledger.get_minimum_energy_after(time), min(after))
+            self.assertEqual(ledger.get_maximum_energy_after(time), max(after))
+
+    def test_ledger_updates_in_place(self):
+        rng = random.Random(5)
+        profiles = [Profile(rated_power=power) for power in [-4500, -2000, 1500, 3000]]
+        start_time = self.now + timezone.timedelta(hours=2)
+        executions = {}
+        ledger = BatteryLedger(1, self.now, 18000, start_time=start_time, energy=15000)
+        for _ in range(200):
+            execution_id = rng.randrange(30)
+            if rng.random() < 0.2:
+                executions.pop(execution_id, None)
+                ledger.remove(execution_id)
+                continue
+            execution = executions.get(execution_id) or Execution(id=execution_id, appliance_id=1)
+            execution.start_time = self.now + timezone.timedelta(minutes=rng.randrange(0, 600, 5))
+            execution.end_time = execution.start_time + timezone.timedelta(minutes=rng.randrange(0, 180, 5))
+            execution.profile = rng.choice(profiles)
+            executions[execution_id] = execution
+            ledger.add(execution)
+            rebuilt = BatteryLedger(1, self.now, 18000, executions.values(), start_time, 15000)
+            time = start_time + timezone.timedelta(minutes=rng.randrange(0, 600, 5))
+            self.assertEqual(ledger.get_energy(), rebuilt.get_energy())
+            self.assertEqual(ledger.get_energy(time), rebuilt.get_energy(time))
+            self.assertEqual(ledger.get_minimum_energy_after(time), rebuilt.get_minimum_energy_after(time))
+            self.assertEqual(ledger.get_maximum_energy_after(time), rebuilt.get_maximum_energy_after(time))
+
+    def test_extrema_tree(self):
+        rng = random.Random(7)
+        tree = ExtremaTree(depth=8)
+        values = {}
+        for _ in range(300):
+            key = rng.randrange(tree.size)
+            if rng.random() < 0.3:
+                values.pop(key, None)
+                tree.remove(key)
+            else:
+                values[key] = rng.randint(-100, 100)
+                tree.set(key, values[key])
+            start, end = sorted(rng.sample(range(tree.size + 1), 2))
+            value = rng.randint(-50, 50)
+            tree.add(start, end, value)
+            for key in values:
+                if start <= key < end:
+                    values[key] += value
+            start, end = sorted(rng.sample(range(tree.size + 1), 2))
+            within = [values[key] for key in values if start <= key < end]
+            self.assertEqual(tree.extrema(start, end), (min(within), max(within)) if within else None)
+        for key in list(values):
+            tree.remove(key)
+        self.assertIsNone(tree.root.left)
+
+    def test_ledger_follows_battery_executions(self):
+        time = self.now + timezone.timedelta(hours=30)
+        execution = ext.create_battery_execution(self.h1, self.now + timezone.timedelta(hours=26), self.now + timezone.timedelta(hours=28), -3000)
+        self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+        core.interrupt_execution(execution, self.now + timezone.timedelta(hours=27))
+        self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+        execution.delete()
+        self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+        self.h1.batterystoragesystem.set_last_full_charge_time(self.now + timezone.timedelta(hours=12))
+        self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_energy_from_checkpoints(self):
+        for hours in [2, 7, 13]:
+            ext.save_battery_checkpoint(self.h1, self.now + timezone.timedelta(hours=hours, minutes=3))
+        self.assertEqual(BatteryCheckpoint.objects.filter(battery=self.h1.batterystoragesystem).count(), 3)
+        for time in self.times:
+            self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_energy_starts_at_latest_checkpoint(self):
+        time = self.now + timezone.timedelta(hours=20)
+        checkpoint = BatteryCheckpoint.objects.create(battery=self.h1.batterystoragesystem, time=time, energy=self.get_energy(time) - 500)
+        later = time + timezone.timedelta(hours=5)
+        self.assertEqual(ext.get_battery_energy(self.h1, later), self.get_energy(later) - 500)
+        self.assertEqual(ext.get_battery_energy(self.h1, time - timezone.timedelta(minutes=1)), self.get_energy(time - timezone.timedelta(minutes=1)))
+        checkpoint.delete()
+        self.assertEqual(ext.get_battery_energy(self.h1, later), self.get_energy(later))
+
+    def test_past_battery_execution_drops_later_checkpoints(self):
+        for minutes in [2, 30, 60]:
+            ext.save_battery_checkpoint(self.h1, self.now + timezone.timedelta(minutes=minutes))
+        ext.create_battery_execution(self.h1, self.now + timezone.timedelta(minutes=5), self.now + timezone.timedelta(minutes=10), -3000)
+        self.assertEqual(BatteryCheckpoint.objects.filter(battery=self.h1.batterystoragesystem).count(), 1)
+        for time in self.times:
+            self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_moved_battery_execution_drops_later_checkpoints(self):
+        execution = ext.create_battery_execution(self.h1, self.now + timezone.timedelta(hours=26), self.now + timezone.timedelta(hours=28), -3000)
+        for hours in [25, 27, 29]:
+            ext.save_battery_checkpoint(self.h1, self.now + timezone.timedelta(hours=hours, minutes=3))
+        execution.start_time = self.now + timezone.timedelta(hours=24)
+        execution.save()
+        self.assertFalse(BatteryCheckpoint.objects.filter(battery=self.h1.batterystoragesystem, time__gt=execution.start_time).exists())
+        for time in self.times:
+            self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_checkpoints_stay_loaded(self):
+        time = self.now + timezone.timedelta(hours=3)
+        ext.get_battery_energy(self.h1, time)
+        ext.save_battery_checkpoint(self.h1, self.now + timezone.timedelta(hours=2))
+        with self.assertNumQueries(0):
+            energy = ext.get_battery_energy(self.h1, time)
+        self.assertEqual(energy, self.get_energy(time))
+        execution = Execution.objects.select_related("profile", "appliance").get(id=ext.create_battery_execution(self.h1, time, time + timezone.timedelta(hours=1), -2000).id)
+        execution.end_time += timezone.timedelta(minutes=30)
+        with self.assertNumQueries(1):
+            execution.save()
+        self.assertEqual(ext.get_battery_energy(self.h1, time + timezone.timedelta(hours=2)), self.get_energy(time + timezone.timedelta(hours=2)))
+
+    def test_old_checkpoints_are_deleted(self):
+        battery = self.h1.batterystoragesystem
+        times = [self.now + timezone.timedelta(hours=hours) for hours in [1, 2, 3]]
+        times.append(times[1] + SCHEDULING_HORIZON + timezone.timedelta(minutes=1))
+        for time in times:
+            ext.save_battery_checkpoint(self.h1, time)
+        self.assertEqual(list(BatteryCheckpoint.objects.filter(battery=battery).order_by('time').values_list('time', flat=True)), times[2:])
+        self.assertEqual([checkpoint[0] for checkpoint in state.get_checkpoints(battery)], times[2:])
+        for time in self.times:
+            self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_rolled_back_checkpoints_are_dropped(self):
+        time = self.now + timezone.timedelta(hours=3)
+        ext.get_battery_energy(self.h1, time)
+        try:
+            with transaction.atomic():
+                BatteryCheckpoint.objects.create(battery=self.h1.batterystoragesystem, time=time, energy=0)
+                self.assertEqual(ext.get_battery_energy(self.h1, time), 0)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_ledgers_are_capped(self):
+        battery = self.h1.batterystoragesystem
+        first = self.now + timezone.timedelta(hours=1, minutes=3)
+        ext.save_battery_checkpoint(self.h1, first)
+        ledger = state.get_battery_ledger(self.h1, first)
+        for hours in range(2, 2 + 2 * state.MAXIMUM_LEDGERS):
+            time = self.now + timezone.timedelta(hours=hours, minutes=3)
+            ext.save_battery_checkpoint(self.h1, time)
+            state.get_battery_ledger(self.h1, time)
+            self.assertIs(state.get_battery_ledger(self.h1, first), ledger)
+        ledgers = state.get_state(self.h1, battery.last_full_charge_time).ledgers
+        self.assertEqual(len(ledgers), state.MAXIMUM_LEDGERS)
+        for time in self.times:
+            self.assertEqual(ext.get_battery_energy(self.h1, time), self.get_energy(time))
+
+    def test_ledger_without_database(self):
+        start_time = self.now + timezone.timedelta(hours=1)
+        charge = Execution(id=1, appliance_id=1, start_time=start_time, end_time=start_time + timezone.timedelta(hours=2),
+            profile=Profile(rated_power=3000))
+        discharge = Execution(id=2, appliance_id=1, start_time=start_time + timezone.timedelta(hours=1), end_time=start_time + timezone.timedelta(hours=4),
+            profile=Profile(rated_power=-4000))
+        ledger = BatteryLedger(1, self.now, 10000, [charge, discharge])
+        self.assertEqual(ledger.get_energy(start_time + timezone.timedelta(hours=2)), 10000 + 6000 - 4000)
+        self.assertEqual(ledger.get_maximum_energy_after(self.now), 10000 + 3000 - 0)
+        self.assertEqual(ledger.get_minimum_energy_after(self.now), 10000 + 6000 - 12000)
+        self.assertEqual(ledger.get_energy(), 4000)
+
+@unittest.skipUnless(vectorized.available, "numpy is not installed")
+class VectorizedSchedulingTestCase(TestCase):
+    def setUp(self):
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.p1 = Profile.objects.create(name="Test 1", schedulability=NONINTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(seconds=7200), rated_power=6000)
+        self.p2 = Profile.objects.create(name="Test 2", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(seconds=3600), rated_power=4000)
+        self.a1 = Appliance.objects.create(home=self.h1, name="Test 1", maximum_delay=None)
+        self.a1.profiles.set([self.p1, self.p2])
+        self.now = timezone.now().replace(second=0, microsecond=0)
+        Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1,
+            start_time=self.now + timezone.timedelta(minutes=30), end_time=self.now + timezone.timedelta(minutes=150))
+
+    def test_peak_consumptions_match_timeline(self):
+        start_times = [self.now + timezone.timedelta(minutes=i) for i in range(0, 240, 5)]
+        for duration in [timezone.timedelta(minutes=45), timezone.timedelta(), None]:
+            arrays = vectorized.get_window_arrays(self.h1, start_times, duration)
+            peaks = arrays.get_peak_consumptions().tolist()
+            self.assertEqual(peaks, core.get_maximum_consumption_for_duration(self.h1, start_times, duration))
+        arrays = vectorized.get_window_arrays(self.h1, start_times, timezone.timedelta(minutes=45))
+        self.assertEqual(arrays.get_minimum_thresholds().tolist(), [8000] * len(start_times))
+
+    def test_evaluation_matches_scalar_path(self):
+        BatteryStorageSystem.objects.create(home=self.h1, total_energy_capacity=12000, continuous_power=4000, last_full_charge_time=self.now)
+        pv = PhotovoltaicSystem.objects.create(home=self.h1, latitude=38.7, longitude=-9.1, tilt=20, azimuth=180, capacity=3000)
+        for hour in range(24):
+            ProductionData.objects.create(system=pv, month=self.now.month, hour=hour, average_power_generated=(hour * 700) % 3000)
+        Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p2,
+            start_time=self.now + timezone.timedelta(hours=5), end_time=self.now + timezone.timedelta(hours=6))
+        home = coordinator.get_home_snapshot(self.h1.id, self.now)
+        for profile in [self.p1, self.p2]:
+            execution = home.attach(Execution.objects.create(home=self.h1, appliance=self.a1, profile=profile, request_time=self.now))
+            with mock.patch.object(coordinator, "VECTORIZED_SCHEDULING", False):
+                scalar = coordinator.get_available_execution_times_by_strategy(execution, self.now)
+            with mock.patch.object(coordinator, "VECTORIZED_SCHEDULING", True):
+                self.assertEqual(coordinator.get_available_execution_times_by_strategy(execution, self.now), scalar)
+            self.assertTrue(all(scalar))
+
+    # Candidates off the minute, at the end of an execution and right after one running before them
+    def test_evaluation_matches_scalar_path_unaligned(self):
+        start_time = self.now + timezone.timedelta(hours=4, seconds=17, microseconds=250000)
+        Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p2,
+            start_time=start_time - timezone.timedelta(minutes=40), end_time=start_time)
+        Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1,
+            start_time=start_time + timezone.timedelta(minutes=160), end_time=start_time + timezone.timedelta(minutes=200))
+        home = coordinator.get_home_snapshot(self.h1.id, start_time)
+        for profile in [self.p1, self.p2]:
+            execution = home.attach(Execution.objects.create(home=self.h1, appliance=self.a1, profile=profile, request_time=start_time))
+            with mock.patch.object(coordinator, "VECTORIZED_SCHEDULING", False):
+                scalar = coordinator.get_available_execution_times_by_strategy(execution, start_time)
+            with mock.patch.object(coordinator, "VECTORIZED_SCHEDULING", True):
+                self.assertEqual(coordinator.get_available_execution_times_by_strategy(execution, start_time), scalar)
+            start_times = [period[0] for period in scalar[0]]
+            self.assertIn(start_time, start_times)
+            self.assertIn(start_time + timezone.timedelta(minutes=200), start_times)
+
+class SimulationTestCase(TestCase):
+    def setUp(self):
+        self.h1 = Home.objects.create(consumption_threshold=5000, strategy=PEAK_SHAVING, is_running=False)
+        self.midnight = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) + timezone.timedelta(days=1)
+        BatteryStorageSystem.objects.create(home=self.h1, total_energy_capacity=12000, continuous_power=4000,
+            last_full_charge_time=self.midnight, depth_of_discharge=0.9)
+        pv = PhotovoltaicSystem.objects.create(home=self.h1, latitude=38.7, longitude=-9.1, tilt=20, azimuth=180, capacity=3000)
+        for hour in range(8, 18):
+            ProductionData.objects.create(system=pv, month=self.midnight.month, hour=hour, average_power_generated=1500)
+        p1 = Profile.objects.create(name="Test 1", schedulability=NONINTERRUPTIBLE, priority=URGENT, maximum_duration_of_usage=timezone.timedelta(hours=1), rated_power=3000)
+        p2 = Profile.objects.create(name="Test 2", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(hours=2), rated_power=2500)
+        p3 = Profile.objects.create(name="Test 3", schedulability=INTERRUPTIBLE, priority=LOW_PRIORITY, maximum_duration_of_usage=timezone.timedelta(hours=3), rated_power=1500)
+        for name, profile in [("Test 1", p1), ("Test 2", p2), ("Test 3", p3)]:
+            Appliance.objects.create(home=self.h1, name=name, maximum_delay=timezone.timedelta(hours=6)).profiles.set([profile])
+        self.requests = [("Test 3", 1, 0), ("Test 2", 7, 30), ("Test 1", 7, 45), ("Test 2", 8, 0), ("Test 3", 12, 10),
+            ("Test 1", 12, 20), ("Test 2", 18, 0), ("Test 1", 18, 15), ("Test 3", 18, 40), ("Test 1", 19, 0)]
+
+    def get_results(self, executions):
+        return sorted((e.appliance.name, e.profile.rated_power, e.request_time, e.start_time, e.end_time) for e in executions)
+
+    def test_simulation_matches_database(self):
+        simulation = Simulation()
+        home = simulation.copy_home(self.h1.id)
+        simulated = []
+        for name, hours, minutes in self.requests:
+            request_time = self.midnight + timezone.timedelta(hours=hours, minutes=minutes)
+            appliance = Appliance.objects.get(home=self.h1, name=name)
+            execution = Execution.objects.create(home=self.h1, appliance=appliance, profile=appliance.profiles.get(), request_time=request_time)
+            core.schedule_execution(execution, request_time)
+            appliance = home.appliances[appliance.id]
+            simulated.append(simulation.create_execution(home, appliance, appliance.profiles.all()[0], request_time))
+        simulation.run(simulated)
+        self.assertEqual(self.get_results(simulation.executions.values()), self.get_results(Execution.objects.all()))
+        time = self.midnight + timezone.timedelta(hours=20)
+        self.assertEqual(ext.get_battery_energy(home, time), ext.get_battery_energy(self.h1, time))
+
+    def test_simulation_without_database(self):
+        with self.assertNumQueries(0):
+            simulation = Simulation()
+            home = simulation.add_home(4000)
+            simulation.add_battery(home, 12000, 4000, self.midnight, 0.9)
+            simulation.add_photovoltaic_system(home, [[1000 if 9 <= hour < 17 else 0 for hour in range(24)] for _ in range(12)])
+            profile = simulation.add_profile("Test", INTERRUPTIBLE, NORMAL, 3000, timezone.timedelta(hours=2))
+            appliances = [simulation.add_appliance(home, f"Test {i}", [profile]) for i in range(3)]
+            executions = [simulation.create_execution(home, appliance, profile, self.midnight + timezone.timedelta(hours=10))
+                for appliance in appliances]
+            strategies = simulation.run(executions)
+            ext.schedule_battery_charge(home, self.midnight + timezone.timedelta(hours=12))
+            energy = ext.get_battery_energy(home, self.midnight + timezone.timedelta(hours=20))
+        self.assertNotIn(-1, strategies)
+        self.assertGreater(energy, 0)
+        self.assertEqual(executions[0].start_time, self.midnight + timezone.timedelta(hours=10))
+        self.assertLessEqual(core.get_maximum_consumption_within(home, self.midnight, INF_DATE), 4000 + 1000 + 4000)
+
+    # Debug calls decide whether a time is now by the clock of the simulation
+    def test_debug_lifecycle_on_virtual_clock(self):
+        now = self.midnight + timezone.timedelta(hours=10)
+        simulation = Simulation(VirtualClock(now))
+        home = simulation.copy_home(self.h1.id)
+        appliance = home.appliances[Appliance.objects.get(home=self.h1, name="Test 1").id]
+        execution = simulation.create_execution(home, appliance, appliance.profiles.all()[0], now)
+        coordinator.start_execution(execution, now, debug=True)
+        self.assertTrue(execution.is_started)
+        self.assertEqual(execution.start_time, now)
+        simulation.clock.advance(now + timezone.timedelta(minutes=30))
+        coordinator.finish_execution(execution, now + timezone.timedelta(minutes=30), debug=True)
+        self.assertTrue(execution.is_finished)
+        self.assertEqual(execution.end_time, now + timezone.timedelta(minutes=30))
+
+class EventSchedulerTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(minute=30, second=0, microsecond=0)
+        self.clock = VirtualClock(self.now)
+        self.scheduler = EventScheduler(self.clock)
+        self.runs = []
+
+    def record(self, name):
+        self.runs.append((name, self.clock.now()))
+
+    def test_jobs_run_in_time_order(self):
+        hour = timezone.timedelta(hours=1)
+        self.scheduler.add_job(self.record, 'date', ["late"], id="late", run_date=self.now + 2 * hour)
+        self.scheduler.add_job(self.record, 'date', ["early"], id="early", run_date=self.now + hour)
+        self.scheduler.add_job(self.record, 'date', ["past"], id="past", run_date=self.now - hour)
+        self.scheduler.add_job(self.record, 'date', ["moved"], id="moved", run_date=self.now + 3 * hour)
+        self.scheduler.add_job(self.record, 'date', ["moved"], id="moved", run_date=self.now + hour / 2, replace_existing=True)
+        self.scheduler.add_job(self.record, 'date', ["removed"], id="removed", run_date=self.now + hour)
+        self.scheduler.remove_job("removed")
+        self.assertEqual(self.scheduler.run_until(self.now + 4 * hour), 4)
+        self.assertEqual(self.runs, [("past", self.now), ("moved", self.now + hour / 2), ("early", self.now + hour), ("late", self.now + 2 * hour)])
+        self.assertEqual(self.clock.now(), self.now + 4 * hour)
+        self.assertIsNone(self.scheduler.get_job("late"))
+
+    def test_cron_jobs_repeat(self):
+        self.scheduler.add_job(self.record, args=["hourly"], trigger=CronTrigger(minute=0, timezone=self.now.tzinfo), id="hourly")
+        self.scheduler.run_until(self.now + timezone.timedelta(hours=5))
+        self.assertEqual([time for _, time in self.runs], [self.now + timezone.timedelta(minutes=30 + 60 * i) for i in range(5)])
+        self.assertIsNotNone(self.scheduler.get_job("hourly"))
+
+    def test_simulated_jobs_charge_battery(self):
+        simulation = Simulation(self.clock)
+        home = simulation.add_home(6000)
+        battery = simulation.add_battery(home, 10000, 4000, self.now - timezone.timedelta(hours=1), 0.9)
+        profile = simulation.add_profile("Test", NONINTERRUPTIBLE, NORMAL, 2000, timezone.timedelta(hours=1))
+        appliance = simulation.add_appliance(home, "Test", [profile])
+        discharge = ext.create_battery_execution(home, self.now, self.now + timezone.timedelta(hours=2), -4000)
+        coordinator.start_execution(discharge, discharge.start_time)
+        execution = simulation.create_execution(home, appliance, profile, self.now + timezone.timedelta(hours=1))
+        simulation.request(execution)
+        simulation.start()
+        simulation.run_until(self.now + timezone.timedelta(days=1))
+        self.assertTrue(discharge.is_finished)
+        self.assertTrue(execution.is_started and execution.is_finished)
+        charges = [e for e in simulation.executions.values() if e.appliance_id == battery.appliance_id and e.profile.rated_power > 0]
+        self.assertTrue(charges)
+        self.assertTrue(all(charge.start_time >= discharge.end_time and charge.is_finished for charge in charges))
+        self.assertGreater(battery.last_full_charge_time, discharge.end_time)
+        self.assertTrue(simulation.get_checkpoints(battery))
+
+""" Test the per-home event timers that replace the start and finish jobs of each execution. """
+class HomeTimerTestCase(TestCase):
+    def setUp(self):
+        self.now = timezone.now().replace(second=0, microsecond=0)
+        self.clock = VirtualClock(self.now)
+        self.h1 = Home.objects.create(consumption_threshold=8000, is_running=False)
+        self.p1 = Profile.objects.create(name="Test", schedulability=INTERRUPTIBLE, priority=NORMAL, rated_power=1000,
+            maximum_duration_of_usage=timezone.timedelta(hours=1))
+        self.a1 = Appliance.objects.create(home=self.h1, name="Test")
+
+    def test_due_events_in_time_order(self):
+        minute = timezone.timedelta(minutes=1)
+        timer = HomeTimer()
+        timer.add(1, timers.START, self.now + 2 * minute)
+        timer.add(1, timers.FINISH, self.now + 9 * minute)
+        timer.add(2, timers.START, self.now + minute)
+        timer.add(2, timers.FINISH, self.now + 5 * minute)
+        timer.add(1, timers.FINISH, self.now + 3 * minute)
+        timer.remove(2, timers.FINISH)
+        self.assertEqual(timer.get_next_time(), self.now + minute)
+        self.assertEqual(timer.pop_due(self.now + 3 * minute), [(2, timers.START), (1, timers.START), (1, timers.FINISH)])
+        self.assertIsNone(timer.get_next_time())
+        self.assertEqual(len(timer), 0)
+
+    def test_one_job_per_home(self):
+        simulation = Simulation(self.clock)
+        home = simulation.add_home(10000)
+        profile = simulation.add_profile("Test", NONINTERRUPTIBLE, NORMAL, 1000, timezone.timedelta(minutes=30))
+        appliance = simulation.add_appliance(home, "Test", [profile])
+        executions = [simulation.create_execution(home, appliance, profile, self.now) for _ in range(5)]
+        for execution in executions:
+            coordinator.schedule_execution(execution, self.now)
+        self.assertEqual([job.id for job in simulation.scheduler.get_jobs()], [f"home_{home.id}_timer"])
+        self.assertEqual(len(timers.get_timer(home)), 10)
+        simulation.run_until(self.now + timezone.timedelta(hours=1))
+        self.assertTrue(all(execution.is_started and execution.is_finished for execution in executions))
+        self.assertEqual(simulation.scheduler.get_jobs(), [])
+
+    def test_timer_loaded_on_start(self):
+        pending = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, request_time=self.now)
+        pending.set_start_time(self.now + timezone.timedelta(hours=1))
+        finished = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, request_time=self.now)
+        finished.set_start_time(self.now)
+        finished.set_finished()
+        self.addCleanup(timers.clear, self.h1.id)
+        self.addCleanup(coordinator.background.remove_job, f"home_{self.h1.id}_timer")
+        coordinator.start_home(self.h1)
+        timer = timers.get_timer(self.h1)
+        self.assertEqual(timer.get_time(pending.id, timers.START), pending.start_time)
+        self.assertEqual(timer.get_time(pending.id, timers.FINISH), pending.end_time)
+        self.assertEqual(len(timer), 2)
+        self.assertEqual(coordinator.background.get_job(f"home_{self.h1.id}_timer").trigger.run_date, pending.start_time)
+
+    def test_failed_events_are_logged(self):
+        simulation = Simulation(self.clock)
+        home = simulation.add_home(10000)
+        profile = simulation.add_profile("Test", NONINTERRUPTIBLE, NORMAL, 1000, timezone.timedelta(minutes=30))
+        appliance = simulation.add_appliance(home, "Test", [profile])
+        execution = simulation.create_execution(home, appliance, profile, self.now)
+        coordinator.schedule_execution(execution, self.now)
+        with mock.patch.object(coordinator, "start_execution_job", side_effect=ValueError("failed")), \
+            self.assertLogs("processor.core", "ERROR") as logs:
+            simulation.run_until(self.now + timezone.timedelta(hours=1))
+        self.assertIn(f"Unable to start execution {execution.id}.", logs.output[0])
+        self.assertTrue(execution.is_finished)
+
+    def test_execution_jobs_removed(self):
+        run_date = self.now + timezone.timedelta(days=1)
+        job_ids = ["home_1_execution_2_start", "home_1_execution_2_finish", "home_12_execution_3_finish", "home_1_timer"]
+        for job_id in job_ids:
+            coordinator.background.add_job(delete_old_job_executions, 'date', run_date=run_date, id=job_id, replace_existing=True)
+        self.addCleanup(coordinator.background.remove_job, "home_1_timer")
+        coordinator.remove_execution_jobs()
+        self.assertEqual([job_id for job_id in job_ids if coordinator.background.get_job(job_id) is not None], ["home_1_timer"])
+
+""" Test that home tasks run off the calling thread, one at a time per home and coalesced while waiting (outside a transaction). """
+class HomeExecutorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.runs = []
+        self.release = threading.Event()
+        self.blocked = threading.Event()
+
+    def block(self, home_id):
+        self.blocked.set()
+        self.release.wait(5)
+        self.runs.append((home_id, "block"))
+
+    def record(self, home_id, time):
+        self.runs.append((home_id, time))
+
+    def test_tasks_coalesce_per_home(self):
+        self.assertTrue(workers.submit(1, "block", self.block, 1))
+        self.assertTrue(self.blocked.wait(5))
+        self.assertTrue(workers.submit(1, "anticipate", self.record, 1, 1))
+        self.assertFalse(workers.submit(1, "anticipate", self.record, 1, 2))
+        self.assertFalse(workers.submit(1, "anticipate", self.record, 1, 3))
+        self.assertTrue(workers.submit(2, "anticipate", self.record, 2, 1))
+        for _ in range(50):
+            if (2, 1) in self.runs:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.runs, [(2, 1)])
+        self.release.set()
+        workers.join()
+        self.assertEqual(self.runs, [(2, 1), (1, "block"), (1, 3)])
+
+    def test_calls_run_serially_per_home(self):
+        active = {}
+        peaks = {"total": 0}
+        lock = threading.Lock()
+        def call(home_id):
+            with lock:
+                active[home_id] = active.get(home_id, 0) + 1
+                peaks[home_id] = max(peaks.get(home_id, 0), active[home_id])
+                peaks["total"] = max(peaks["total"], sum(active.values()))
+            time.sleep(0.005)
+            with lock:
+                active[home_id] -= 1
+            return home_id
+        callers = [threading.Thread(target=workers.execute, args=(i % 3, call, i % 3)) for i in range(24)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertEqual([peaks[home_id] for home_id in range(3)], [1, 1, 1])
+        self.assertGreater(peaks["total"], 1)
+
+    def test_execute_returns_from_home_executor(self):
+        def nested():
+            self.assertEqual(workers.get_current_home(), 7)
+            return workers.execute(7, lambda: "nested")
+        self.assertEqual(workers.execute(7, nested), "nested")
+        with self.assertRaises(ZeroDivisionError):
+            workers.execute(7, lambda: 1 / 0)
+        self.assertIsNone(workers.get_current_home())
+
+    def test_calls_in_transaction_hold_home(self):
+        self.assertTrue(workers.submit(7, "block", self.block, 7))
+        self.assertTrue(self.blocked.wait(5))
+        threading.Timer(0.05, self.release.set).start()
+        with mock.patch.object(connection, "in_atomic_block", True):
+            result = workers.execute(7, lambda: (workers.get_current_home(), threading.current_thread(), list(self.runs)))
+        self.assertEqual(result, (7, threading.current_thread(), [(7, "block")]))
+        self.assertIsNone(workers.get_current_home())
+
+    def test_workers_only_submit_to_other_homes(self):
+        with self.assertRaises(RuntimeError):
+            workers.execute(7, workers.execute, 8, lambda: None)
+        self.assertTrue(workers.execute(7, workers.submit, 8, "record", self.record, 8, 1))
+        workers.join()
+        self.assertEqual(self.runs, [(8, 1)])
+
+""" Test that calls on database homes go through their executors, seeing what their callers committed. """
+class HomeExecutorTransactionTestCase(TransactionTestCase):
+    def setUp(self):
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.p1 = Profile.objects.create(name="Test 1", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(hours=1), rated_power=2000)
+        self.a1 = Appliance.objects.create(home=self.h1, name="Test 1", maximum_delay=None)
+        self.a1.profiles.set([self.p1])
+        self.addCleanup(timers.clear, self.h1.id)
+        job_id = f"home_{self.h1.id}_timer"
+        self.addCleanup(lambda: coordinator.background.get_job(job_id) and coordinator.background.remove_job(job_id))
+
+    def test_schedule_execution_runs_on_home_executor(self):
+        now = timezone.now()
+        execution = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, request_time=now)
+        homes = []
+        place_execution = coordinator.place_execution
+        def record(*args, **kwargs):
+            homes.append((workers.get_current_home(), threading.current_thread()))
+            return place_execution(*args, **kwargs)
+        with mock.patch.object(coordinator, "place_execution", record):
+            self.assertEqual(coordinator.schedule_execution(execution, now), 0)
+        self.assertEqual(homes[0][0], self.h1.id)
+        self.assertNotEqual(homes[0][1], threading.current_thread())
+        self.assertEqual(Execution.objects.get(pk=execution.id).start_time, now)
+
+    def test_submit_in_transaction_waits_for_commit(self):
+        runs = []
+        with transaction.atomic():
+            self.assertIsNone(workers.submit(self.h1.id, "record", runs.append, 1))
+            workers.join()
+            self.assertEqual(runs, [])
+        workers.join()
+        self.assertEqual(runs, [1])
+
+""" Test the assignment of homes and their jobs to coordinator shards. """
+class ShardTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(shards.configure, shards.shard, shards.count)
+        self.run_date = timezone.now() + timezone.timedelta(days=1)
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.p1 = Profile.objects.create(name="Test 1", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(hours=1), rated_power=2000)
+        # marks of the fixtures run at once, not left waiting on the transaction of the test
+        with self.captureOnCommitCallbacks(execute=True):
+            self.a1 = Appliance.objects.create(home=self.h1, name="Test 1", maximum_delay=None)
+            self.a1.profiles.set([self.p1])
+
+    def test_homes_move_only_to_added_shard(self):
+        before = {home_id: shards.get_shard(home_id, 4) for home_id in range(1, 2001)}
+        after = {home_id: shards.get_shard(home_id, 5) for home_id in range(1, 2001)}
+        sizes = [list(before.values()).count(shard) for shard in range(4)]
+        self.assertTrue(all(400 < size < 600 for size in sizes), sizes)
+        moved = [home_id for home_id in before if before[home_id] != after[home_id]]
+        self.assertTrue(all(after[home_id] == 4 for home_id in moved))
+        self.assertTrue(300 < len(moved) < 500, len(moved))
+
+    def test_job_owners(self):
+        shards.configure(0, 1)
+        self.assertTrue(shards.owns_job("home_3_timer"))
+        shards.configure(1 - shards.get_shard(3, 2), 2)
+        self.assertEqual(shards.get_job_home("save_battery_checkpoint_3"), 3)
+        self.assertFalse(shards.owns_job("home_3_timer"))
+        self.assertFalse(shards.owns_job("schedule_battery_charge_3"))
+        self.assertEqual(shards.owns_job("delete_old_job_executions"), shards.shard == 0)
+        with self.assertRaises(ValueError):
+            shards.configure(2, 2)
+
+    def test_job_store_partition(self):
+        shards.configure(0, 1)
+        store = WriteBehindJobStore(delay=None)
+        scheduler = self.start_store(store)
+        for home_id in range(1, 11):
+            scheduler.add_job(delete_old_job_executions, 'date', run_date=self.run_date, id=f"home_{home_id}_timer")
+        store.flush()
+        shards.configure(0, 2)
+        owned = {f"home_{home_id}_timer" for home_id in range(1, 11) if shards.owns(home_id)}
+        partition = WriteBehindJobStore(delay=None)
+        self.start_store(partition)
+        self.assertEqual({job.id for job in partition.get_all_jobs()}, owned)
+        partition.remove_all_jobs()
+        self.assertEqual(DjangoJob.objects.count(), 10 - len(owned))
+        shards.configure(0, 1)
+        partition.rebalance()
+        self.assertEqual(len(partition.get_all_jobs()), 10 - len(owned))
+
+    def test_writes_elsewhere_mark_home(self):
+        shards.configure(0, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+        Home.objects.filter(id=self.h1.id).update(state_changed=None)
+        with mock.patch.object(shards, "started", True), self.assertNumQueries(1):
+            Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+        shards.configure(1 - shards.get_shard(self.h1.id, 2), 2)
+        with mock.patch.object(shards, "started", True), self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(1):
+                Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+            self.assertIsNone(Home.objects.get(id=self.h1.id).state_changed)
+        self.assertIsNotNone(Home.objects.get(id=self.h1.id).state_changed)
+        shards.configure(0, 1)
+        Home.objects.filter(id=self.h1.id).update(state_changed=None)
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+            Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+            self.assertIsNone(Home.objects.get(id=self.h1.id).state_changed)
+        self.assertEqual(len([query for query in queries if query["sql"].startswith('UPDATE "coordinator_home"')]), 1)
+        self.h1.refresh_from_db()
+        self.assertIsNotNone(self.h1.state_changed)
+        state_changed = self.h1.state_changed
+        Home.objects.filter(id=self.h1.id).update(state_changed=None)
+        self.h1.set_consumption_threshold(6000)
+        self.assertIsNone(Home.objects.get(id=self.h1.id).state_changed)
+        Home.objects.filter(id=self.h1.id).update(state_changed=state_changed)
+        self.h1.consumption_threshold = 5000
+        self.h1.state_changed = None
+        self.h1.save()
+        self.assertEqual(Home.objects.get(id=self.h1.id).state_changed, state_changed)
+
+    def test_changed_homes_are_reloaded(self):
+        shards.configure(0, 1)
+        shards.get_changed_homes()
+        state.get_state(self.h1, timezone.now())
+        shards.mark_changed(Home.objects.filter(id=self.h1.id))
+        # workers could not see the home inside the transaction of the test, so reloads run on its thread
+        with mock.patch.object(coordinator, "reload_home_timer") as reload_home_timer, \
+            mock.patch.object(workers, "runs_directly", return_value=True):
+            coordinator.sync_homes_job()
+            self.assertNotIn(self.h1.id, state.states)
+            reload_home_timer.assert_called_once()
+            coordinator.sync_homes_job()
+            reload_home_timer.assert_called_once()
+
+    def test_profile_update_marks_only_its_homes(self):
+        shards.configure(0, 1)
+        h2 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        Home.objects.update(state_changed=None)
+        state.get_state(h2, timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.p1.rated_power = 3000
+            self.p1.save()
+        self.assertIsNotNone(Home.objects.get(id=self.h1.id).state_changed)
+        self.assertIsNone(Home.objects.get(id=h2.id).state_changed)
+        self.assertIn(h2.id, state.states)
+
+    def test_states_of_homes_run_elsewhere_are_rebuilt(self):
+        shards.configure(0, 1)
+        now = timezone.now()
+        home_state = state.get_state(self.h1, now)
+        self.assertIs(state.get_state(self.h1, now), home_state)
+        # written by the process running the home, so neither signals nor marks reach this one
+        with mock.patch.object(shards, "started", True):
+            Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1, start_time=now, end_time=now + timezone.timedelta(hours=1))
+        state.states[self.h1.id] = home_state
+        shards.mark_changed(Home.objects.filter(id=self.h1.id))
+        self.h1.refresh_from_db()
+        self.assertIsNot(state.get_state(self.h1, now), home_state)
+        self.assertEqual(len(state.get_index(self.h1, now).search(now, None, closed=True)), 1)
+        home_state = state.get_state(self.h1, now)
+        with mock.patch.object(state.clock, "monotonic", return_value=home_state.built + COORDINATOR_SYNC_INTERVAL + 1):
+            with mock.patch.object(shards, "started", True):
+                self.assertIs(state.get_state(self.h1, now), home_state)
+            self.assertIsNot(state.get_state(self.h1, now), home_state)
+
+    def start_store(self, store):
+        scheduler = BackgroundScheduler()
+        scheduler.add_jobstore(store, "default")
+        scheduler.start(paused=True)
+        self.addCleanup(scheduler.shutdown, wait=False)
+        return scheduler
+
+""" Test the binary aggregator protocol and its compatibility with the text commands. """
+class AggregatorProtocolTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.periods = {
+            (now, now + timezone.timedelta(minutes=30)): 1500,
+            (now + timezone.timedelta(minutes=30), now + timezone.timedelta(hours=2, microseconds=7)): -250,
+            (now + timezone.timedelta(hours=2, microseconds=7), INF_DATE): 100
+        }
+
+    def test_binary_round_trip(self):
+        frame = protocol.encode(protocol.Message(protocol.UPDATE, 42, periods=self.periods))
+        self.assertTrue(protocol.is_binary(frame))
+        message = protocol.decode(frame)
+        self.assertEqual((message.type, message.home_id), (protocol.UPDATE, 42))
+        self.assertEqual(message.periods, self.periods)
+        choice = protocol.decode(protocol.encode(protocol.Message(protocol.CHOOSE, periods=[(INF_DATE, None)])))
+        self.assertEqual(choice.periods, [(INF_DATE, None)])
+        self.assertEqual(protocol.decode_reply(protocol.encode(protocol.Message(protocol.CHOICE, index=2))), "2")
+        text = protocol.encode_text(protocol.Message(protocol.UPDATE, 42, periods=self.periods))
+        self.assertLess(len(frame), len(text) / 3)
+
+    def test_text_commands(self):
+        frame = protocol.encode_text(protocol.Message(protocol.UPDATE, 42, periods=self.periods))
+        self.assertTrue(frame.startswith(b"update 42 {"))
+        self.assertFalse(protocol.is_binary(frame))
+        message = protocol.decode_text(frame)
+        self.assertEqual((message.type, message.home_id), (protocol.UPDATE, 42))
+        self.assertEqual(message.periods, self.periods)
+        choice = protocol.decode_text(protocol.encode_text(protocol.Message(protocol.CHOOSE, periods=list(self.periods))))
+        self.assertEqual(choice.periods, list(self.periods))
+        self.assertEqual(protocol.decode_text(b"plot Night test").text, "Night test")
+        self.assertEqual(protocol.decode_reply(b"Consumption data updated."), "Consumption data updated.")
+
+    def test_invalid_frames(self):
+        frame = protocol.encode(protocol.Message(protocol.REPLY, text="OK."))
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode(frame[:2] + bytes([protocol.VERSION + 1]) + frame[3:])
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode(protocol.encode(protocol.Message(protocol.UPDATE, 1, periods=self.periods))[:-4])
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.decode_text(b"unknown 1 {}")
+
+""" Test that schedules are sent to the aggregator as deltas, falling back to full syncs. """
+class ScheduleDeltaTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now().replace(microsecond=0)
+        self.times = [now + timezone.timedelta(minutes=15 * i) for i in range(6)]
+        self.periods = {(self.times[0], self.times[1]): 1000, (self.times[1], self.times[2]): 2000, (self.times[2], self.times[3]): 500}
+        self.frames = []
+        patcher = mock.patch.object(client, "exchange", self.exchange)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(client.schedules.clear)
+        self.addCleanup(server.versions.clear)
+
+    def exchange(self, frame, name):
+        self.frames.append(protocol.decode(frame))
+        return server.parse_request(frame)
+
+    def get_stored(self, home_id):
+        return {(data.start_time, data.end_time): data.power for data in ConsumptionData.objects.filter(home_id=home_id)}
+
+    def test_deltas_and_resync(self):
+        self.assertEqual(client.send_schedule(7, self.periods), "Schedule version 1 acknowledged.")
+        self.assertEqual(self.frames[-1].type, protocol.SYNC)
+        periods = dict(self.periods)
+        del periods[(self.times[0], self.times[1])]
+        periods[(self.times[1], self.times[2])] = 2500
+        periods[(self.times[4], self.times[5])] = 800
+        self.assertEqual(client.send_schedule(7, periods), "Schedule version 2 acknowledged.")
+        delta = self.frames[-1]
+        self.assertEqual((delta.type, delta.base_version, delta.version), (protocol.DELTA, 1, 2))
+        self.assertEqual(delta.removed, [(self.times[0], self.times[1])])
+        self.assertEqual(delta.periods, {(self.times[1], self.times[2]): 2500, (self.times[4], self.times[5]): 800})
+        self.assertEqual(self.get_stored(7), periods)
+        self.assertEqual(client.send_schedule(7, periods), "Schedule unchanged.")
+        self.assertEqual(len(self.frames), 2)
+        server.versions.clear()
+        periods[(self.times[3], self.times[4])] = 100
+        self.assertEqual(client.send_schedule(7, periods), "Schedule version 3 acknowledged.")
+        self.assertEqual([frame.type for frame in self.frames[2:]], [protocol.DELTA, protocol.SYNC])
+        self.assertEqual(self.get_stored(7), periods)
+
+    def test_text_is_the_default_protocol(self):
+        frames = []
+        def exchange(frame, name):
+            frames.append(frame)
+            return server.parse_request(frame)
+        message = protocol.Message(protocol.CHOOSE, periods=[(self.times[0], self.times[1])])
+        with mock.patch.object(client, "exchange", exchange):
+            client.send_request(message)
+            with mock.patch.object(client, "AGGREGATOR_PROTOCOL", "binary"):
+                client.send_request(message)
+        self.assertEqual(protocol.decode_text(frames[0]).type, protocol.CHOOSE)
+        self.assertEqual(protocol.decode(frames[1]).type, protocol.CHOOSE)
+
+    def test_full_update_invalidates_version(self):
+        client.send_schedule(8, self.periods)
+        server.parse_request(protocol.encode_text(protocol.Message(protocol.UPDATE, 8, periods=self.periods)))
+        self.assertNotIn(8, server.versions)
+        client.send_schedule(8, {(self.times[0], self.times[1]): 1000})
+        self.assertEqual([frame.type for frame in self.frames], [protocol.SYNC, protocol.DELTA, protocol.SYNC])
+        self.assertEqual(self.get_stored(8), {(self.times[0], self.times[1]): 1000})
+
+    def test_update_writes_in_one_batch(self):
+        start = self.times[0]
+        periods = {(start + timezone.timedelta(minutes=i), start + timezone.timedelta(minutes=i + 1)): i for i in range(200)}
+        with CaptureQueriesContext(connection) as queries:
+            server.handle_update_schedule_request(9, periods)
+        self.assertLessEqual(len(queries), 4)
+        self.assertEqual(self.get_stored(9), periods)
+        removed = list(periods)[:150]
+        changed = {period: 1 for period in list(periods)[150:]}
+        server.versions[9] = 1
+        with CaptureQueriesContext(connection) as queries:
+            server.handle_delta_schedule_request(9, 1, 2, removed, changed)
+        self.assertLessEqual(len(queries), 6)
+        self.assertEqual(self.get_stored(9), changed)
+
+""" Test the segment tree of the aggregate load against the scheduled consumption stored by the aggregator. """
+class AggregateLoadTestCase(TestCase):
+    def setUp(self):
+        self.rng = random.Random(11)
+        self.now = timezone.now().replace(microsecond=0) + timezone.timedelta(minutes=1)
+        server.load_consumption_data()
+        self.addCleanup(server.versions.clear)
+
+    def get_stored_maximum(self, start_time, end_time):
+        reference_times = server.get_consumption_reference_times_within(start_time, end_time)
+        return max(server.get_power_consumption(time) for time in reference_times)
+
+    def test_range_add_and_maximum(self):
+        tree = SegmentTree(depth=10)
+        values = [0] * tree.size
+        for _ in range(300):
+            start, end = sorted(self.rng.sample(range(tree.size + 1), 2))
+            value = self.rng.randint(-50, 100)
+            tree.add(start, end, value)
+            for i in range(start, end):
+                values[i] += value
+            start, end = sorted(self.rng.sample(range(tree.size + 1), 2))
+            self.assertEqual(tree.maximum(start, end), max(values[start:end]))
+        self.assertIsNone(tree.maximum(5, 5))
+
+    def test_choose_matches_stored_consumption(self):
+        minutes = lambda i: self.now + timezone.timedelta(minutes=i)
+        for home_id in range(1, 6):
+            periods = {}
+            for _ in range(20):
+                start, end = sorted(self.rng.sample(range(240), 2))
+                periods[(minutes(start), minutes(end))] = self.rng.randint(-500, 3000)
+            periods[(minutes(240), INF_DATE)] = 100 * home_id
+            server.handle_update_schedule_request(home_id, periods)
+        server.versions[3] = 1
+        server.handle_delta_schedule_request(3, 1, 2, list(server.scheduled[3])[:10], {(minutes(30), minutes(90)): 4000})
+        server.handle_update_schedule_request(4, {(minutes(0), minutes(60)): 700})
+        windows = [(minutes(start), minutes(start + length)) for start in range(0, 300, 13) for length in (1, 30, 120)]
+        windows += [(minutes(200), INF_DATE), (minutes(250), None)]
+        for start_time, end_time in windows:
+            self.assertEqual(server.get_maximum_power_consumption_within(start_time, end_time), self.get_stored_maximum(start_time, end_time))
+        expected = min(range(len(windows)), key=lambda i: self.get_stored_maximum(*windows[i]))
+        self.assertEqual(server.handle_choose_time_request(windows).index, expected)
+        tree = server.load
+        server.load_consumption_data()
+        self.assertLessEqual(server.load.nodes, tree.nodes)
+        self.assertEqual(server.get_maximum_power_consumption_within(*windows[0]), self.get_stored_maximum(*windows[0]))
+
+    def test_ended_consumption_is_not_loaded(self):
+        minutes = lambda i: self.now + timezone.timedelta(minutes=i)
+        ConsumptionData.objects.create(home_id=1, start_time=minutes(-120), end_time=minutes(-60), power=5000)
+        ConsumptionData.objects.create(home_id=1, start_time=minutes(-30), end_time=minutes(30), power=2000)
+        server.load_consumption_data()
+        for start_time, end_time in [(minutes(-90), minutes(-70)), (minutes(-90), minutes(10)), (minutes(-10), minutes(10))]:
+            self.assertEqual(server.get_maximum_power_consumption_within(start_time, end_time), self.get_stored_maximum(start_time, end_time))
+        self.assertEqual(server.get_maximum_power_consumption_within(minutes(-90), minutes(10)), 2000)
+        ConsumptionData.objects.all().delete()
+        server.load_consumption_data()
+
+""" Test that the aggregator answers requests on a pool of workers, serializing the writes of each home. """
+class AggregatorWorkersTestCase(TestCase):
+    def setUp(self):
+        self.address = f"inproc://aggregator-test-{self._testMethodName}"
+        self.now = timezone.now().replace(microsecond=0) + timezone.timedelta(minutes=1)
+        server.start(self.address, worker_count=4)
+        self.thread = threading.Thread(target=server.run, daemon=True)
+        self.thread.start()
+        self.addCleanup(server.load_consumption_data)
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        self.assertTrue(server.stop())
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    def request(self, message, timeout=-1):
+        socket = server.context.socket(zmq.REQ)
+        socket.linger = 0
+        socket.rcvtimeo = timeout
+        socket.connect(self.address)
+        try:
+            socket.send(protocol.encode(message))
+            return protocol.decode(socket.recv())
+        finally:
+            socket.close()
+
+    def run_concurrently(self, messages):
+        replies = [None] * len(messages)
+        def send(i):
+            replies[i] = self.request(messages[i])
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(len(messages))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return replies
+
+    def test_concurrent_choose_requests(self):
+        minutes = lambda i: self.now + timezone.timedelta(minutes=i)
+        server.update_load(1, {(minutes(0), minutes(60)): 2000, (minutes(120), minutes(180)): 500})
+        server.update_load(2, {(minutes(30), minutes(90)): 1000})
+        windows = [(minutes(start), minutes(start + 25)) for start in (0, 60, 90, 125)]
+        messages = [protocol.Message(protocol.CHOOSE, periods=windows[i:] + windows[:i]) for i in range(len(windows))] * 5
+        replies = self.run_concurrently(messages)
+        self.assertEqual([reply.type for reply in replies], [protocol.CHOICE] * len(messages))
+        self.assertEqual([message.periods[reply.index] for message, reply in zip(messages, replies)], [windows[2]] * len(messages))
+
+    def test_busy_worker_does_not_hold_up_requests(self):
+        released = threading.Event()
+        def write(home_id, consumption_periods, replaced=None):
+            released.wait(10)
+        message = protocol.Message(protocol.SYNC, 1, periods={(self.now, self.now + timezone.timedelta(minutes=15)): 100}, version=1)
+        with mock.patch.object(server, "write_consumption_data", write):
+            writer = threading.Thread(target=self.request, args=(message,))
+            writer.start()
+            try:
+                for _ in range(12):
+                    self.assertEqual(self.request(protocol.Message(protocol.CHOOSE, periods=[(self.now, None)]), timeout=2000).type, protocol.CHOICE)
+                self.assertTrue(writer.is_alive())
+            finally:
+                released.set()
+                writer.join(10)
+
+    def test_failed_requests_are_answered(self):
+        def write(home_id, consumption_periods, replaced=None):
+            raise RuntimeError("database is locked")
+        message = protocol.Message(protocol.SYNC, 1, periods={(self.now, self.now + timezone.timedelta(minutes=15)): 100}, version=1)
+        with mock.patch.object(server, "write_consumption_data", write), self.assertLogs(server.logger, "ERROR"):
+            replies = self.run_concurrently([message] * 6)
+        self.assertEqual([(reply.type, reply.text) for reply in replies], [(protocol.REPLY, "Request failed: database is locked")] * 6)
+        self.assertEqual(self.request(protocol.Message(protocol.CHOOSE, periods=[(self.now, None)])).type, protocol.CHOICE)
+
+    def test_plots_are_saved_from_workers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        times = [self.now + timezone.timedelta(hours=i) for i in range(3)]
+        # workers do not see the rows of the test transaction
+        with mock.patch.object(server, "PLOT_FILE", os.path.join(directory, "{title}.png")), \
+            mock.patch.object(server, "get_consumption_reference_times_within", lambda start_time, end_time: times), \
+            mock.patch.object(server, "get_power_consumption", lambda time: 800):
+            replies = [self.request(protocol.Message(protocol.PLOT, text="Day test")) for _ in range(3)]
+        path = os.path.join(directory, "Day_test.png")
+        self.assertEqual([reply.text for reply in replies], ["OK.", "OK.", f"Plot saved to {path}."])
+        self.assertTrue(os.path.exists(path))
+
+    def test_readers_share_the_load(self):
+        lock = server.ReadWriteLock()
+        events = []
+        def read():
+            with lock.read():
+                events.append("read")
+        def write():
+            with lock.write():
+                events.append("write")
+        with lock.read():
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(5)
+            self.assertEqual(events, ["read"])
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(0.1)
+            self.assertEqual(events, ["read"])
+        writer.join(5)
+        self.assertEqual(events, ["read", "write"])
+
+    def test_writes_serialized_per_home(self):
+        active = {}
+        overlaps = []
+        lock = threading.Lock()
+        def write(home_id, consumption_periods, replaced=None):
+            with lock:
+                active[home_id] = active.get(home_id, 0) + 1
+                overlaps.append((sum(active.values()), active[home_id]))
+            time.sleep(0.05)
+            with lock:
+                active[home_id] -= 1
+        periods = {(self.now, self.now + timezone.timedelta(minutes=15)): 100}
+        messages = [protocol.Message(protocol.SYNC, home_id, periods=periods, version=version) for version in (1, 2, 3) for home_id in (1, 2)]
+        with mock.patch.object(server, "write_consumption_data", write):
+            replies = self.run_concurrently(messages)
+        self.assertEqual([(reply.type, reply.home_id) for reply in replies], [(protocol.ACK, message.home_id) for message in messages])
+        self.assertEqual(max(home for _, home in overlaps), 1)
+        self.assertGreater(max(total for total, _ in overlaps), 1)
+
+class BenchmarkTestCase(TestCase):
+    def setUp(self):
+        self.rng = random.Random(5)
+        self.midnight = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0) + timezone.timedelta(days=1)
+
+    def test_generate_home(self):
+        home = benchmark.generate_home(self.rng, appliances=4, profiles_per_appliance=3, pv=True, bss=True)
+        self.assertEqual(Appliance.objects.filter(home=home).count(), 5)
+        self.assertEqual(Profile.objects.filter(appliance__home=home).count(), 12)
+        self.assertEqual(ProductionData.objects.filter(system=home.photovoltaicsystem).count(), 12 * 24)
+        executions = benchmark.generate_requests(self.rng, home, self.midnight, hours=12, rate=4)
+        self.assertTrue(executions)
+        self.assertTrue(all(self.midnight <= e.request_time < self.midnight + timezone.timedelta(hours=12) for e in executions))
+        self.assertFalse(any(home.compare_BSS_appliance(e.appliance) for e in executions))
+
+    def test_measure_and_compare(self):
+        home = benchmark.generate_home(self.rng, appliances=2, pv=False, bss=False)
+        result = benchmark.Benchmark(seed=5)
+        for _ in range(3):
+            result.measure("count", Home.objects.filter(pk=home.id).count)
+        summary = result.summary()["count"]
+        self.assertEqual(summary["count"], 3)
+        self.assertEqual(summary["queries"], {"mean": 1, "max": 1, "total": 3})
+        self.assertLessEqual(summary["latency_ms"]["p50"], summary["latency_ms"]["max"])
+        self.assertEqual(benchmark.get_percentile([1, 2, 3, 4], 50), 2.5)
+        results = result.results()
+        self.assertEqual(benchmark.compare(results, results)["count"]["queries_mean"], 1)
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.h1 = Home.objects.create(consumption_threshold=8000, strategy=PEAK_SHAVING, is_running=False)
+        self.p1 = Profile.objects.create(name="Test 1", schedulability=INTERRUPTIBLE, priority=NORMAL, maximum_duration_of_usage=timezone.timedelta(hours=1), rated_power=3000)
+        self.a1 = Appliance.objects.create(home=self.h1, name="Test 1")
+        self.a1.profiles.set([self.p1])
+        self.now = timezone.now()
+        metrics.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def get_histogram(self, data, name):
+        return next(histogram for histogram in data["histograms"] if histogram["name"] == name)
+
+    def test_schedule_execution_metrics(self):
+        for _ in range(2):
+            core.schedule_execution(Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1), self.now)
+        data = metrics.snapshot()
+        strategies = {counter["labels"]["strategy"]: counter["value"] for counter in data["counters"] if counter["name"] == "schedule_strategy_total"}
+        self.assertEqual(strategies, {"0": 2})
+        self.assertEqual(self.get_histogram(data, "schedule_execution_seconds")["count"], 2)
+        self.assertGreater(self.get_histogram(data, "schedule_execution_queries")["sum"], 0)
+        self.assertGreaterEqual(self.get_histogram(data, "schedule_candidate_periods")["sum"], 2)
+
+    def test_nested_scheduling_measured_once(self):
+        e1 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+        e2 = Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1)
+        place_execution = coordinator.place_execution
+        def place_and_replan(execution, request_time, debug=False):
+            if execution.id == e1.id:
+                core.schedule_execution(e2, request_time)
+            return place_execution(execution, request_time, debug)
+        with mock.patch.object(coordinator, "place_execution", side_effect=place_and_replan):
+            core.schedule_execution(e1, self.now)
+        data = metrics.snapshot()
+        self.assertEqual(sum(counter["value"] for counter in data["counters"] if counter["name"] == "schedule_strategy_total"), 2)
+        self.assertEqual(self.get_histogram(data, "schedule_execution_seconds")["count"], 1)
+        self.assertEqual(self.get_histogram(data, "schedule_execution_queries")["count"], 1)
+        core.schedule_execution(Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1), self.now)
+        self.assertEqual(self.get_histogram(metrics.snapshot(), "schedule_execution_seconds")["count"], 2)
+
+    def test_disabled_metrics_are_not_recorded(self):
+        metrics.disable()
+        core.schedule_execution(Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1), self.now)
+        self.assertEqual(metrics.snapshot()["counters"], [])
+        self.assertEqual(metrics.snapshot()["histograms"], [])
+
+    def test_metrics_command(self):
+        core.schedule_execution(Execution.objects.create(home=self.h1, appliance=self.a1, profile=self.p1), self.now)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.json")
+            metrics.save(path)
+            output = io.StringIO()
+            call_command("metrics", file=path, stdout=output)
+        text = output.getvalue()
+        self.assertIn('schedule_strategy_total{strategy="0"} 1', text)
+        self.assertIn('schedule_execution_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn("schedule_execution_queries_count 1", text)
+
+
+""" Test that job changes are served from memory and written to the database in batches. """
+class WriteBehindJobStoreTestCase(TestCase):
+    def setUp(self):
+        self.run_date = timezone.now() + timezone.timedelta(days=1)
+
+    def start_scheduler(self, store):
+        scheduler = BackgroundScheduler()
+        scheduler.add_jobstore(store, "default")
+        scheduler.start(paused=True)
+        self.addCleanup(scheduler.shutdown, wait=False)
+        return scheduler
+
+    def test_changes_are_written_in_batches(self):
+        store = WriteBehindJobStore(delay=None)
+        scheduler = self.start_scheduler(store)
+        with CaptureQueriesContext(connection) as queries:
+            for i in range(5):
+                scheduler.add_job(delete_old_job_executions, 'date', run_date=self.run_date, id=f"job_{i}")
+            scheduler.get_job("job_0").modify(next_run_time=self.run_date + timezone.timedelta(hours=1))
+            scheduler.remove_job("job_4")
+            self.assertEqual(len(scheduler.get_jobs()), 4)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(DjangoJob.objects.count(), 0)
+        store.flush()
+        self.assertEqual(set(DjangoJob.objects.values_list("id", flat=True)), {"job_0", "job_1", "job_2", "job_3"})
+        self.assertEqual(DjangoJob.objects.get(id="job_0").next_run_time, self.run_date + timezone.timedelta(hours=1))
+        scheduler.remove_job("job_1")
+        scheduler.get_job("job_2").modify(next_run_time=self.run_date + timezone.timedelta(hours=2))
+        store.flush()
+        self.assertEqual(DjangoJob.objects.count(), 3)
+        self.assertEqual(DjangoJob.objects.get(id="job_2").next_run_time, self.run_date + timezone.timedelta(hours=2))
+
+    def test_jobs_survive_restart(self):
+        store = WriteBehindJobStore(delay=None)
+        scheduler = self.start_scheduler(store)
+        scheduler.add_job(delete_old_job_executions, 'date', run_date=self.run_date, id="job")
+        store.shutdown()
+        restarted = self.start_scheduler(WriteBehindJobStore(delay=None))
+        job = restarted.get_job("job")
+        self.assertIsNotNone(job)
+        self.assertEqual(job.next_run_time, self.run_date)
+        self.assertEqual(job.func, delete_old_job_executions)
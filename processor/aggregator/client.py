@@ -1,16 +1,23 @@
 import zmq
-import json
+import threading
 
 from django.utils import timezone
 
 import processor.core as core
 import processor.external_energy as ext
+import processor.metrics as metrics
+import processor.aggregator.protocol as protocol
 from processor.tools import compact_periods
 from coordinator.models import NoAggregatorException
+from coordinator.settings import AGGREGATOR_PROTOCOL, AGGREGATOR_DELTA_UPDATES
 
 context = zmq.Context()
 socket = None
 started = False
+# requests of different homes share the socket, one round trip at a time
+lock = threading.Lock()
+# (version, periods) of the schedule of each home last acknowledged by the aggregator, by outside id
+schedules = {}
 
 def start():
     print("Connecting to aggregator…")
@@ -23,6 +30,7 @@ def start():
 def stop():
     global started
     started = False
+    schedules.clear()
     context.term()
 
 def get_consumption_periods(home, current_time):
@@ -40,27 +48,49 @@ def get_consumption_periods(home, current_time):
     consumption_periods = compact_periods(consumption_periods)
     return consumption_periods
 
-# Convert from {(start_time, end_time): power } to {start_time: {end_time: X, power: Y}}
-def format_time_periods(periods, include_value=True):
-    formatted_periods = {}
-    i = 1
-    for period in periods:
-        details = {}
-        if period[1] is not None:
-            details["end_time"] = period[1].strftime("%Y-%m-%d %H:%M:%S:%f %z")
-        if include_value:
-            details["power"] = periods[period]
-        formatted_periods[period[0].strftime("%Y-%m-%d %H:%M:%S:%f %z")] = details
-        i += 1
-    return formatted_periods
+def exchange(frame, name):
+    with lock, metrics.timer("aggregator_round_trip", request=name):
+        socket.send(frame)
+        return socket.recv()
+
+# Sends a request in the protocol of this coordinator (AGGREGATOR_PROTOCOL) and returns the reply as text
+def send_request(message):
+    frame = protocol.encode(message) if AGGREGATOR_PROTOCOL == "binary" else protocol.encode_text(message)
+    return protocol.decode_reply(exchange(frame, protocol.NAMES[message.type]))
+
+# Sends the periods changed since the schedule last acknowledged, or the whole schedule when the
+# aggregator does not have that version
+def send_schedule(home_id, periods):
+    if home_id not in schedules:
+        return sync_schedule(home_id, periods, 1)
+    version, acknowledged = schedules[home_id]
+    removed, changed = protocol.get_schedule_delta(acknowledged, periods)
+    if not removed and not changed:
+        metrics.increment("aggregator_updates_total", mode="unchanged")
+        return "Schedule unchanged."
+    metrics.increment("aggregator_updates_total", mode="delta")
+    message = protocol.Message(protocol.DELTA, home_id, periods=changed, removed=removed, base_version=version, version=version + 1)
+    reply = protocol.decode(exchange(protocol.encode(message), "delta"))
+    if reply.type == protocol.RESYNC:
+        return sync_schedule(home_id, periods, max(version, reply.version) + 1)
+    return acknowledge_schedule(home_id, periods, reply)
+
+def sync_schedule(home_id, periods, version):
+    metrics.increment("aggregator_updates_total", mode="sync")
+    message = protocol.Message(protocol.SYNC, home_id, periods=periods, version=version)
+    return acknowledge_schedule(home_id, periods, protocol.decode(exchange(protocol.encode(message), "sync")))
+
+def acknowledge_schedule(home_id, periods, reply):
+    if reply.type == protocol.ACK:
+        schedules[home_id] = (reply.version, dict(periods))
+        return f"Schedule version {reply.version} acknowledged."
+    schedules.pop(home_id, None)
+    return reply.text
 
 def send_choice_request(available_periods):
     if not started:
         raise NoAggregatorException()
-    formatted_periods = format_time_periods(available_periods, False)
-    str = f"choose {json.dumps(formatted_periods)}".encode("utf-8")
-    socket.send(str)
-    response = socket.recv().decode("utf-8")
+    response = send_request(protocol.Message(protocol.CHOOSE, periods=list(available_periods)))
     # print("Received reply: %s" % response)
     return response
 
@@ -69,14 +99,12 @@ def send_update_schedule(home, request_time=None):
         request_time = timezone.now()
     if started:
         consumption_periods = get_consumption_periods(home, request_time)
-        formatted_periods = format_time_periods(consumption_periods, True)
-        str = f"update {home.outside_id} {json.dumps(formatted_periods)}".encode("utf-8")
-        socket.send(str)
-        response = socket.recv().decode("utf-8")
+        if AGGREGATOR_PROTOCOL == "binary" and AGGREGATOR_DELTA_UPDATES:
+            response = send_schedule(home.outside_id, consumption_periods)
+        else:
+            response = send_request(protocol.Message(protocol.UPDATE, home.outside_id, periods=consumption_periods))
         print("Received reply: %s" % response)
 
 def send_create_plot(graph_title):
-    str = f"plot {graph_title}".encode("utf-8")
-    socket.send(str)
-    response = socket.recv().decode("utf-8")
+    response = send_request(protocol.Message(protocol.PLOT, text=graph_title))
     print("Received reply: %s" % response)
@@ -0,0 +1,201 @@
+import json
+import struct
+from datetime import datetime, timezone as dt_timezone
+
+'''
+Binary wire protocol between coordinators and the aggregator.
+Every frame starts with a typed envelope: the magic bytes "HM", the protocol version, the message
+type and the home id (0 when not applicable). Periods follow as a count and packed arrays of start
+times, end times and, for consumption updates, powers: times as signed 64-bit epoch microseconds,
+so they round-trip exactly, and powers as signed 64-bit integer watts. Text payloads (plot titles,
+replies) are UTF-8.
+Schedules can also be kept in sync incrementally: a SYNC carries a home's whole consumption curve
+and a DELTA only the periods removed and added or changed since the version the aggregator last
+acknowledged (ACK). When the base version of a delta is not the aggregator's, it asks for a full
+SYNC (RESYNC) instead. These messages only exist in the binary protocol.
+Frames without the magic bytes are text commands of the original protocol
+("choose {json}", "update {id} {json}", "plot {title}"), which the aggregator keeps accepting
+while coordinators are switched over (see AGGREGATOR_PROTOCOL).
+'''
+MAGIC = b"HM"
+VERSION = 1
+
+CHOOSE = 1
+UPDATE = 2
+PLOT = 3
+CHOICE = 4
+REPLY = 5
+SYNC = 6
+DELTA = 7
+ACK = 8
+RESYNC = 9
+NAMES = {CHOOSE: "choose", UPDATE: "update", PLOT: "plot", CHOICE: "choice", REPLY: "reply",
+    SYNC: "sync", DELTA: "delta", ACK: "ack", RESYNC: "resync"}
+
+HEADER = struct.Struct(">2sBBq")
+COUNT = struct.Struct(">I")
+INDEX = struct.Struct(">i")
+VERSIONS = struct.Struct(">qq")
+NO_TIME = -2**63
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+TEXT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S:%f %z"
+
+class ProtocolError(Exception):
+    pass
+
+class Message:
+    def __init__(self, type, home_id=0, periods=None, text=None, index=None, version=0, base_version=0, removed=None):
+        self.type = type
+        self.home_id = home_id
+        self.periods = periods
+        self.text = text
+        self.index = index
+        self.version = version
+        self.base_version = base_version
+        self.removed = removed
+
+def is_binary(frame):
+    return frame[:len(MAGIC)] == MAGIC
+
+def to_epoch(time):
+    if time is None:
+        return NO_TIME
+    delta = time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def from_epoch(value):
+    if value == NO_TIME:
+        return None
+    seconds, microseconds = divmod(value, 1000000)
+    return datetime.fromtimestamp(seconds, dt_timezone.utc).replace(microsecond=microseconds)
+
+# {(start_time, end_time): power} for updates, or an iterable of (start_time, end_time) for choices
+def pack_periods(periods, include_power):
+    periods = list(periods.items()) if include_power else [(period, None) for period in periods]
+    count = len(periods)
+    times = [to_epoch(period[0]) for period, _ in periods] + [to_epoch(period[1]) for period, _ in periods]
+    frame = COUNT.pack(count) + struct.pack(f">{2 * count}q", *times)
+    if include_power:
+        frame += struct.pack(f">{count}q", *[round(power) for _, power in periods])
+    return frame
+
+# Periods packed at offset, and the offset after them
+def unpack_periods(payload, include_power, offset=0):
+    (count,) = COUNT.unpack_from(payload, offset)
+    size = (3 if include_power else 2) * count
+    values = struct.unpack_from(f">{size}q", payload, offset + COUNT.size)
+    offset += COUNT.size + 8 * size
+    periods = [(from_epoch(values[i]), from_epoch(values[count + i])) for i in range(count)]
+    if include_power:
+        return {period: values[2 * count + i] for i, period in enumerate(periods)}, offset
+    return periods, offset
+
+def encode(message):
+    frame = HEADER.pack(MAGIC, VERSION, message.type, message.home_id or 0)
+    if message.type in (CHOOSE, UPDATE):
+        frame += pack_periods(message.periods, message.type == UPDATE)
+    elif message.type in (PLOT, REPLY):
+        frame += message.text.encode("utf-8")
+    elif message.type == CHOICE:
+        frame += INDEX.pack(message.index)
+    elif message.type in (SYNC, DELTA, ACK, RESYNC):
+        frame += VERSIONS.pack(message.base_version, message.version)
+        if message.type == DELTA:
+            frame += pack_periods(message.removed, False)
+        if message.type in (SYNC, DELTA):
+            frame += pack_periods(message.periods, True)
+    else:
+        raise ProtocolError(f"Unknown message type {message.type}.")
+    return frame
+
+def decode(frame):
+    if not is_binary(frame) or len(frame) < HEADER.size:
+        raise ProtocolError("Not a binary frame.")
+    _, version, type, home_id = HEADER.unpack_from(frame)
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}.")
+    payload = frame[HEADER.size:]
+    try:
+        if type in (CHOOSE, UPDATE):
+            return Message(type, home_id, periods=unpack_periods(payload, type == UPDATE)[0])
+        if type in (PLOT, REPLY):
+            return Message(type, home_id, text=payload.decode("utf-8"))
+        if type == CHOICE:
+            return Message(type, home_id, index=INDEX.unpack(payload)[0])
+        if type in (SYNC, DELTA, ACK, RESYNC):
+            base_version, version = VERSIONS.unpack_from(payload)
+            message = Message(type, home_id, version=version, base_version=base_version)
+            offset = VERSIONS.size
+            if type == DELTA:
+                message.removed, offset = unpack_periods(payload, False, offset)
+            if type in (SYNC, DELTA):
+                message.periods, offset = unpack_periods(payload, True, offset)
+            return message
+    except (struct.error, UnicodeDecodeError) as error:
+        raise ProtocolError(f"Malformed message of type {type}: {error}")
+    raise ProtocolError(f"Unknown message type {type}.")
+
+# Reply of either protocol, as text
+def decode_reply(frame):
+    if not is_binary(frame):
+        return frame.decode("utf-8")
+    reply = decode(frame)
+    return str(reply.index) if reply.type == CHOICE else reply.text
+
+# Convert from {(start_time, end_time): power } to {start_time: {end_time: X, power: Y}}
+def format_time_periods(periods, include_value=True):
+    formatted_periods = {}
+    for period in periods:
+        details = {}
+        if period[1] is not None:
+            details["end_time"] = period[1].strftime(TEXT_TIME_FORMAT)
+        if include_value:
+            details["power"] = periods[period]
+        formatted_periods[period[0].strftime(TEXT_TIME_FORMAT)] = details
+    return formatted_periods
+
+def parse_time_periods(period_string, include_value=True):
+    periods = {}
+    for start_time, details in json.loads(period_string).items():
+        end_time = details.get("end_time")
+        period = (datetime.strptime(start_time, TEXT_TIME_FORMAT),
+            datetime.strptime(end_time, TEXT_TIME_FORMAT) if end_time is not None else None)
+        periods[period] = details.get("power")
+    return periods if include_value else list(periods)
+
+# Original text commands and replies
+def encode_text(message):
+    if message.type == CHOOSE:
+        text = f"choose {json.dumps(format_time_periods(message.periods, False))}"
+    elif message.type == UPDATE:
+        text = f"update {message.home_id} {json.dumps(format_time_periods(message.periods, True))}"
+    elif message.type == PLOT:
+        text = f"plot {message.text}"
+    elif message.type == CHOICE:
+        text = f"{message.index}"
+    elif message.type == REPLY:
+        text = message.text
+    else:
+        raise ProtocolError(f"No text command for {NAMES.get(message.type, message.type)} messages.")
+    return text.encode("utf-8")
+
+def decode_text(frame):
+    text = frame.decode("utf-8")
+    command = text.split(" ", 2)
+    try:
+        match command[0]:
+            case "choose":
+                return Message(CHOOSE, periods=parse_time_periods(text[7:], False))
+            case "update":
+                return Message(UPDATE, int(command[1]), periods=parse_time_periods(command[2], True))
+            case "plot":
+                return Message(PLOT, text=text.split(" ", 1)[1])
+    except (IndexError, ValueError, AttributeError) as error:
+        raise ProtocolError(f"Malformed {command[0]} command: {error}")
+    raise ProtocolError(f"Unknown command {command[0]}.")
+
+# Periods of the new schedule removed from, and added or changed since, the old one
+def get_schedule_delta(old, new):
+    removed = [period for period in old if period not in new]
+    changed = {period: power for period, power in new.items() if old.get(period) != power}
+    return removed, changed
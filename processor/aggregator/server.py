@@ -1,34 +1,255 @@
+import re
 import zmq
-import json
+import logging
+import threading
+import contextlib
 import numpy as np
 
-import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from matplotlib.figure import Figure
 from django.utils import timezone
+from django import db
+from django.db import transaction
+from django.db.models import Q
 from aggregator.models import ConsumptionData
 from home.settings import INF_DATE
+from processor.segments import SegmentTree
+import processor.aggregator.protocol as protocol
+from coordinator.settings import AGGREGATOR_ADDRESS, AGGREGATOR_WORKERS
+
+'''
+Aggregator server.
+Coordinators connect to a ROUTER socket, whose requests are passed through a second ROUTER to the
+least recently idle of a pool of worker threads, with replies routed back. Workers announce
+themselves as READY and are only handed a request once they have answered the last one, so a slow
+request holds up its own worker and not the requests behind it; when all of them are busy,
+requests wait in the frontend queue. Workers share the scheduled load under a readers-writer lock: choose
+requests read the tree together, and writes of a home's schedule run one at a time under the lock
+of that home, holding the load for writing only to apply the result.
+Workers are threads, so Python code in requests still runs one at a time; what they overlap is
+the time spent in database writes and socket I/O, not computation across cores.
+'''
+logger = logging.getLogger(__name__)
 
 context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.bind("tcp://*:5555")
+frontend = None
+backend = None
+control = None
+controller = None
+workers = []
+running = threading.Event()
+stopped = threading.Event()
+
+WORKERS_ADDRESS = "inproc://aggregator-workers"
+CONTROL_ADDRESS = "inproc://aggregator-control"
+# sent by a worker once it is ready for its first request
+READY = b"READY"
+POLL_TIMEOUT = 100 # ms
+STOP_TIMEOUT = 10 # s
+DELETE_BATCH_SIZE = 100
+# consumption plots are saved, as requests run on worker threads, where interactive backends cannot open windows
+PLOT_FILE = "{title}.png"
+# the load tree is rebuilt when it has this many nodes per scheduled period, as nodes are never freed
+REBUILD_NODES = 1000
 
 x = []
 y = []
+# schedule version of each home, as last synced or updated by delta
+versions = {}
+# scheduled consumption periods of each home, and the net load of the neighbourhood over epoch microseconds
+scheduled = {}
+load = SegmentTree()
+home_locks = {}
+homes_lock = threading.Lock()
+plot_lock = threading.Lock()
+
+'''
+ReadWriteLock class
+Shared for readers, exclusive for a writer. Readers arriving while a writer waits queue behind it,
+so a steady stream of choose requests cannot starve updates.
+'''
+class ReadWriteLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+load_lock = ReadWriteLock()
+
+def start(address=AGGREGATOR_ADDRESS, worker_count=AGGREGATOR_WORKERS):
+    global frontend, backend, control, controller
+    load_consumption_data()
+    stopped.clear()
+    frontend = bind(zmq.ROUTER, address)
+    backend = bind(zmq.ROUTER, WORKERS_ADDRESS)
+    control = bind(zmq.PAIR, CONTROL_ADDRESS)
+    controller = context.socket(zmq.PAIR)
+    controller.linger = 0
+    controller.connect(CONTROL_ADDRESS)
+    running.set()
+    for i in range(worker_count):
+        thread = threading.Thread(target=work, name=f"aggregator-worker-{i}", daemon=True)
+        workers.append(thread)
+        thread.start()
+
+def bind(type, address):
+    socket = context.socket(type)
+    socket.linger = 0
+    socket.bind(address)
+    return socket
+
+# Forwards requests to idle workers and replies back until stop is called, then releases the addresses.
+# Requests are only read while a worker is idle, so the rest queue on the frontend.
+def run():
+    busy = zmq.Poller()
+    for socket in (backend, control):
+        busy.register(socket, zmq.POLLIN)
+    available = zmq.Poller()
+    for socket in (frontend, backend, control):
+        available.register(socket, zmq.POLLIN)
+    idle = []
+    try:
+        while True:
+            events = dict((available if idle else busy).poll())
+            if control in events:
+                control.recv()
+                break
+            if backend in events:
+                worker, _, *reply = backend.recv_multipart()
+                idle.append(worker)
+                if reply != [READY]:
+                    frontend.send_multipart(reply)
+            if idle and frontend in events:
+                backend.send_multipart([idle.pop(0), b""] + frontend.recv_multipart())
+    finally:
+        running.clear()
+        for thread in workers:
+            thread.join()
+        workers.clear()
+        for socket in (frontend, backend, control):
+            socket.unbind(socket.last_endpoint)
+            socket.close()
+        stopped.set()
+
+# Ends run and waits for it to return; False when it did not within the timeout
+def stop(timeout=STOP_TIMEOUT):
+    controller.send(b"TERMINATE")
+    controller.close()
+    return stopped.wait(timeout)
+
+# Answers one request at a time, keeping the envelope of the coordinator it came from
+def work():
+    socket = context.socket(zmq.REQ)
+    socket.linger = 0
+    socket.connect(WORKERS_ADDRESS)
+    try:
+        socket.send(READY)
+        while running.is_set():
+            if socket.poll(POLL_TIMEOUT):
+                *envelope, request = socket.recv_multipart()
+                socket.send_multipart(envelope + [answer_request(request)])
+    finally:
+        socket.close()
+        db.connection.close()
+
+def get_home_lock(home_id):
+    with homes_lock:
+        return home_locks.setdefault(home_id, threading.Lock())
+
+def load_consumption_data():
+    with load_lock.write():
+        scheduled.clear()
+        for consumption in get_scheduled_consumption():
+            scheduled.setdefault(consumption.home_id, {})[(consumption.start_time, consumption.end_time)] = consumption.power
+        rebuild_load()
+
+# Epoch microseconds covered by [start_time, end_time), where no end time means forever
+def get_load_range(start_time, end_time):
+    end = protocol.to_epoch(end_time) if end_time is not None else load.size
+    return protocol.to_epoch(start_time), end
+
+def add_load(period, power):
+    load.add(*get_load_range(*period), power)
+
+# Replaces the load of all periods of a home, or only of the periods replaced, as in write_consumption_data
+def update_load(home_id, consumption_periods, replaced=None):
+    with load_lock.write():
+        periods = scheduled.setdefault(home_id, {})
+        for period in (list(periods) if replaced is None else replaced):
+            power = periods.pop(period, None)
+            if power is not None:
+                add_load(period, -power)
+        for period, power in consumption_periods.items():
+            periods[period] = power
+            add_load(period, power)
+        if load.nodes > REBUILD_NODES * (sum(len(periods) for periods in scheduled.values()) + 1):
+            rebuild_load()
+
+def rebuild_load():
+    global load
+    load = SegmentTree()
+    for periods in scheduled.values():
+        for period, power in periods.items():
+            add_load(period, power)
 
 def get_scheduled_consumption():
 	return ConsumptionData.objects.exclude(end_time__lt=timezone.now()).order_by('end_time')
 
-def create_consumption_data(home_id, start_time, end_time, power):
-    return ConsumptionData.objects.create(
-        home_id=home_id,
-        start_time=start_time,
-        end_time=end_time,
-        power=power
-    )
+# Writes the periods of a home in one transaction and a single insert batch, replacing all of its
+# rows, or only those of the periods replaced
+def write_consumption_data(home_id, consumption_periods, replaced=None):
+    with transaction.atomic():
+        if replaced is None:
+            clean_consumption_data(home_id)
+        else:
+            delete_consumption_data(home_id, replaced)
+        ConsumptionData.objects.bulk_create([
+            ConsumptionData(home_id=home_id, start_time=start_time, end_time=end_time, power=power)
+            for (start_time, end_time), power in consumption_periods.items()
+        ])
+    update_load(home_id, consumption_periods, replaced)
 
 def clean_consumption_data(home_id):
     ConsumptionData.objects.filter(home_id=home_id).delete()
 
+# Periods are matched in batches, keeping each condition within database expression limits
+def delete_consumption_data(home_id, periods):
+    for i in range(0, len(periods), DELETE_BATCH_SIZE):
+        condition = Q()
+        for start_time, end_time in periods[i:i + DELETE_BATCH_SIZE]:
+            condition |= Q(start_time=start_time, end_time=end_time)
+        ConsumptionData.objects.filter(condition, home_id=home_id).delete()
+
 def get_scheduled_consumption_within(start_time, end_time):
 	scheduled = get_scheduled_consumption()
 	if end_time is None:
@@ -55,40 +276,47 @@ def get_consumption_reference_times_within(start_time, end_time):
     time_list = sorted(list(dict.fromkeys(time_list)))
     return time_list
 
+# Peak of the scheduled load over [start_time, end_time], as get_power_consumption gives it at
+# each reference time; periods that had ended when the load was last loaded are left out of it
 def get_maximum_power_consumption_within(start_time, end_time):
-	peak_consumption = 0
-	reference_times = get_consumption_reference_times_within(start_time, end_time)
-	for time in reference_times:
-		power_consumption = get_power_consumption(time)
-		if power_consumption > peak_consumption:
-			peak_consumption = power_consumption
-	return peak_consumption
-
-def handle_choose_time_request(period_string):
-    available_periods = json.loads(period_string)
+    start, end = get_load_range(start_time, end_time)
+    if end_time is not None:
+        end += 1
+    with load_lock.read():
+        return max(load.maximum(start, end) or 0, 0)
+
+# Index of the available period with the lowest peak consumption
+def handle_choose_time_request(available_periods):
     minimum_consumption = None
     selected_index = index = 0
-    for period in available_periods:
-        start_time = timezone.datetime.strptime(period, '%Y-%m-%d %H:%M:%S:%f %z')
-        end_time = timezone.datetime.strptime(available_periods[period]["end_time"], '%Y-%m-%d %H:%M:%S:%f %z')
+    for start_time, end_time in available_periods:
         power_consumption = get_maximum_power_consumption_within(start_time, end_time)
         if minimum_consumption is None or power_consumption < minimum_consumption:
             minimum_consumption = power_consumption
             selected_index = index
         index += 1
-    str = f"{selected_index}".encode("utf-8")
-    socket.send(str)
-
-def handle_update_schedule_request(home_id, period_string):
-    clean_consumption_data(home_id)
-    consumption_periods = json.loads(period_string)
-    for period in consumption_periods:
-        start_time = timezone.datetime.strptime(period, '%Y-%m-%d %H:%M:%S:%f %z')
-        end_time = timezone.datetime.strptime(consumption_periods[period]["end_time"], '%Y-%m-%d %H:%M:%S:%f %z')
-        power = consumption_periods[period]["power"]
-        create_consumption_data(home_id, start_time, end_time, power)
-    str = f"Consumption data updated.".encode("utf-8")
-    socket.send(str)    
+    return protocol.Message(protocol.CHOICE, index=selected_index)
+
+def handle_update_schedule_request(home_id, consumption_periods):
+    with get_home_lock(home_id):
+        write_consumption_data(home_id, consumption_periods)
+        versions.pop(home_id, None)
+    return protocol.Message(protocol.REPLY, text="Consumption data updated.")
+
+def handle_sync_schedule_request(home_id, version, consumption_periods):
+    with get_home_lock(home_id):
+        write_consumption_data(home_id, consumption_periods)
+        versions[home_id] = version
+    return protocol.Message(protocol.ACK, home_id, version=version)
+
+# Applied only on top of the version it was computed from, otherwise a full sync is requested
+def handle_delta_schedule_request(home_id, base_version, version, removed, changed):
+    with get_home_lock(home_id):
+        if versions.get(home_id) != base_version:
+            return protocol.Message(protocol.RESYNC, home_id, version=versions.get(home_id, 0))
+        write_consumption_data(home_id, changed, removed + list(changed))
+        versions[home_id] = version
+    return protocol.Message(protocol.ACK, home_id, version=version)
 
 def handle_create_consumption_plot_request(title):
     global x
@@ -113,8 +341,10 @@ def handle_create_consumption_plot_request(title):
     average = np.average(y[-1][0:-1], weights=weights)
     print(f"Peak: {peak}\nAverage: {average}\nPAR: {peak/average}")
 
+    reply = "OK."
     if len(x) == 3:
-        _, ax = plt.subplots(constrained_layout=True)
+        figure = Figure(constrained_layout=True)
+        ax = figure.subplots()
         ax.step(x[2], y[2], where='post', zorder=1)
         ax.step(x[1], y[1], where='post', zorder=0)
         ax.step(x[0], y[0], where='post', zorder=2)
@@ -125,29 +355,50 @@ def handle_create_consumption_plot_request(title):
         ax.set_ylabel('Consumption (W)')
         ax.xaxis.set_major_formatter(myFmt)
         ax.xaxis.set_tick_params(rotation=40)
-        plt.legend(["Baseline", "Single-House", "Multi-House"])
-        plt.show()
+        ax.legend(["Baseline", "Single-House", "Multi-House"])
+        path = PLOT_FILE.format(title=re.sub(r"[^\w-]+", "_", title))
+        figure.savefig(path)
+        reply = f"Plot saved to {path}."
         x = []
         y = []
-    str = f"OK.".encode("utf-8")
-    socket.send(str)    
-
-def parse_request(message):
-    parsed_message = message.split(" ", 2)
-    match parsed_message[0]:
-        case 'choose': # ask for best available time
-            handle_choose_time_request(message[7:])
-        case 'update': # send all consumption periods
-            handle_update_schedule_request(parsed_message[1], parsed_message[2])
-        case 'plot': # debug
-            parsed_message = message.split(" ", 1)
-            handle_create_consumption_plot_request(parsed_message[1])
-
-
-def receive_request():
-    message = socket.recv().decode('utf-8')
-    print("Received request: %s" % message)
-    parse_request(message)
+    return protocol.Message(protocol.REPLY, text=reply)
+
+def handle_request(message):
+    match message.type:
+        case protocol.CHOOSE: # ask for best available time
+            return handle_choose_time_request(message.periods)
+        case protocol.UPDATE: # send all consumption periods
+            return handle_update_schedule_request(message.home_id, message.periods)
+        case protocol.SYNC: # send all consumption periods of a schedule version
+            return handle_sync_schedule_request(message.home_id, message.version, message.periods)
+        case protocol.DELTA: # send consumption periods changed since a schedule version
+            return handle_delta_schedule_request(message.home_id, message.base_version, message.version, message.removed, message.periods)
+        case protocol.PLOT: # debug
+            with plot_lock:
+                return handle_create_consumption_plot_request(message.text)
+    raise protocol.ProtocolError(f"Unexpected {protocol.NAMES.get(message.type, message.type)} request.")
+
+# Binary requests are answered in binary, text commands in text (see processor.aggregator.protocol)
+def parse_request(frame):
+    try:
+        message = protocol.decode(frame) if protocol.is_binary(frame) else protocol.decode_text(frame)
+        print(f"Received {protocol.NAMES[message.type]} request{f' from home {message.home_id}' if message.home_id else ''}.")
+        reply = handle_request(message)
+    except protocol.ProtocolError as error:
+        print(f"Invalid request: {error}")
+        reply = protocol.Message(protocol.REPLY, text=f"Invalid request: {error}")
+    return encode_reply(frame, reply)
+
+def encode_reply(frame, reply):
+    return protocol.encode(reply) if protocol.is_binary(frame) else protocol.encode_text(reply)
+
+# Every request gets a reply, as its REQ client waits for one and the worker serves no other request until it is sent
+def answer_request(frame):
+    try:
+        return parse_request(frame)
+    except Exception as error:
+        logger.exception("Aggregator request failed.")
+        return encode_reply(frame, protocol.Message(protocol.REPLY, text=f"Request failed: {error}"))
 
 def get_np_num(time):
     return mdates.date2num(timezone.make_naive(time))
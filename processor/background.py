@@ -1,18 +1,161 @@
-import os, logging
+import os, logging, pickle, threading
 
+from django import db
 from django.conf import settings
+from django.db import transaction
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.jobstores.memory import MemoryJobStore
 from django_apscheduler.jobstores import DjangoJobStore
-from django_apscheduler.models import DjangoJobExecution
+from django_apscheduler.models import DjangoJob, DjangoJobExecution
+from django_apscheduler.util import get_django_internal_datetime
 from django_apscheduler import util
 
+import processor.shards as shards
+from coordinator.settings import JOB_STORE_WRITE_DELAY
+
 logger = logging.getLogger(__name__)
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coordinator.settings")
 
+'''
+WriteBehindJobStore class
+DjangoJobStore serving reads from memory. Jobs are loaded from the database when the scheduler starts;
+afterwards adding, updating or removing a job only changes the in-memory store and queues the change.
+Queued changes are written in a single transaction, keeping only the latest change of each job,
+after a short delay, before due jobs are run and when the store is flushed or shut down.
+When sharded, the store only loads and writes the jobs of the homes of its shard (see processor.shards).
+'''
+class WriteBehindJobStore(DjangoJobStore):
+	def __init__(self, delay=JOB_STORE_WRITE_DELAY, **kwargs):
+		super().__init__(**kwargs)
+		self.delay = delay
+		self.memory = MemoryJobStore()
+		self.pending = {}
+		self.lock = threading.RLock()
+		self.flush_lock = threading.Lock()
+		self.timer = None
+
+	def start(self, scheduler, alias):
+		super().start(scheduler, alias)
+		self.memory.start(scheduler, alias)
+		self.load()
+
+	# Loads the jobs of this shard not in memory yet
+	def load(self):
+		for job_id, job_state in DjangoJob.objects.values_list("id", "job_state"):
+			if not shards.owns_job(job_id):
+				continue
+			with self.lock:
+				if job_id in self.pending or self.memory.lookup_job(job_id) is not None:
+					continue
+				try:
+					self.memory.add_job(self._reconstitute_job(job_state))
+				except Exception:
+					logger.exception(f"Unable to restore job {job_id}.")
+
+	# After a change of shards, keeps the jobs of homes moved elsewhere in the database only
+	def rebalance(self):
+		self.flush()
+		with self.lock:
+			for job in self.memory.get_all_jobs():
+				if not shards.owns_job(job.id):
+					self.memory.remove_job(job.id)
+		self.load()
+
+	def lookup_job(self, job_id):
+		with self.lock:
+			return self.memory.lookup_job(job_id)
+
+	# Due jobs are persisted before they run, so their executions can be logged
+	def get_due_jobs(self, now):
+		with self.lock:
+			jobs = self.memory.get_due_jobs(now)
+		if jobs:
+			self.flush()
+		return jobs
+
+	def get_next_run_time(self):
+		with self.lock:
+			return self.memory.get_next_run_time()
+
+	def get_all_jobs(self):
+		with self.lock:
+			return self.memory.get_all_jobs()
+
+	def add_job(self, job):
+		with self.lock:
+			self.memory.add_job(job)
+			self.queue(job.id, job)
+
+	def update_job(self, job):
+		with self.lock:
+			self.memory.update_job(job)
+			self.queue(job.id, job)
+
+	def remove_job(self, job_id):
+		with self.lock:
+			self.memory.remove_job(job_id)
+			self.queue(job_id, None)
+
+	# Rows of other shards are left alone
+	def remove_all_jobs(self):
+		with self.flush_lock, self.lock:
+			job_ids = [job.id for job in self.memory.get_all_jobs()] + list(self.pending)
+			self.memory.remove_all_jobs()
+			self.pending.clear()
+			DjangoJob.objects.filter(id__in=job_ids).delete()
+
+	def shutdown(self):
+		self.flush()
+		super().shutdown()
+
+	# Latest state of a job, or None once removed
+	def queue(self, job_id, job):
+		if job is None:
+			self.pending[job_id] = None
+		else:
+			self.pending[job_id] = (get_django_internal_datetime(job.next_run_time), pickle.dumps(job.__getstate__(), self.pickle_protocol))
+		if self.timer is None and self.delay is not None:
+			self.timer = threading.Timer(self.delay, self.flush_in_background)
+			self.timer.daemon = True
+			self.timer.start()
+
+	def flush(self):
+		with self.flush_lock:
+			with self.lock:
+				pending, self.pending = self.pending, {}
+				if self.timer is not None:
+					self.timer.cancel()
+					self.timer = None
+			if not pending:
+				return
+			saved = {job_id: state for job_id, state in pending.items() if state is not None}
+			try:
+				with transaction.atomic():
+					DjangoJob.objects.filter(id__in=[job_id for job_id, state in pending.items() if state is None]).delete()
+					existing = set(DjangoJob.objects.filter(id__in=list(saved)).values_list("id", flat=True))
+					jobs = [DjangoJob(id=job_id, next_run_time=state[0], job_state=state[1]) for job_id, state in saved.items()]
+					DjangoJob.objects.bulk_update([job for job in jobs if job.id in existing], ["next_run_time", "job_state"])
+					DjangoJob.objects.bulk_create([job for job in jobs if job.id not in existing])
+			except Exception:
+				with self.lock:
+					for job_id, state in pending.items():
+						self.pending.setdefault(job_id, state)
+				raise
+
+	def flush_in_background(self):
+		try:
+			self.flush()
+		except Exception:
+			logger.exception("Unable to write scheduled jobs.")
+		finally:
+			db.connection.close()
+
+# Jobs of this process only, such as metrics exports, are not persisted
 job_store = {
-	'default': DjangoJobStore()
+	'default': WriteBehindJobStore(),
+	'local': MemoryJobStore()
 }
 job_defaults = {
 	'misfire_grace_time': None
@@ -21,7 +164,8 @@ job_defaults = {
 logger.info("Creating scheduler...")
 scheduler = BackgroundScheduler()
 scheduler.configure(job_stores=job_store, job_defaults=job_defaults, timezone=settings.TIME_ZONE)
-scheduler.add_jobstore(DjangoJobStore(), "default")
+for alias, store in job_store.items():
+	scheduler.add_jobstore(store, alias)
 logger.info("Scheduler created.")
 
 @util.close_old_connections
@@ -30,13 +174,14 @@ def delete_old_job_executions(max_age=604800):
 
 def start():
 	logger.info("Starting scheduler...")
-	scheduler.add_job(
-		delete_old_job_executions,
-		trigger=CronTrigger(day_of_week="mon", hour="00", minute="00"),
-		id="delete_old_job_executions",
-		max_instances=1,
-		replace_existing=True
-	)
+	if shards.owns_job("delete_old_job_executions"):
+		scheduler.add_job(
+			delete_old_job_executions,
+			trigger=CronTrigger(day_of_week="mon", hour="00", minute="00"),
+			id="delete_old_job_executions",
+			max_instances=1,
+			replace_existing=True
+		)
 	scheduler.start()
 
 def stop():
@@ -0,0 +1,113 @@
+from datetime import timedelta
+
+from processor.intervals import IntervalTree
+from processor.segments import SegmentTree, ExtremaTree
+from processor.tools import power_to_energy
+
+MICROSECOND = timedelta(microseconds=1)
+
+'''
+BatteryLedger class
+State of charge of a home's battery, from its last full charge or a later checkpoint onwards.
+Battery executions are kept in an interval index, and the energy each one adds or removes is
+added from its end time on in a segment tree over microseconds since the last full charge, so the
+energy stored at any time is that sum plus the executions still running at that time.
+Executions already running at the checkpoint are kept with the energy they had provided by then
+subtracted from the starting energy, so results match a count from the last full charge.
+The energy at every start and end time is kept in a tree of extrema, so the lowest and highest SOC
+after a time are range queries. Adding or removing an execution updates both trees in place,
+in O(log n) plus one update per breakpoint it runs across.
+The lowest and highest SOC after a time are taken over the energy at that time and at every
+breakpoint after it, where the stored energy changes direction.
+'''
+class BatteryLedger:
+    def __init__(self, appliance_id, last_full_charge_time, total_energy_capacity, executions=(), start_time=None, energy=None):
+        self.appliance_id = appliance_id
+        self.last_full_charge_time = last_full_charge_time
+        self.total_energy_capacity = total_energy_capacity
+        self.start_time = start_time if start_time is not None else last_full_charge_time
+        self.start_energy = energy if energy is not None else total_energy_capacity
+        # start time, end time and power of each execution, as added
+        self.executions = {}
+        self.index = IntervalTree()
+        self.ended = SegmentTree()
+        self.energies = ExtremaTree()
+        # number of executions starting or ending at each breakpoint
+        self.breakpoints = {}
+        self.energy = self.start_energy
+        self.total = 0
+        for execution in executions:
+            self.add(execution)
+
+    def add(self, execution):
+        self.remove(execution.id)
+        if execution.appliance_id != self.appliance_id or execution.start_time is None or execution.end_time is None \
+            or execution.start_time < self.last_full_charge_time or execution.end_time < self.start_time:
+            return
+        start_time, end_time, power = execution.start_time, execution.end_time, execution.profile.rated_power
+        self.executions[execution.id] = (start_time, end_time, power)
+        self.index.add(execution)
+        self.change(start_time, end_time, power, 1)
+        for time in (start_time, end_time):
+            key = self.get_key(time)
+            self.breakpoints[key] = self.breakpoints.get(key, 0) + 1
+            if self.breakpoints[key] == 1:
+                self.energies.set(key, self.get_energy(time))
+
+    def remove(self, execution_id):
+        values = self.executions.pop(execution_id, None)
+        if values is None:
+            return
+        start_time, end_time, power = values
+        self.index.remove(execution_id)
+        for time in (start_time, end_time):
+            key = self.get_key(time)
+            self.breakpoints[key] -= 1
+            if not self.breakpoints[key]:
+                del self.breakpoints[key]
+                self.energies.remove(key)
+        self.change(start_time, end_time, power, -1)
+
+    # Microseconds since the last full charge
+    def get_key(self, time):
+        return (time - self.last_full_charge_time) // MICROSECOND
+
+    # Adds (sign 1) or takes back (sign -1) the energy of an execution at every breakpoint
+    def change(self, start_time, end_time, power, sign):
+        if start_time < self.start_time:
+            before = sign * power_to_energy(start_time, min(end_time, self.start_time), power)
+            self.energy -= before
+            self.energies.add(0, self.energies.size, -before)
+        energy = sign * power_to_energy(start_time, end_time, power)
+        self.total += energy
+        end = self.get_key(end_time)
+        self.ended.add(end + 1, self.ended.size, energy)
+        self.energies.add(end, self.energies.size, energy)
+        times = set()
+        for execution in self.index.search(start_time, end_time):
+            times.update(time for time in self.executions[execution.id][:2] if start_time < time < end_time)
+        for time in times:
+            key = self.get_key(time)
+            self.energies.add(key, key + 1, sign * power_to_energy(start_time, time, power))
+
+    # Energy stored at time (not before the ledger start), counting executions started before it up to that time
+    def get_energy(self, time=None):
+        if time is None:
+            return self.energy + self.total
+        key = self.get_key(time)
+        energy = self.energy + (self.ended.maximum(key, key + 1) or 0)
+        for execution in self.index.search(time, time, closed=True):
+            start_time, _, power = self.executions[execution.id]
+            if start_time < time:
+                energy += power_to_energy(start_time, time, power)
+        return energy
+
+    def get_minimum_energy_after(self, time):
+        energy = self.get_energy(time)
+        extrema = self.energies.extrema(self.get_key(time) + 1, self.energies.size)
+        return min(energy, extrema[0]) if extrema is not None else energy
+
+    def get_maximum_energy_after(self, time):
+        energy = self.get_energy(time)
+        extrema = self.energies.extrema(self.get_key(time) + 1, self.energies.size)
+        return max(energy, extrema[1]) if extrema is not None else energy
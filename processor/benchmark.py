@@ -0,0 +1,133 @@
+import json
+import math
+import time
+import platform
+import subprocess
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from coordinator.settings import INTERRUPTIBLE, NONINTERRUPTIBLE, URGENT, NORMAL, LOW_PRIORITY
+from coordinator.models import Home, Appliance, Profile, Execution, BatteryStorageSystem, PhotovoltaicSystem, ProductionData
+
+'''
+Scheduler benchmarks.
+Synthetic homes are generated with a configurable number of appliances and profiles, optional
+PV and BSS systems, and requests arriving at a given rate. Each measured call records its latency
+and the SQL queries it ran; results are summarised as percentiles and saved as JSON, together with
+the commit and parameters they were taken with, so runs on different commits can be compared.
+'''
+PERCENTILES = [50, 90, 99]
+
+def generate_home(rng, appliances=10, profiles_per_appliance=2, pv=True, bss=True, consumption_threshold=None):
+    home = Home.objects.create(consumption_threshold=consumption_threshold or rng.randrange(3000, 8001, 250), is_running=False)
+    for i in range(appliances):
+        appliance = Appliance.objects.create(home=home, name=f"Appliance {i}",
+            maximum_delay=timezone.timedelta(minutes=rng.choice([15, 60, 180, 720])))
+        profiles = []
+        for j in range(profiles_per_appliance):
+            profiles.append(Profile.objects.create(
+                name=f"Benchmark {home.id}.{i}.{j}",
+                schedulability=rng.choice([INTERRUPTIBLE, NONINTERRUPTIBLE]),
+                priority=rng.choice([URGENT, NORMAL, NORMAL, LOW_PRIORITY]),
+                maximum_duration_of_usage=timezone.timedelta(minutes=rng.randrange(15, 181, 15)),
+                rated_power=rng.randrange(100, 3001, 50)
+            ))
+        appliance.profiles.set(profiles)
+    if bss:
+        BatteryStorageSystem.objects.create(home=home, total_energy_capacity=rng.randrange(5000, 20001, 1000),
+            continuous_power=rng.randrange(2000, 6001, 500), depth_of_discharge=0.9)
+    if pv:
+        capacity = rng.randrange(1000, 8001, 500)
+        system = PhotovoltaicSystem.objects.create(home=home, latitude=38.7, longitude=-9.1, tilt=20, azimuth=180, capacity=capacity)
+        ProductionData.objects.bulk_create([ProductionData(system=system, month=month, hour=hour,
+            average_power_generated=get_synthetic_production(capacity, month, hour)) for month in range(1, 13) for hour in range(24)])
+    return home
+
+# Daylight bell curve, lower in winter
+def get_synthetic_production(capacity, month, hour):
+    season = 0.7 + 0.3 * math.cos((month - 7) * math.pi / 6)
+    return max(0, round(capacity * 0.8 * season * math.sin((hour - 6) * math.pi / 13))) if 6 <= hour <= 19 else 0
+
+# Unscheduled executions requested at random appliances and profiles, about rate per hour
+def generate_requests(rng, home, start_time, hours=24, rate=2):
+    appliances = list(Appliance.objects.filter(home=home, batterystoragesystem__isnull=True).prefetch_related('profiles'))
+    executions = []
+    request_time = start_time + timezone.timedelta(hours=rng.expovariate(rate))
+    while request_time < start_time + timezone.timedelta(hours=hours):
+        appliance = rng.choice(appliances)
+        executions.append(Execution.objects.create(home=home, appliance=appliance,
+            profile=rng.choice(list(appliance.profiles.all())), request_time=request_time.replace(microsecond=0)))
+        request_time += timezone.timedelta(hours=rng.expovariate(rate))
+    return executions
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * percentile / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class Benchmark:
+    def __init__(self, **parameters):
+        self.parameters = parameters
+        self.samples = {}
+
+    # Calls function, recording its latency and SQL query count under name
+    def measure(self, name, function, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        self.samples.setdefault(name, []).append((elapsed, len(queries)))
+        return result
+
+    def summary(self):
+        summary = {}
+        for name, samples in self.samples.items():
+            latencies = [sample[0] * 1000 for sample in samples]
+            queries = [sample[1] for sample in samples]
+            summary[name] = {
+                "count": len(samples),
+                "latency_ms": dict([(f"p{percentile}", get_percentile(latencies, percentile)) for percentile in PERCENTILES],
+                    mean=sum(latencies) / len(latencies), max=max(latencies)),
+                "queries": {"mean": sum(queries) / len(queries), "max": max(queries), "total": sum(queries)}
+            }
+        return summary
+
+    def results(self):
+        return {
+            "commit": get_commit(),
+            "time": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "parameters": self.parameters,
+            "benchmarks": self.summary()
+        }
+
+    def save(self, path):
+        results = self.results()
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+        return results
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Ratio of current to baseline median latency and mean query count, for benchmarks found in both
+def compare(baseline, current):
+    comparison = {}
+    for name, result in current["benchmarks"].items():
+        previous = baseline["benchmarks"].get(name)
+        if previous is None:
+            continue
+        comparison[name] = {
+            "latency_p50": result["latency_ms"]["p50"] / previous["latency_ms"]["p50"] if previous["latency_ms"]["p50"] else None,
+            "queries_mean": result["queries"]["mean"] / previous["queries"]["mean"] if previous["queries"]["mean"] else None
+        }
+    return comparison
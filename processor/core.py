@@ -1,65 +1,181 @@
 import os
 import django
-from math import floor
+import logging
+import re
+import threading
+from contextlib import nullcontext
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import QuerySet
 from apscheduler.triggers.cron import CronTrigger
 import processor.tools as tools
+import processor.state as state
+import processor.timers as timers
+import processor.workers as workers
+import processor.shards as shards
 import processor.background as aps
 import processor.external_energy as ext
 import processor.aggregator.client as cli
+import processor.vectorized as vectorized
+import processor.metrics as metrics
+import processor.production as production
 
 from home.settings import INF_DATE
-from coordinator.settings import INTERRUPTIBLE, LOW_PRIORITY, NORMAL, URGENT
-from coordinator.models import Home, Execution
+from processor.timeline import LoadTimeline
+from processor.priority import calculate_weighted_priority
+from coordinator.settings import INTERRUPTIBLE, LOW_PRIORITY, SCHEDULING_HORIZON, VECTORIZED_SCHEDULING, METRICS_FILE, COORDINATOR_SYNC_INTERVAL
+from coordinator.models import Home, HomeSnapshot, Execution
 
+logger = logging.getLogger(__name__)
+EXECUTION_JOB_ID = re.compile(r"^home_\d+_execution_\d+_(?:start|finish)$")
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coordinator.settings")
 # django.setup()
 
-def start_execution_job(id):
-	execution = Execution.objects.get(pk=id)
+# Calls that change a home run on its executor (processor.workers), except in debug mode and simulations
+def get_executor_home(arguments):
+	if arguments.get("debug") or arguments.get("simulation") is not None:
+		return None
+	if "execution" in arguments:
+		execution = arguments["execution"]
+		return None if tools.is_simulated(execution) else execution.home_id
+	if "home" in arguments:
+		home = arguments["home"]
+		return None if tools.is_simulated(home) else home.id
+	return arguments["id"]
+
+# Jobs of simulated records also receive their simulation, see get_job_args
+def start_execution_job(id, simulation=None):
+	execution = get_execution(id, simulation)
 	if execution.is_started is False:
 		execution.set_started()
-	print("Execution of " + execution.appliance.name + " started at " + timezone.now().strftime("%d/%m/%Y, %H:%M:%S."))
+	print("Execution of " + execution.appliance.name + " started at " + tools.current_time(execution).strftime("%d/%m/%Y, %H:%M:%S."))
 
-def finish_execution_job(id):
-	execution = Execution.objects.get(pk=id)
+def finish_execution_job(id, simulation=None):
+	execution = get_execution(id, simulation)
 	if execution.is_finished is False and execution.is_interrupted is False:
 		execution.set_finished()
 	home = execution.home
 	if home.compare_BSS_appliance(execution.appliance):
 		battery = home.batterystoragesystem
 		energy_stored = ext.get_battery_energy(home, execution.end_time)
+		ext.save_battery_checkpoint(home, execution.end_time)
 		if energy_stored >= battery.total_energy_capacity * 0.99:
 			battery.set_last_full_charge_time(execution.end_time)
 		elif energy_stored < battery.total_energy_capacity * (1.1 - battery.depth_of_discharge) and \
 			id == ext.get_last_battery_execution(home).id:
-			ext.schedule_battery_charge(home)
-	print("Execution of " + execution.appliance.name + " finished by the system at " + timezone.now().strftime("%d/%m/%Y, %H:%M:%S."))
-
-def schedule_battery_charge_job(id):
-	home = Home.objects.get(pk=id)
+			replan(home, "schedule_battery_charge", schedule_battery_charge_job, *get_job_args(home))
+	print("Execution of " + execution.appliance.name + " finished by the system at " + tools.current_time(execution).strftime("%d/%m/%Y, %H:%M:%S."))
+
+# Runs the start and finish events of a home due by now, then waits for the next one
+@workers.serial(get_executor_home, wait=False)
+def home_timer_job(id, simulation=None):
+	home = get_home(id, simulation)
+	timer = timers.get_timer(home)
+	while due := timer.pop_due(tools.current_time(home)):
+		for execution_id, kind in due:
+			try:
+				(start_execution_job if kind == timers.START else finish_execution_job)(execution_id, simulation)
+			except Exception:
+				logger.exception(f"Unable to {kind} execution {execution_id}.")
+	arm_home_timer(home, force=True)
+
+@workers.serial(get_executor_home, wait=False)
+def schedule_battery_charge_job(id, simulation=None):
+	home = get_home(id, simulation)
 	ext.schedule_battery_charge(home)
 
-def send_consumption_schedule_job(id):
-	home = Home.objects.get(pk=id)
+@workers.serial(get_executor_home, wait=False)
+def save_battery_checkpoint_job(id, simulation=None):
+	home = get_home(id, simulation)
+	ext.save_battery_checkpoint(home)
+
+@workers.serial(get_executor_home, wait=False)
+def send_consumption_schedule_job(id, simulation=None):
+	home = get_home(id, simulation)
 	send_consumption_schedule(home)
 
+def export_metrics_job():
+	metrics.save(shards.get_path(METRICS_FILE))
+
+# Reloads the homes of this shard changed by other processes (see processor.shards)
+def sync_homes_job():
+	for home_id in shards.get_changed_homes():
+		reload_home_job(home_id)
+
+@workers.serial(get_executor_home, wait=False)
+def reload_home_job(id):
+	home = get_home(id)
+	state.invalidate_home(home)
+	if hasattr(home, "photovoltaicsystem"):
+		production.invalidate(home.photovoltaicsystem.id)
+	reload_home_timer(home)
+
+def get_execution(id, simulation=None):
+	return simulation.executions[id] if simulation is not None else Execution.objects.get(pk=id)
+
+def get_home(id, simulation=None):
+	return simulation.homes[id] if simulation is not None else Home.objects.get(pk=id)
+
+# Simulated records are scheduled on the discrete-event scheduler of their simulation
+def get_scheduler(record):
+	return record.simulation.scheduler if tools.is_simulated(record) else background
+
+def get_job_args(record):
+	return [record.id, record.simulation] if tools.is_simulated(record) else [record.id]
+
+# Follow-up re-planning runs on the worker pool, coalesced by home and name, except in debug mode and simulations
+def replan(home, name, function, *args, debug=False):
+	if debug or tools.is_simulated(home):
+		function(*args)
+	else:
+		workers.submit(home.id, name, function, *args)
+
+# A single date job per home runs at the earliest event of its timer.
+# Within schedule_executions, database homes are only armed once their executions commit.
+def arm_home_timer(home, force=False):
+	deferred = getattr(local, "deferred_timers", None)
+	if deferred is not None and not tools.is_simulated(home):
+		deferred[home.id] = (home, force or deferred.get(home.id, (home, False))[1])
+		return
+	timer = timers.get_timer(home)
+	with timer.lock:
+		next_time = timer.get_next_time()
+		if next_time == timer.armed and not force:
+			return
+		timer.armed = next_time
+		scheduler = get_scheduler(home)
+		if next_time is not None:
+			scheduler.add_job(home_timer_job, 'date', get_job_args(home),
+				run_date=next_time,
+				id=f"home_{home.id}_timer",
+				max_instances=1,
+				replace_existing=True)
+		elif scheduler.get_job(f"home_{home.id}_timer") is not None:
+			scheduler.remove_job(f"home_{home.id}_timer")
+
+def add_execution_events(execution):
+	timer = timers.get_timer(execution.home)
+	if not execution.is_started:
+		timer.add(execution.id, timers.START, execution.start_time)
+	if execution.end_time is not None:
+		timer.add(execution.id, timers.FINISH, execution.end_time)
+
+# Scheduled executions not finished by request time, sorted by end time
 def get_unfinished_executions(home, request_time):
-	return Execution.objects.filter(home=home).exclude(end_time__lt=request_time).order_by('end_time')
+	unfinished = state.get_index(home, request_time).search(request_time, None, closed=True)
+	return sorted((home.attach(execution) for execution in unfinished), key=lambda e: (e.end_time, e.id))
 
 def get_pending_executions(home, request_time):
 	unfinished = get_unfinished_executions(home, request_time)
-	return unfinished.filter(start_time__gt=request_time)
+	return [execution for execution in unfinished if execution.start_time > request_time]
 
 def get_running_executions(home, request_time):
 	unfinished = get_unfinished_executions(home, request_time)
-	return unfinished.filter(start_time__lte=request_time)
+	return [execution for execution in unfinished if execution.start_time <= request_time]
 
 def get_running_executions_within(home, start_time, end_time):
-	unfinished = get_unfinished_executions(home, start_time)
-	if end_time is None:
-		return unfinished.filter(end_time__gt=start_time)
-	return unfinished.filter(start_time__lte=end_time, end_time__gt=start_time)
+	running = state.get_index(home, start_time).search(start_time, end_time)
+	return sorted((home.attach(execution) for execution in running), key=lambda e: (e.end_time, e.id))
 
 def get_lower_priority_shiftable_executions_within(home, start_time, end_time, target_priority):
 	shiftable_executions = []
@@ -74,39 +190,32 @@ def get_lower_priority_shiftable_executions_within(home, start_time, end_time, t
 	sorted_keys = sorted(shiftable_executions, key=lambda e: (calculate_weighted_priority(e, start_time)))
 	return sorted_keys
 
-def get_power_consumption(home, time, queryset=None):
-	rated_power = 0
+# Without a queryset, consumption is read from the home's in-memory load timeline
+def get_consumption_timeline(home, start_time, queryset=None):
 	if queryset is None:
-		queryset = get_running_executions_within(home, time, time)
-	else:
-		queryset = queryset.filter(start_time__lte=time, end_time__gt=time)
-	for execution in queryset:
-		rated_power += execution.profile.rated_power
-	return rated_power
+		return state.get_timeline(home, start_time)
+	if isinstance(queryset, QuerySet):
+		queryset = queryset.select_related('profile')
+	return LoadTimeline(queryset)
+
+def get_power_consumption(home, time, queryset=None):
+	return get_consumption_timeline(home, time, queryset).get_power_at(time)
 
 def get_maximum_consumption_within(home, start_time, end_time, queryset=None):
-	peak_consumption = 0
-	if queryset is None:
-		queryset = get_running_executions_within(home, start_time, end_time)
-	reference_times = get_consumption_reference_times_within(home, start_time, end_time, queryset)
-	for time in reference_times:
-		power_consumption = get_power_consumption(home, time, queryset)
-		if power_consumption > peak_consumption:
-			peak_consumption = power_consumption
-	return peak_consumption
+	return get_consumption_timeline(home, start_time, queryset).get_maximum_within(start_time, end_time)
 
 def get_minimum_consumption_within(home, start_time, end_time, queryset=None):
-	min_consumption = None
-	if queryset is None:
-		queryset = get_running_executions_within(home, start_time, end_time)
-	reference_times = get_consumption_reference_times_within(home, start_time, end_time, queryset)
-	for time in reference_times:
-		power_consumption = get_power_consumption(home, time, queryset)
-		if min_consumption is None or power_consumption < min_consumption:
-			min_consumption = power_consumption
-	if min_consumption is None or min_consumption < 0:
-		min_consumption = 0
-	return min_consumption
+	return get_consumption_timeline(home, start_time, queryset).get_minimum_within(start_time, end_time)
+
+def get_maximum_consumption_for_duration(home, start_times, duration):
+	if not start_times:
+		return []
+	return state.get_timeline(home, start_times[0]).get_maximum_within_windows(start_times, duration)
+
+def calculate_execution_duration(execution):
+	if execution.profile.maximum_duration_of_usage is None:
+		return None
+	return execution.profile.maximum_duration_of_usage - execution.previous_progress_time
 
 def calculate_execution_end_time(execution, start_time, duration=None):
 	if execution.profile.maximum_duration_of_usage is None and duration is None:
@@ -139,25 +248,56 @@ def choose_execution_time(execution, available_periods):
 			chosen_time = start_time
 	return chosen_time
 
+# Strategies: 0 - available power, 1 - with BSS discharge, 2 - with BSS discharge and shiftable executions
+STRATEGIES = [(False, False), (True, False), (True, True)]
+
 def get_available_execution_times(execution, minimum_start_time=None, include_bss=False, include_shiftable=False):
+	return evaluate_execution_times(execution, minimum_start_time, [(include_bss, include_shiftable)])[0]
+
+def get_available_execution_times_by_strategy(execution, minimum_start_time=None):
+	return evaluate_execution_times(execution, minimum_start_time, STRATEGIES)
+
+# Single scan over candidate start times, returning one period map per (include_bss, include_shiftable) strategy.
+# Battery and shiftable headroom are computed once per candidate and shared between strategies.
+def evaluate_execution_times(execution, minimum_start_time, strategies):
 	if minimum_start_time is None:
-		minimum_start_time = timezone.now()
-	timeout = minimum_start_time + timezone.timedelta(days=2)
+		minimum_start_time = tools.current_time(execution)
+	timeout = minimum_start_time + SCHEDULING_HORIZON
 	home = execution.home
-	available_periods = {}
+	rated_power = execution.profile.rated_power
+	duration = calculate_execution_duration(execution)
+	include_bss = any(strategy[0] for strategy in strategies)
+	include_shiftable = any(strategy[1] for strategy in strategies)
+	available_periods = [{} for _ in strategies]
 	reference_times = get_consumption_reference_times_within(home, minimum_start_time, timeout)
-	for proposed_start_time in reference_times:
+	metrics.observe("schedule_candidate_periods", len(reference_times), metrics.COUNT_BUCKETS)
+	power_thresholds = None
+	if VECTORIZED_SCHEDULING and vectorized.available:
+		arrays = vectorized.get_window_arrays(home, reference_times, duration)
+		peak_consumptions = arrays.get_peak_consumptions().tolist()
+		power_thresholds = arrays.get_minimum_thresholds().tolist()
+	else:
+		peak_consumptions = get_maximum_consumption_for_duration(home, reference_times, duration)
+	for i, proposed_start_time in enumerate(reference_times):
 		proposed_end_time = calculate_execution_end_time(execution, proposed_start_time)
-		power_consumption = get_maximum_consumption_within(home, proposed_start_time, proposed_end_time)
-		power_available = ext.get_power_threshold_within(home, proposed_start_time, proposed_end_time) - power_consumption
+		if power_thresholds is None:
+			power_available = ext.get_power_threshold_within(home, proposed_start_time, proposed_end_time) - peak_consumptions[i]
+		else:
+			power_available = power_thresholds[i] - peak_consumptions[i]
+		battery_power_available = shiftable_power_available = 0
 		if include_bss:
 			battery_power_available = ext.get_battery_discharge_available(home, proposed_start_time, proposed_end_time)
-			power_available += battery_power_available
 		if include_shiftable:
 			priority = calculate_weighted_priority(execution, proposed_start_time)
-			power_available += get_shiftable_executions_power(home, proposed_start_time, proposed_end_time, priority)
-		if power_available >= execution.profile.rated_power:
-			available_periods[(proposed_start_time, proposed_end_time)] = power_available
+			shiftable_power_available = get_shiftable_executions_power(home, proposed_start_time, proposed_end_time, priority)
+		for periods, (with_bss, with_shiftable) in zip(available_periods, strategies):
+			strategy_power_available = power_available
+			if with_bss:
+				strategy_power_available += battery_power_available
+			if with_shiftable:
+				strategy_power_available += shiftable_power_available
+			if strategy_power_available >= rated_power:
+				periods[(proposed_start_time, proposed_end_time)] = strategy_power_available
 	return available_periods
 
 # Slight hack: returned list includes hourly references for at most two days
@@ -184,60 +324,47 @@ def get_consumption_reference_times_within(home, start_time, end_time, queryset=
 
 def start_execution(execution, start_time, debug=False):
 	if debug:
-		execution.start() if tools.is_now(start_time) else execution.set_start_time(start_time)
+		execution.start() if tools.is_now(start_time, execution) else execution.set_start_time(start_time)
 	else:
 		if execution.start_time is None:
 			execution.set_start_time(start_time)
-		background.add_job(start_execution_job, 'date', [execution.id],
-			run_date=execution.start_time,
-			id=f"home_{execution.home.id}_execution_{execution.id}_start",
-			max_instances=1,
-			replace_existing=True)
-		if execution.end_time is not None:
-			background.add_job(finish_execution_job, 'date', [execution.id],
-				id=f"home_{execution.home.id}_execution_{execution.id}_finish",
-				run_date=execution.end_time,
-				max_instances=1,
-				replace_existing=True)
+		add_execution_events(execution)
+		arm_home_timer(execution.home)
 	print("Execution of " + execution.appliance.name + " scheduled to start at " + execution.start_time.strftime("%d/%m/%Y, %H:%M:%S."))
 
+@workers.serial(get_executor_home)
 def interrupt_execution(execution, end_time=None, debug=False):
 	home = execution.home
 	if debug:
-		execution.interrupt() if end_time is None or tools.is_now(end_time) else execution.set_end_time(end_time)
+		execution.interrupt() if end_time is None or tools.is_now(end_time, execution) else execution.set_end_time(end_time)
 	else:
+		timer = timers.get_timer(home)
 		if end_time is None:
 			execution.interrupt()
-			if background.get_job(f"home_{execution.home.id}_execution_{execution.id}_finish") is not None:
-				background.remove_job(f"home_{execution.home.id}_execution_{execution.id}_finish")
+			timer.remove(execution.id, timers.FINISH)
 		else:
 			execution.set_end_time(end_time)
-			background.add_job(finish_execution_job, 'date', [execution.id],
-				id=f"home_{home.id}_execution_{execution.id}_finish",
-				run_date=execution.end_time,
-				max_instances=1,
-				replace_existing=True)	
+			timer.add(execution.id, timers.FINISH, execution.end_time)
+		arm_home_timer(home)
 	print("Execution of " + execution.appliance.name + " interrupted at " + execution.end_time.strftime("%d/%m/%Y, %H:%M:%S."))
 
+@workers.serial(get_executor_home)
 def finish_execution(execution, end_time=None, debug=False):
 	home = execution.home
 	if debug:
-		execution.finish() if end_time is None or tools.is_now(end_time) else execution.set_end_time(end_time)
+		execution.finish() if end_time is None or tools.is_now(end_time, execution) else execution.set_end_time(end_time)
 	else:
+		timer = timers.get_timer(home)
 		if end_time is None:
 			execution.finish()
-			if background.get_job(f"home_{home.id}_execution_{execution.id}_finish") is not None:
-				background.remove_job(f"home_{home.id}_execution_{execution.id}_finish")
+			timer.remove(execution.id, timers.FINISH)
 		else:
 			if end_time < execution.end_time:
 				execution.set_end_time(end_time)
-				background.add_job(finish_execution_job, 'date', [execution.id],
-					id=f"home_{home.id}_execution_{execution.id}_finish",
-					run_date=execution.end_time,
-					max_instances=1,
-					replace_existing=True)
+				timer.add(execution.id, timers.FINISH, execution.end_time)
+		arm_home_timer(home)
 	print("Execution of " + execution.appliance.name + " finished at " + execution.end_time.strftime("%d/%m/%Y, %H:%M:%S."))
-	anticipate_pending_executions(home, execution.end_time, debug)
+	replan(home, "anticipate_pending_executions", anticipate_pending_executions, home, execution.end_time, debug, debug=debug)
 
 def propose_schedule_execution(execution, request_time):
 	priority = execution.profile.priority
@@ -245,15 +372,9 @@ def propose_schedule_execution(execution, request_time):
 
 	# for low priority device, any time is fine
 	# for normal or immediate device, attempt to schedule immediately
+	strategy_periods = get_available_execution_times_by_strategy(execution, request_time)
 	for i in range(0, len(start_times)):
-		match i:
-			case 0:
-				available_periods = get_available_execution_times(execution, request_time, False, False)
-			case 1:
-				available_periods = get_available_execution_times(execution, request_time, True, False)
-			case 2:
-				available_periods = get_available_execution_times(execution, request_time, True, True)
-		start_times[i] = choose_execution_time(execution, available_periods)
+		start_times[i] = choose_execution_time(execution, strategy_periods[i])
 
 	if priority is LOW_PRIORITY:
 		chosen_time = next((time for time in start_times if time is not None), None)
@@ -263,11 +384,57 @@ def propose_schedule_execution(execution, request_time):
 	chosen_strategy = start_times.index(chosen_time) if chosen_time is not None else -1
 	return chosen_strategy, chosen_time
 
+@workers.serial(get_executor_home)
 def schedule_execution(execution, request_time=None, debug=False):
 	if request_time is None:
-		request_time = timezone.now()
+		request_time = tools.current_time(execution)
+	with metrics.measure("schedule_execution"):
+		home = execution.home if tools.is_simulated(execution) else get_home_snapshot(execution.home_id, request_time)
+		chosen_strategy = place_execution(home.attach(execution), request_time, debug)
+		send_consumption_schedule(home, request_time)
+	return chosen_strategy
+
+# Schedule several executions of a home at once, highest weighted priority first,
+# committing them together and sending the aggregator a single update
+@workers.serial(get_executor_home)
+def schedule_executions(home, executions, request_time=None, debug=False):
+	if request_time is None:
+		request_time = tools.current_time(home)
+	for execution in executions:
+		if execution.home_id != home.id:
+			raise ValueError(f"Execution {execution.id} belongs to home {execution.home_id}, not to home {home.id}.")
+	home = load_home(home, request_time)
+	executions = [home.attach(execution) for execution in executions]
+	times = {execution.id: get_execution_request_time(execution, request_time) for execution in executions}
+	ordered = sorted(executions, key=lambda e: calculate_weighted_priority(e, times[e.id]), reverse=True)
+	strategies = {}
+	local.deferred_timers = {}
+	try:
+		with nullcontext() if tools.is_simulated(home) else transaction.atomic():
+			for execution in ordered:
+				strategies[execution.id] = place_execution(execution, times[execution.id], debug)
+	except Exception:
+		state.invalidate(home.id)
+		if not tools.is_simulated(home):
+			reload_home_timer(home)
+		raise
+	finally:
+		deferred, local.deferred_timers = local.deferred_timers, None
+	for timer_home, force in deferred.values():
+		transaction.on_commit(lambda timer_home=timer_home, force=force: arm_home_timer(timer_home, force))
+	send_consumption_schedule(home, request_time)
+	return [strategies[execution.id] for execution in executions]
+
+# Each execution of a batch is placed from its own request time, or from the batch's when that is later
+def get_execution_request_time(execution, request_time):
+	if execution.request_time is None:
+		return request_time
+	return max(execution.request_time, request_time)
+
+def place_execution(execution, request_time, debug=False):
 	home = execution.home
 	chosen_strategy, chosen_time = propose_schedule_execution(execution, request_time)
+	metrics.increment("schedule_strategy_total", strategy=chosen_strategy)
 	match chosen_strategy:
 		case 0:
 			print(f'[1] Enough available power found.')
@@ -287,12 +454,11 @@ def schedule_execution(execution, request_time=None, debug=False):
 			print(f'[{chosen_strategy}] Unable to schedule appliance. Consider raising power threshold or increasing maximum delay.')
 	if chosen_time is not None:
 		check_high_consumption(home, request_time, debug)
-	send_consumption_schedule(home, request_time)
 	return chosen_strategy
 		
 def shift_executions(execution, start_time, request_time=None, debug=False):
 	if request_time is None:
-		request_time = timezone.now()
+		request_time = tools.current_time(execution)
 	home = execution.home
 	priority = calculate_weighted_priority(execution, request_time)
 	rated_power = execution.profile.rated_power
@@ -303,13 +469,13 @@ def shift_executions(execution, start_time, request_time=None, debug=False):
 	for execution in interrupted:
 		#TODO: if it's battery, schedule with lower wattage
 		if not home.compare_BSS_appliance(execution.appliance):
-			new = Execution.objects.create(
+			new = create_execution(
 				home=home,
 				appliance=execution.appliance,
 				profile=execution.profile,
 				previous_progress_time=execution.end_time-execution.start_time+execution.previous_progress_time,
 				previous_waiting_time=execution.start_time-execution.request_time+execution.previous_waiting_time)
-			schedule_execution(new, request_time, debug)
+			place_execution(new, request_time, debug)
 
 def interrupt_shiftable_executions(home, start_time, end_time, rated_power, priority, debug):
 	shiftable_executions = get_lower_priority_shiftable_executions_within(home, start_time, end_time, priority)
@@ -317,7 +483,7 @@ def interrupt_shiftable_executions(home, start_time, end_time, rated_power, prio
 	interrupted = []
 	for execution in shiftable_executions:
 		interrupt_execution(execution, start_time, debug)
-		running_executions = running_executions.exclude(id=execution.id)
+		running_executions = [e for e in running_executions if e.id != execution.id]
 		minimum_power_available = ext.get_power_threshold_within(home, start_time, end_time) - \
 			get_maximum_consumption_within(home, start_time, end_time, running_executions)
 		interrupted.append(execution)
@@ -327,8 +493,7 @@ def interrupt_shiftable_executions(home, start_time, end_time, rated_power, prio
 	return interrupted
 
 def get_shiftable_executions_power(home, start_time, end_time, priority):
-	shiftable_executions_list = get_lower_priority_shiftable_executions_within(home, start_time, end_time, priority)
-	shiftable_executions = Execution.objects.filter(id__in=[e.id for e in shiftable_executions_list])
+	shiftable_executions = get_lower_priority_shiftable_executions_within(home, start_time, end_time, priority)
 	maximum_shiftable_power = get_maximum_consumption_within(home, start_time, end_time, shiftable_executions)
 	return maximum_shiftable_power
 
@@ -343,37 +508,56 @@ def check_high_consumption(home, start_time, debug=False):
 					interrupt_execution(execution, period[0], debug)
 		ext.schedule_battery_discharge_on_high_demand(home, start_time, debug)
 
-def calculate_weighted_priority(execution, current_time):
-	maximum_delay = execution.appliance.maximum_delay
-	start_time = execution.start_time if execution.start_time is not None else current_time
-	waiting_time = start_time - execution.request_time + execution.previous_waiting_time
-
-	if execution.profile.priority is URGENT:
-		base_priority = 7
-	elif execution.profile.priority is NORMAL: 
-		base_priority = 3
-	elif execution.profile.priority is LOW_PRIORITY:
-		base_priority = 1
-
-	if maximum_delay is not None:
-		multiplier = 8 # steepness of curve: 6, 8, 10 are viable
-		time_until_deadline = maximum_delay - waiting_time
-		minutes_until_deadline = time_until_deadline.seconds/60 if maximum_delay > waiting_time else 0
-		priority = base_priority + floor(60*multiplier/(minutes_until_deadline+60))
-	else:
-		priority = base_priority
-	return priority if priority < 10 else 10
-
+def get_pending_executions_by_priority(home, current_time):
+	return [home.attach(execution) for execution in state.get_pending_executions(home, current_time)]
+
+# Upper bound of the power any strategy could free for an execution starting within [start_time, end_time]
+def get_anticipation_power_bound(home, start_time, end_time):
+	production = 0
+	if hasattr(home, "photovoltaicsystem"):
+		time = start_time
+		while time <= end_time:
+			production = max(production, ext.get_power_production(home, time))
+			time += timezone.timedelta(hours=1)
+		production = max(production, ext.get_power_production(home, end_time))
+	battery_power = home.batterystoragesystem.continuous_power if hasattr(home, "batterystoragesystem") else 0
+	interruptible = [execution for execution in get_unfinished_executions(home, start_time)
+		if execution.profile.schedulability is INTERRUPTIBLE and execution.profile.rated_power > 0]
+	shiftable_power = get_maximum_consumption_within(home, start_time, INF_DATE, interruptible)
+	return home.consumption_threshold + production + battery_power + shiftable_power - \
+		get_minimum_consumption_within(home, start_time, end_time)
+
+@workers.serial(get_executor_home)
 def anticipate_pending_executions(home, current_time, debug=False):
-	pending_executions = sorted(list(get_pending_executions(home, current_time)), key=lambda e: calculate_weighted_priority(e, current_time), reverse=True)
+	home = load_home(home, current_time)
+	pending_executions = get_pending_executions_by_priority(home, current_time)
+	if not pending_executions or get_anticipation_power_bound(home, current_time, max(e.start_time for e in pending_executions)) < \
+		min(e.profile.rated_power for e in pending_executions):
+		return
 	for execution in pending_executions:
+		if get_anticipation_power_bound(home, current_time, execution.start_time) < execution.profile.rated_power:
+			continue
 		print(f"Attempting to anticipate execution {execution.id}.")
 		_, chosen_time = propose_schedule_execution(execution, current_time)
-		if chosen_time < execution.start_time:
+		if chosen_time is not None and chosen_time < execution.start_time:
 			schedule_execution(execution, current_time, debug)
 		else:
 			print("Unable to anticipate execution.")
 
+def get_home_snapshot(home_id, time=None):
+	home = HomeSnapshot.load(home_id)
+	state.get_state(home, time if time is not None else timezone.now())
+	return home
+
+# Simulated homes already hold everything in memory
+def load_home(home, time=None):
+	return home if tools.is_simulated(home) else get_home_snapshot(home.id, time)
+
+def create_execution(home, **fields):
+	if tools.is_simulated(home):
+		return home.simulation.create_execution(home=home, **fields)
+	return Execution.objects.create(home=home, **fields)
+
 def start_aggregator_client(home, accept_recommendations=True):
 	home.set_outside_id(home.id) # hack: home_id == outside_id only when simulating locally
 	home.set_accept_recommendations(accept_recommendations)
@@ -390,31 +574,101 @@ def send_consumption_schedule(home, request_time=None):
 	if cli.started and home.outside_id is not None:
 		cli.send_update_schedule(home, request_time)
 
+@workers.serial(get_executor_home)
 def change_threshold(home, threshold):
 	home.set_consumption_threshold(threshold)
-	now = timezone.now()
+	now = tools.current_time(home)
 	anticipate_pending_executions(home, now)
 
+# Starts the homes of the shard of this process, all of them unless sharded (see processor.shards)
 def start():
 	aps.start()
+	shards.started = True
+	remove_execution_jobs()
 	for home in Home.objects.all():
-		if hasattr(home, "batterystoragesystem"):
-			background.add_job(
-				schedule_battery_charge_job,
-				args=[home.id],
-				trigger=CronTrigger(hour=2),
-				id=f"schedule_battery_charge_{home.id}",
-				replace_existing=True
-			)
-		if cli.started and home.outside_id is not None:
-			background.add_job(
-				send_consumption_schedule_job,
-				args=[home.id],
-				trigger=CronTrigger(hour="*/4"),
-				id=f"send_consumption_schedule_{home.id}",
-				replace_existing=True
-			)
-		home.set_running(True)
+		if shards.owns(home.id):
+			start_home(home)
+	background.add_job(
+		sync_homes_job,
+		trigger="interval",
+		seconds=COORDINATOR_SYNC_INTERVAL,
+		id="sync_homes",
+		jobstore="local",
+		replace_existing=True
+	)
+	if metrics.enabled and METRICS_FILE is not None:
+		background.add_job(
+			export_metrics_job,
+			trigger=CronTrigger(minute="*"),
+			id="export_metrics",
+			jobstore="local",
+			replace_existing=True
+		)
 	print("Start process complete.")
 
-background = aps.scheduler
\ No newline at end of file
+# Moves this process to another shard or number of shards. Homes it loses keep their jobs in the
+# database for their new owner; homes it gains are started from theirs.
+def rebalance(shard, count):
+	owned = [home.id for home in Home.objects.all() if shards.owns(home.id)]
+	shards.configure(shard, count)
+	aps.job_store['default'].rebalance()
+	remove_execution_jobs()
+	for home in Home.objects.all():
+		if not shards.owns(home.id):
+			timers.clear(home.id)
+			state.invalidate(home.id)
+		elif home.id not in owned:
+			start_home(home)
+	background.wakeup()
+	print(f"Rebalanced to shard {shard} of {count}.")
+
+def start_home(home):
+	scheduler = get_scheduler(home)
+	if hasattr(home, "batterystoragesystem"):
+		scheduler.add_job(
+			schedule_battery_charge_job,
+			args=get_job_args(home),
+			trigger=CronTrigger(hour=2),
+			id=f"schedule_battery_charge_{home.id}",
+			replace_existing=True
+		)
+		scheduler.add_job(
+			save_battery_checkpoint_job,
+			args=get_job_args(home),
+			trigger=CronTrigger(minute=0),
+			id=f"save_battery_checkpoint_{home.id}",
+			replace_existing=True
+		)
+	if cli.started and home.outside_id is not None:
+		scheduler.add_job(
+			send_consumption_schedule_job,
+			args=get_job_args(home),
+			trigger=CronTrigger(hour="*/4"),
+			id=f"send_consumption_schedule_{home.id}",
+			replace_existing=True
+		)
+	if not tools.is_simulated(home):
+		load_home_timer(home)
+	arm_home_timer(home, force=True)
+	home.set_running(True)
+
+# Per-execution start and finish jobs of earlier versions are replaced by the home timers,
+# found in a single pass over the jobs of this shard
+def remove_execution_jobs():
+	for job in background.get_jobs():
+		if EXECUTION_JOB_ID.match(job.id):
+			background.remove_job(job.id)
+
+# Rebuilds the timer of a home from the database
+# Timer events added by a rolled back transaction are dropped by reading the timer again
+def reload_home_timer(home):
+	timers.clear(home.id)
+	load_home_timer(home)
+	arm_home_timer(home, force=True)
+
+def load_home_timer(home):
+	for execution in Execution.objects.filter(home_id=home.id, start_time__isnull=False, is_finished=False, is_interrupted=False).select_related("home"):
+		add_execution_events(execution)
+
+background = aps.scheduler
+local = threading.local()
\ No newline at end of file
@@ -0,0 +1,85 @@
+import heapq
+
+from apscheduler.jobstores.base import JobLookupError
+
+'''
+Discrete-event stand-in for the APScheduler background scheduler.
+Jobs are added, looked up and removed with the same calls processor.core makes on APScheduler,
+and kept in a heap by run date. Running the scheduler moves a virtual clock from one run date
+to the next and calls each job there, so hours of household operation replay without waiting.
+Jobs whose run date has already passed run at the current time, as with no misfire grace time.
+'''
+class VirtualClock:
+    def __init__(self, time):
+        self.time = time
+
+    def now(self):
+        return self.time
+
+    def advance(self, time):
+        if time > self.time:
+            self.time = time
+
+class EventJob:
+    def __init__(self, id, func, args, trigger, next_run_time):
+        self.id = id
+        self.func = func
+        self.args = args
+        self.trigger = trigger
+        self.next_run_time = next_run_time
+
+class EventScheduler:
+    def __init__(self, clock):
+        self.clock = clock
+        self.jobs = {}
+        self.queue = []
+        self.sequence = 0
+
+    # Date jobs run once at run_date, other triggers (e.g. CronTrigger) at each fire time
+    def add_job(self, func, trigger=None, args=None, id=None, run_date=None, replace_existing=False, **kwargs):
+        if id is None:
+            id = f"job_{self.sequence + 1}"
+        if id in self.jobs and not replace_existing:
+            raise ValueError(f"Job {id} already exists.")
+        if trigger is None or trigger == 'date':
+            trigger, next_run_time = None, run_date if run_date is not None else self.clock.now()
+        else:
+            next_run_time = trigger.get_next_fire_time(None, self.clock.now())
+        job = EventJob(id, func, list(args or []), trigger, next_run_time)
+        self.jobs[id] = job
+        self.push(job)
+        return job
+
+    def get_job(self, id):
+        return self.jobs.get(id)
+
+    def get_jobs(self):
+        return list(self.jobs.values())
+
+    def remove_job(self, id):
+        if self.jobs.pop(id, None) is None:
+            raise JobLookupError(id)
+
+    # Replaced and removed jobs stay in the heap and are skipped when popped
+    def push(self, job):
+        if job.next_run_time is not None:
+            self.sequence += 1
+            heapq.heappush(self.queue, (job.next_run_time, self.sequence, job))
+
+    # Runs every job due by end_time in run date order, leaving the clock at end_time
+    def run_until(self, end_time):
+        count = 0
+        while self.queue and self.queue[0][0] <= end_time:
+            run_time, _, job = heapq.heappop(self.queue)
+            if self.jobs.get(job.id) is not job or job.next_run_time != run_time:
+                continue
+            self.clock.advance(run_time)
+            if job.trigger is None:
+                del self.jobs[job.id]
+            else:
+                job.next_run_time = job.trigger.get_next_fire_time(run_time, self.clock.now())
+                self.push(job)
+            job.func(*job.args)
+            count += 1
+        self.clock.advance(end_time)
+        return count
@@ -2,12 +2,14 @@ import os
 
 from home.settings import INF_DATE
 import processor.core as core
-from coordinator.models import Home, Execution, NoBSSystemException, NoPVSystemException, ProductionData
+import processor.state as state
+import processor.production as production
+from coordinator.models import Home, Execution, BatteryCheckpoint, NoBSSystemException, NoPVSystemException
 from django.utils import timezone
 from math import floor
 
-from coordinator.settings import INTERRUPTIBLE, LOW_PRIORITY, NONINTERRUPTIBLE
-from processor.tools import compact_periods, power_to_energy, energy_to_power
+from coordinator.settings import INTERRUPTIBLE, LOW_PRIORITY, NONINTERRUPTIBLE, SCHEDULING_HORIZON
+from processor.tools import compact_periods, current_time, is_simulated, power_to_energy, energy_to_power
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "coordinator.settings")
 # django.setup()
@@ -29,23 +31,15 @@ def get_day_reference_times(home, current_time):
 def get_power_production(home, time):
     power = 0
     if hasattr(home, "photovoltaicsystem"):
-        pv = home.photovoltaicsystem
-        queryset = ProductionData.objects.filter(system=pv, month=time.month, hour=time.hour)
-        for production in queryset:
-            power += production.average_power_generated
+        power = production.get_table(home.photovoltaicsystem).get_power(time)
     return power
 
 def get_minimum_production_within(home, start_time, end_time):
     minimum_production = None
     if hasattr(home, "photovoltaicsystem"):
-        time = start_time
         if end_time > start_time + timezone.timedelta(days=2):
             end_time = start_time + timezone.timedelta(days=2)
-        while time < end_time:
-            power_production = get_power_production(home, time)
-            if minimum_production is None or power_production < minimum_production:
-                minimum_production = power_production
-            time += timezone.timedelta(hours=1)
+        minimum_production = production.get_table(home.photovoltaicsystem).get_minimum_within(start_time, end_time)
     if minimum_production is None:
         minimum_production = 0
     return minimum_production
@@ -53,8 +47,9 @@ def get_minimum_production_within(home, start_time, end_time):
 """ Consumption-related methods """
 def get_high_consumption_periods(home, start_time):
     day_periods = {}
-    if core.get_unfinished_executions(home, start_time) is not None:
-        end_time = core.get_unfinished_executions(home, start_time).last().end_time
+    unfinished_executions = core.get_unfinished_executions(home, start_time)
+    if unfinished_executions:
+        end_time = unfinished_executions[-1].end_time
         reference_times = core.get_consumption_reference_times_within(home, start_time, end_time)
         prev_time = None
         for time in reference_times:
@@ -116,19 +111,19 @@ def get_battery_discharge_available_on_high_demand_periods(home, start_time, end
     return periods
 
 """ Battery-related methods """
+# Battery executions overlapping the period, in creation order
 def get_battery_executions_within(home, start_time, end_time):
     if not hasattr(home, "batterystoragesystem"):
-        return Execution.objects.none()
+        return []
     battery = home.batterystoragesystem
-    if end_time is None:
-        return Execution.objects.filter(appliance=battery.appliance, end_time__gt=start_time)
-    return Execution.objects.filter(appliance=battery.appliance, start_time__lte=end_time, end_time__gt=start_time)
+    executions = state.get_index(home, start_time).search(start_time, end_time)
+    return sorted((home.attach(e) for e in executions if e.appliance_id == battery.appliance_id), key=lambda e: e.id)
 
 def get_battery_charge_within(home, start_time, end_time):
-    return get_battery_executions_within(home, start_time, end_time).filter(profile__rated_power__gt=0)
+    return [e for e in get_battery_executions_within(home, start_time, end_time) if e.profile.rated_power > 0]
 
 def get_battery_discharge_within(home, start_time, end_time):
-    return get_battery_executions_within(home, start_time, end_time).filter(profile__rated_power__lt=0)
+    return [e for e in get_battery_executions_within(home, start_time, end_time) if e.profile.rated_power < 0]
 
 def get_battery_discharge_reference_times_within(home, start_time, end_time):
     time_list = [start_time, end_time]
@@ -145,34 +140,46 @@ def get_last_battery_execution(home):
     if not hasattr(home, "batterystoragesystem"):
         return Execution.objects.none()
     battery = home.batterystoragesystem
+    if is_simulated(home):
+        return home.simulation.get_last_execution(battery.appliance)
     return Execution.objects.filter(appliance=battery.appliance).order_by('end_time').last()
 
 def get_last_battery_charge(home):
     if not hasattr(home, "batterystoragesystem"):
         return Execution.objects.none()
     battery = home.batterystoragesystem
+    if is_simulated(home):
+        return home.simulation.get_last_execution(battery.appliance, lambda e: e.profile.rated_power > 0)
     return Execution.objects.filter(appliance=battery.appliance, profile__rated_power__gt=0).order_by('end_time').last()
 
 def get_last_battery_discharge(home):
     if not hasattr(home, "batterystoragesystem"):
         return Execution.objects.none()
     battery = home.batterystoragesystem
+    if is_simulated(home):
+        return home.simulation.get_last_execution(battery.appliance, lambda e: e.profile.rated_power < 0)
     return Execution.objects.filter(appliance=battery.appliance, profile__rated_power__lt=0).order_by('end_time').last()
 
 def get_battery_energy(home, time=None):
     if not hasattr(home, "batterystoragesystem"):
         return 0
-    battery = home.batterystoragesystem
-    queryset = Execution.objects.filter(appliance=battery.appliance, start_time__gte=battery.last_full_charge_time)
-    if time is not None:
-        queryset = queryset.exclude(start_time__gte=time)
-    energy = battery.total_energy_capacity
-    for execution in queryset:
-        power = execution.profile.rated_power        
-        energy += power_to_energy(execution.start_time,
-            execution.end_time if time is None or execution.end_time < time else time,
-            power)
-    return energy
+    return state.get_battery_ledger(home, time).get_energy(time)
+
+def save_battery_checkpoint(home, time=None):
+    if time is None:
+        time = current_time(home)
+    if not hasattr(home, "batterystoragesystem"):
+        raise NoBSSystemException()
+    if is_simulated(home):
+        return home.simulation.save_checkpoint(home.batterystoragesystem, time, get_battery_energy(home, time))
+    checkpoint, _ = BatteryCheckpoint.objects.update_or_create(
+        battery=home.batterystoragesystem,
+        time=time,
+        defaults={"energy": get_battery_energy(home, time)}
+    )
+    # Battery reads stay within a scheduling horizon, older ones falling back to the last full charge
+    BatteryCheckpoint.objects.filter(battery=home.batterystoragesystem, time__lt=time - SCHEDULING_HORIZON).delete()
+    return checkpoint
 
 def get_allocable_battery_energy_charge(home, day_periods):
     if not hasattr(home, "batterystoragesystem"):
@@ -191,13 +198,7 @@ def get_maximum_possible_battery_energy_charge(home, start_time):
         return 0
     battery = home.batterystoragesystem
     maximum_energy = battery.total_energy_capacity
-    maximum_energy_available = energy_available = get_battery_energy(home, start_time)
-    queryset = get_battery_executions_within(home, start_time, None)
-    for battery_execution in queryset:
-        start_time_after_measurement = battery_execution.start_time if battery_execution.start_time > start_time else start_time
-        energy_available += power_to_energy(start_time_after_measurement, battery_execution.end_time, battery_execution.profile.rated_power)
-        if energy_available > maximum_energy_available:
-            maximum_energy_available = energy_available
+    maximum_energy_available = state.get_battery_ledger(home, start_time).get_maximum_energy_after(start_time)
     return maximum_energy - maximum_energy_available
 
 def get_battery_power_charge(home, time):
@@ -229,13 +230,7 @@ def get_maximum_possible_battery_energy_discharge(home, start_time):
         return 0
     battery = home.batterystoragesystem
     minimum_energy = floor(battery.total_energy_capacity * (1 - battery.depth_of_discharge))
-    minimum_energy_available = energy_available = get_battery_energy(home, start_time)
-    queryset = get_battery_executions_within(home, start_time, None)
-    for battery_execution in queryset:
-        start_time_after_measurement = battery_execution.start_time if battery_execution.start_time > start_time else start_time
-        energy_available += power_to_energy(start_time_after_measurement, battery_execution.end_time, battery_execution.profile.rated_power)
-        if energy_available < minimum_energy_available:
-            minimum_energy_available = energy_available
+    minimum_energy_available = state.get_battery_ledger(home, start_time).get_minimum_energy_after(start_time)
     return minimum_energy_available - minimum_energy
     
 # Available if:
@@ -278,7 +273,7 @@ def create_battery_execution(home, start_time, end_time, power):
             "hidden": True
         }
     )
-    return Execution.objects.create(
+    return core.create_execution(
         home=home,
         request_time=start_time,
         appliance=battery.appliance,
@@ -308,6 +303,8 @@ def schedule_battery_discharge_on_consumption_above_threshold(home, start_time,
     # battery_power_needed = min(get_battery_discharge_available(period[0], period[1]), power_needed)
     available_periods = get_battery_discharge_available_on_high_demand_periods(home, start_time, end_time, rated_power)
     for period in available_periods:
+        if available_periods[period] <= 0:
+            continue
         execution = create_battery_execution(home, period[0], period[1], -available_periods[period])
         core.start_execution(execution, period[0], debug)
 
@@ -350,7 +347,7 @@ def schedule_battery_charge_on_low_demand(home, start_time, energy_needed, debug
 # If not, it will charge as much as future executions allow without going over total capacity
 def schedule_battery_charge(home, start_time=None, debug=False):
     if start_time is None:
-        start_time = timezone.now()
+        start_time = current_time(home)
     if not hasattr(home, "batterystoragesystem"):
         raise NoBSSystemException()
     battery = home.batterystoragesystem
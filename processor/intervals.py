@@ -0,0 +1,109 @@
+import random
+
+class IntervalNode:
+    __slots__ = ["key", "end_time", "item", "priority", "left", "right", "max_end_time"]
+
+    def __init__(self, key, end_time, item):
+        self.key = key
+        self.end_time = end_time
+        self.item = item
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end_time = end_time
+
+    def update(self):
+        self.max_end_time = self.end_time
+        if self.left is not None and self.left.max_end_time > self.max_end_time:
+            self.max_end_time = self.left.max_end_time
+        if self.right is not None and self.right.max_end_time > self.max_end_time:
+            self.max_end_time = self.right.max_end_time
+
+'''
+IntervalTree class
+Index of executions by [start_time, end_time), stored in a treap ordered by (start_time, id)
+where each node also keeps the latest end time of its subtree.
+Insert and delete take O(log n); overlap queries take O(log n + k),
+since subtrees ending before the period or starting after it are never visited.
+'''
+class IntervalTree:
+    def __init__(self, items=()):
+        self.root = None
+        self.keys = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, item):
+        self.remove(item.id)
+        if item.start_time is None or item.end_time is None:
+            return
+        key = (item.start_time, item.id)
+        self.keys[item.id] = key
+        left, right = split(self.root, key)
+        self.root = merge(merge(left, IntervalNode(key, item.end_time, item)), right)
+
+    def remove(self, item_id):
+        key = self.keys.pop(item_id, None)
+        if key is not None:
+            self.root = delete(self.root, key)
+
+    # Items with start_time <= end_time and end_time > start_time (>= if closed), sorted by start time
+    def search(self, start_time, end_time=None, closed=False):
+        items = []
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            if node is not None:
+                if node.max_end_time < start_time or (not closed and node.max_end_time == start_time):
+                    node = None
+                    continue
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                if end_time is not None and node.key[0] > end_time:
+                    break
+                if node.end_time > start_time or (closed and node.end_time == start_time):
+                    items.append(node.item)
+                node = node.right
+        return items
+
+# Split tree into keys lower than key and keys greater or equal to key
+def split(node, key):
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = split(node.right, key)
+        node.update()
+        return node, right
+    left, node.left = split(node.left, key)
+    node.update()
+    return left, node
+
+def merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        left.update()
+        return left
+    right.left = merge(left, right.left)
+    right.update()
+    return right
+
+def delete(node, key):
+    if node is None:
+        return None
+    if key == node.key:
+        return merge(node.left, node.right)
+    if key < node.key:
+        node.left = delete(node.left, key)
+    else:
+        node.right = delete(node.right, key)
+    node.update()
+    return node
@@ -0,0 +1,151 @@
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+from django.db import connection
+
+from coordinator.settings import METRICS_ENABLED, METRICS_FILE
+
+'''
+In-process metrics registry for the scheduler.
+Counters and histograms are keyed by name and labels. Timers record the duration of a block
+and, when measured, the SQL queries it ran. Snapshots are exported as JSON to a local file, which
+the "metrics" management command reads and prints in the Prometheus text format.
+While disabled every call returns before touching the registry.
+'''
+SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+enabled = METRICS_ENABLED
+lock = threading.Lock()
+local = threading.local()
+counters = {}
+histograms = {}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+
+    # Cumulative counts by upper bound, as in Prometheus
+    def get_buckets(self):
+        buckets = {}
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            buckets[str(bucket)] = total
+        buckets["+Inf"] = self.count
+        return buckets
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+def get_key(name, labels):
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+def increment(name, value=1, **labels):
+    if not enabled:
+        return
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    if not enabled:
+        return
+    key = get_key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+# Duration of the block, as name_seconds
+def timer(name, **labels):
+    return timed(name, False, labels) if enabled else nullcontext()
+
+# Duration and SQL queries of the block, as name_seconds and name_queries
+def measure(name, **labels):
+    return timed(name, True, labels) if enabled else nullcontext()
+
+# Blocks nested in a block of the same name on the same thread, such as re-plans made while
+# scheduling an execution, are part of the outermost one and not recorded again
+@contextmanager
+def timed(name, count_queries, labels):
+    active = local.__dict__.setdefault("active", set())
+    if name in active:
+        yield
+        return
+    active.add(name)
+    queries = [0]
+    def count(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        if count_queries:
+            with connection.execute_wrapper(count):
+                yield
+        else:
+            yield
+    finally:
+        active.discard(name)
+        observe(f"{name}_seconds", time.perf_counter() - start, SECONDS_BUCKETS, **labels)
+        if count_queries:
+            observe(f"{name}_queries", queries[0], COUNT_BUCKETS, **labels)
+
+def snapshot():
+    with lock:
+        return {
+            "time": time.time(),
+            "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters.items()],
+            "histograms": [{"name": name, "labels": dict(labels), "count": histogram.count, "sum": histogram.sum,
+                "buckets": histogram.get_buckets()} for (name, labels), histogram in histograms.items()]
+        }
+
+def save(path=None):
+    path = path or METRICS_FILE
+    data = snapshot()
+    with open(path, "w") as file:
+        json.dump(data, file)
+    return data
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+# Prometheus text exposition of a snapshot
+def to_text(data):
+    lines = []
+    for counter in data["counters"]:
+        lines.append(f"{counter['name']}{format_labels(counter['labels'])} {counter['value']}")
+    for histogram in data["histograms"]:
+        name, labels = histogram["name"], histogram["labels"]
+        for bucket, count in histogram["buckets"].items():
+            lines.append(f"{name}_bucket{format_labels(labels, le=bucket)} {count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines)
@@ -0,0 +1,28 @@
+from math import floor
+
+from coordinator.settings import LOW_PRIORITY, NORMAL, URGENT
+
+'''
+Weighted priority of executions, shared by the scheduler (processor.core) and the
+pending execution queues of processor.state.
+'''
+def calculate_weighted_priority(execution, current_time):
+	maximum_delay = execution.appliance.maximum_delay
+	start_time = execution.start_time if execution.start_time is not None else current_time
+	waiting_time = start_time - execution.request_time + execution.previous_waiting_time
+
+	if execution.profile.priority is URGENT:
+		base_priority = 7
+	elif execution.profile.priority is NORMAL:
+		base_priority = 3
+	elif execution.profile.priority is LOW_PRIORITY:
+		base_priority = 1
+
+	if maximum_delay is not None:
+		multiplier = 8 # steepness of curve: 6, 8, 10 are viable
+		time_until_deadline = maximum_delay - waiting_time
+		minutes_until_deadline = time_until_deadline.seconds/60 if maximum_delay > waiting_time else 0
+		priority = base_priority + floor(60*multiplier/(minutes_until_deadline+60))
+	else:
+		priority = base_priority
+	return priority if priority < 10 else 10
@@ -0,0 +1,90 @@
+import threading
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from coordinator.models import PhotovoltaicSystem, ProductionData
+from processor.tools import is_simulated
+
+'''
+Hourly PV production of each system, loaded once as a 12x24 (month, hour) matrix
+and dropped whenever the system or its production data change.
+Minimum production over a period is answered from a sparse table over consecutive hours,
+rebuilt only when a query falls outside the hours it covers.
+'''
+HOUR = timezone.timedelta(hours=1)
+SPARSE_TABLE_HOURS = 14 * 24
+
+lock = threading.RLock()
+tables = {}
+
+class ProductionTable:
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.first_hour = None
+        self.levels = []
+
+    @classmethod
+    def load(cls, system_id):
+        matrix = [[0] * 24 for _ in range(12)]
+        for production in ProductionData.objects.filter(system_id=system_id):
+            matrix[production.month - 1][production.hour] += production.average_power_generated
+        return cls(matrix)
+
+    def get_power(self, time):
+        return self.matrix[time.month - 1][time.hour]
+
+    # Production values of consecutive hours starting at first_hour, and their minimum over every 2^k hours
+    def build(self, first_hour):
+        values = [self.get_power(first_hour + i * HOUR) for i in range(SPARSE_TABLE_HOURS)]
+        levels = [values]
+        span = 1
+        while span * 2 <= len(values):
+            previous = levels[-1]
+            levels.append([min(previous[i], previous[i + span]) for i in range(len(previous) - span)])
+            span *= 2
+        self.first_hour, self.levels = first_hour, levels
+
+    # Minimum production of the hours starting at start_time, start_time + 1h, ... before end_time
+    def get_minimum_within(self, start_time, end_time):
+        if end_time <= start_time:
+            return None
+        hours = -((start_time - end_time) // HOUR)
+        if hours > SPARSE_TABLE_HOURS:
+            return min(self.get_power(start_time + i * HOUR) for i in range(hours))
+        wall_time = start_time.replace(tzinfo=None)
+        with lock:
+            if self.first_hour is None or wall_time < self.first_hour or \
+                (wall_time - self.first_hour) // HOUR + hours > SPARSE_TABLE_HOURS:
+                self.build(wall_time.replace(minute=0, second=0, microsecond=0))
+            first_hour, levels = self.first_hour, self.levels
+        first = (wall_time - first_hour) // HOUR
+        level = hours.bit_length() - 1
+        return min(levels[level][first], levels[level][first + hours - (1 << level)])
+
+def get_table(system):
+    if is_simulated(system):
+        return system.simulation.get_production_table(system)
+    with lock:
+        table = tables.get(system.id)
+        if table is None:
+            table = tables[system.id] = ProductionTable.load(system.id)
+        return table
+
+def invalidate(system_id=None):
+    with lock:
+        if system_id is None:
+            tables.clear()
+        else:
+            tables.pop(system_id, None)
+
+@receiver(post_save, sender=ProductionData, dispatch_uid="reset_production_table")
+@receiver(post_delete, sender=ProductionData, dispatch_uid="drop_production_table_value")
+def reset_production_table(sender, instance, **kwargs):
+    invalidate(instance.system_id)
+
+@receiver(post_save, sender=PhotovoltaicSystem, dispatch_uid="reset_system_production_table")
+@receiver(post_delete, sender=PhotovoltaicSystem, dispatch_uid="drop_system_production_table")
+def reset_system_production_table(sender, instance, **kwargs):
+    invalidate(instance.id)
@@ -0,0 +1,172 @@
+class SegmentNode:
+    __slots__ = ["left", "right", "add", "maximum"]
+
+    def __init__(self):
+        self.left = None
+        self.right = None
+        self.add = 0
+        self.maximum = 0
+
+'''
+SegmentTree class
+Step function over integer keys in [0, 2 ** depth), zero everywhere at first, supporting
+adding a value over a range and taking the maximum over a range, both in O(depth).
+Nodes are only created where ranges end, so keys can be epoch microseconds. Each node keeps the
+value added to its whole range and the maximum of its subtree including it; a node without
+children is constant over its range.
+'''
+class SegmentTree:
+    def __init__(self, depth=58):
+        self.size = 1 << depth
+        self.root = SegmentNode()
+        self.nodes = 1
+
+    # Adds value over [start, end)
+    def add(self, start, end, value):
+        start, end = max(start, 0), min(end, self.size)
+        if start < end and value:
+            self._add(self.root, 0, self.size, start, end, value)
+
+    def _add(self, node, low, high, start, end, value):
+        if start <= low and high <= end:
+            node.add += value
+            node.maximum += value
+            return
+        if node.left is None:
+            node.left, node.right = SegmentNode(), SegmentNode()
+            self.nodes += 2
+        middle = (low + high) // 2
+        if start < middle:
+            self._add(node.left, low, middle, start, end, value)
+        if end > middle:
+            self._add(node.right, middle, high, start, end, value)
+        node.maximum = node.add + max(node.left.maximum, node.right.maximum)
+
+    # Maximum over [start, end)
+    def maximum(self, start, end):
+        start, end = max(start, 0), min(end, self.size)
+        if start >= end:
+            return None
+        return self._maximum(self.root, 0, self.size, start, end)
+
+    def _maximum(self, node, low, high, start, end):
+        if (start <= low and high <= end) or node.left is None:
+            return node.maximum
+        middle = (low + high) // 2
+        if end <= middle:
+            result = self._maximum(node.left, low, middle, start, end)
+        elif start >= middle:
+            result = self._maximum(node.right, middle, high, start, end)
+        else:
+            result = max(self._maximum(node.left, low, middle, start, end), self._maximum(node.right, middle, high, start, end))
+        return node.add + result
+
+class ExtremaNode:
+    __slots__ = ["left", "right", "add", "minimum", "maximum"]
+
+    def __init__(self):
+        self.left = None
+        self.right = None
+        self.add = 0
+        self.minimum = None
+        self.maximum = None
+
+'''
+ExtremaTree class
+Values at a sparse set of integer keys in [0, 2 ** depth), supporting setting or removing the value
+of a key, adding a value to every key within a range and taking the minimum and maximum over a
+range, all in O(depth). Nodes only exist on the paths to keys, and are dropped with the last key
+below them. Each node keeps the value added to its whole range and the extrema of the keys of its
+subtree including it, or None when it has no keys.
+'''
+class ExtremaTree:
+    def __init__(self, depth=58):
+        self.size = 1 << depth
+        self.root = ExtremaNode()
+
+    def set(self, key, value):
+        self._set(self.root, 0, self.size, key, value)
+
+    def _set(self, node, low, high, key, value):
+        if high - low == 1:
+            node.add = node.minimum = node.maximum = value
+            return
+        if node.left is None:
+            node.left, node.right = ExtremaNode(), ExtremaNode()
+        middle = (low + high) // 2
+        if key < middle:
+            self._set(node.left, low, middle, key, value - node.add)
+        else:
+            self._set(node.right, middle, high, key, value - node.add)
+        self._update(node)
+
+    def remove(self, key):
+        self._remove(self.root, 0, self.size, key)
+
+    def _remove(self, node, low, high, key):
+        if node.minimum is None:
+            return
+        if high - low == 1:
+            node.add = 0
+            node.minimum = node.maximum = None
+            return
+        middle = (low + high) // 2
+        if key < middle:
+            self._remove(node.left, low, middle, key)
+        else:
+            self._remove(node.right, middle, high, key)
+        self._update(node)
+
+    def _update(self, node):
+        children = [child for child in (node.left, node.right) if child.minimum is not None]
+        if not children:
+            node.left = node.right = None
+            node.add = 0
+            node.minimum = node.maximum = None
+            return
+        node.minimum = node.add + min(child.minimum for child in children)
+        node.maximum = node.add + max(child.maximum for child in children)
+
+    # Adds value to the keys within [start, end)
+    def add(self, start, end, value):
+        start, end = max(start, 0), min(end, self.size)
+        if start < end and value:
+            self._add(self.root, 0, self.size, start, end, value)
+
+    def _add(self, node, low, high, start, end, value):
+        if node.minimum is None:
+            return
+        if start <= low and high <= end:
+            node.add += value
+            node.minimum += value
+            node.maximum += value
+            return
+        middle = (low + high) // 2
+        if start < middle:
+            self._add(node.left, low, middle, start, end, value)
+        if end > middle:
+            self._add(node.right, middle, high, start, end, value)
+        self._update(node)
+
+    # (minimum, maximum) of the keys within [start, end), or None without any
+    def extrema(self, start, end):
+        start, end = max(start, 0), min(end, self.size)
+        if start >= end:
+            return None
+        return self._extrema(self.root, 0, self.size, start, end)
+
+    def _extrema(self, node, low, high, start, end):
+        if node.minimum is None:
+            return None
+        if start <= low and high <= end:
+            return node.minimum, node.maximum
+        middle = (low + high) // 2
+        results = []
+        if start < middle:
+            results.append(self._extrema(node.left, low, middle, start, end))
+        if end > middle:
+            results.append(self._extrema(node.right, middle, high, start, end))
+        results = [result for result in results if result is not None]
+        if not results:
+            return None
+        return node.add + min(result[0] for result in results), node.add + max(result[1] for result in results)
@@ -0,0 +1,157 @@
+import re
+import hashlib
+import threading
+
+from django.utils import timezone
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from coordinator.models import Home, Execution, Profile, Appliance, BatteryStorageSystem, BatteryCheckpoint, PhotovoltaicSystem, ProductionData
+from coordinator.settings import COORDINATOR_SHARD, COORDINATOR_SHARDS, COORDINATOR_SYNC_MARGIN
+from processor.tools import is_simulated
+
+'''
+Sharding of homes across coordinator processes.
+Each of the configured number of processes owns the homes whose id hashes to its shard, and runs
+their jobs on its own scheduler; the job store of each process only loads the jobs of its homes.
+Homes are assigned by rendezvous hashing: every shard scores the home and the highest score wins,
+so adding or removing a shard only moves the homes it gains or loses.
+Jobs that do not belong to a home are owned by shard 0.
+The in-memory state, timers and production tables of a home are only kept up to date by the
+model signals of the process running it. Writes made anywhere else, such as from the admin, the
+web server or another shard, mark the home as changed once they commit, in one update per
+transaction, and every shard looks up the changed homes it owns every COORDINATOR_SYNC_INTERVAL
+seconds to reload them (see processor.core.sync_homes_job). Processes reading homes they do not run
+rebuild their states when a home loaded later was marked after them (see processor.state.get_state).
+Changes are found by the time they were marked, going back COORDINATOR_SYNC_MARGIN seconds so
+transactions committing late are not missed; longer transactions may be.
+'''
+HOME_JOB_IDS = [
+    re.compile(r"^home_(\d+)_"),
+    re.compile(r"^(?:schedule_battery_charge|save_battery_checkpoint|send_consumption_schedule)_(\d+)$")
+]
+
+shard = COORDINATOR_SHARD
+count = COORDINATOR_SHARDS
+# Set once this process runs the coordinator for its shard
+started = False
+
+lock = threading.Lock()
+changes = {}
+last_poll = None
+local = threading.local()
+
+def configure(new_shard, new_count):
+    global shard, count
+    if not 0 <= new_shard < new_count:
+        raise ValueError(f"Shard {new_shard} is not between 0 and {new_count - 1}.")
+    shard, count = new_shard, new_count
+
+def get_score(home_id, index):
+    return hashlib.blake2b(f"{index}:{home_id}".encode(), digest_size=8).digest()
+
+def get_shard(home_id, shards=None):
+    shards = shards or count
+    if shards == 1:
+        return 0
+    return max(range(shards), key=lambda index: get_score(home_id, index))
+
+def owns(home_id):
+    return get_shard(home_id) == shard
+
+def get_job_home(job_id):
+    for pattern in HOME_JOB_IDS:
+        match = pattern.match(job_id)
+        if match:
+            return int(match.group(1))
+    return None
+
+def owns_job(job_id):
+    home_id = get_job_home(job_id)
+    return owns(home_id) if home_id is not None else shard == 0
+
+# Path of a per-process file, such as exported metrics, when running sharded
+def get_path(path):
+    return path if count == 1 else f"{path}.{shard}"
+
+# Homes of this shard marked as changed since the last poll
+def get_changed_homes():
+    global last_poll
+    with lock:
+        now = timezone.now()
+        since = (last_poll or now) - timezone.timedelta(seconds=COORDINATOR_SYNC_MARGIN)
+        last_poll = now
+        changed = []
+        for home_id, time in Home.objects.filter(state_changed__gte=since).values_list("id", "state_changed"):
+            if changes.get(home_id) != time and owns(home_id):
+                changed.append(home_id)
+            changes[home_id] = time
+        for home_id in [home_id for home_id, time in changes.items() if time < since]:
+            del changes[home_id]
+        return changed
+
+def mark_changed(homes):
+    homes.update(state_changed=timezone.now())
+
+# Homes whose caches this process keeps up to date itself
+def keeps(home_id):
+    return started and owns(home_id)
+
+def get_home_ids(instance):
+    if isinstance(instance, BatteryCheckpoint):
+        return BatteryStorageSystem.objects.filter(id=instance.battery_id).values_list("home_id", flat=True)
+    if isinstance(instance, ProductionData):
+        return PhotovoltaicSystem.objects.filter(id=instance.system_id).values_list("home_id", flat=True)
+    return [instance.home_id]
+
+# Marks homes once the transaction of the change commits, adding them to the update still waiting for it if any
+def mark_on_commit(home_ids):
+    pending = getattr(local, "pending", None)
+    if pending is not None and is_waiting(pending[1]):
+        pending[0].update(home_ids)
+        return
+    home_ids = set(home_ids)
+    def mark():
+        if getattr(local, "pending", None) is pending:
+            local.pending = None
+        mark_changed(Home.objects.filter(id__in=home_ids))
+    pending = (home_ids, mark)
+    local.pending = pending
+    transaction.on_commit(mark)
+
+# Whether a commit callback is still to run, neither run nor discarded by a rollback
+def is_waiting(callback):
+    connection = transaction.get_connection()
+    return connection.in_atomic_block and any(entry[1] is callback for entry in reversed(connection.run_on_commit))
+
+# Changes made by the process running a home already reached its caches
+@receiver(post_save, sender=Execution, dispatch_uid="mark_home_on_execution_save")
+@receiver(post_delete, sender=Execution, dispatch_uid="mark_home_on_execution_delete")
+@receiver(post_save, sender=Appliance, dispatch_uid="mark_home_on_appliance_save")
+@receiver(post_save, sender=BatteryStorageSystem, dispatch_uid="mark_home_on_battery_save")
+@receiver(post_delete, sender=BatteryStorageSystem, dispatch_uid="mark_home_on_battery_delete")
+@receiver(post_save, sender=BatteryCheckpoint, dispatch_uid="mark_home_on_checkpoint_save")
+@receiver(post_delete, sender=BatteryCheckpoint, dispatch_uid="mark_home_on_checkpoint_delete")
+@receiver(post_save, sender=PhotovoltaicSystem, dispatch_uid="mark_home_on_pv_save")
+@receiver(post_delete, sender=PhotovoltaicSystem, dispatch_uid="mark_home_on_pv_delete")
+@receiver(post_save, sender=ProductionData, dispatch_uid="mark_home_on_production_save")
+@receiver(post_delete, sender=ProductionData, dispatch_uid="mark_home_on_production_delete")
+def mark_home(sender, instance, **kwargs):
+    if is_simulated(instance) or (started and count == 1):
+        return
+    home_ids = [home_id for home_id in get_home_ids(instance) if not keeps(home_id)]
+    if home_ids:
+        mark_on_commit(home_ids)
+
+@receiver(post_save, sender=Profile, dispatch_uid="mark_homes_on_profile_save")
+def mark_homes(sender, instance, created, **kwargs):
+    if not created and not (started and count == 1):
+        home_ids = [home_id for home_id in get_profile_home_ids(instance) if not keeps(home_id)]
+        if home_ids:
+            mark_on_commit(home_ids)
+
+# Homes with an appliance or an execution using the profile
+def get_profile_home_ids(profile):
+    return Home.objects.filter(Q(appliance__profiles=profile) | Q(execution__profile=profile)).values_list("id", flat=True).distinct()
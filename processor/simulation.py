@@ -0,0 +1,371 @@
+from bisect import insort
+from django.utils import timezone
+
+import processor.core as core
+import processor.state as state
+from processor.events import EventScheduler
+from home.settings import INF_DATE
+from processor.production import ProductionTable
+from coordinator.models import HomeSnapshot
+from coordinator.settings import PEAK_SHAVING, SCHEDULING_HORIZON
+
+'''
+In-memory simulation of the scheduler.
+Homes, appliances, profiles, batteries, PV systems and executions are plain Python records
+with the attributes and setters of the models they stand for. Each record carries the
+simulation it belongs to, which keeps the home states, PV production tables and battery
+checkpoints the scheduler would otherwise load from the database, so processor.core and
+processor.external_energy run on them without touching it.
+Given a virtual clock, requests and the jobs core would leave to APScheduler (execution start
+and finish, battery charge, checkpoints) run on a discrete-event scheduler in timestamp order.
+Each simulated home keeps its own event timer, as in processor.timers.
+'''
+MIN_DATE = timezone.datetime.min.replace(tzinfo=INF_DATE.tzinfo)
+
+class SimulatedProfile:
+    def __init__(self, id, name, schedulability, priority, rated_power, maximum_duration_of_usage=None, hidden=False):
+        self.id = id
+        self.name = name
+        self.schedulability = schedulability
+        self.priority = priority
+        self.rated_power = rated_power
+        self.maximum_duration_of_usage = maximum_duration_of_usage
+        self.hidden = hidden
+
+    def __str__(self):
+        return self.name
+
+# Stands for the profiles relation of an appliance
+class SimulatedProfileSet:
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.profiles = []
+
+    def all(self):
+        return list(self.profiles)
+
+    def add(self, *profiles):
+        for profile in profiles:
+            if profile not in self.profiles:
+                self.profiles.append(profile)
+
+    def get_or_create(self, name, defaults=None):
+        for profile in self.profiles:
+            if profile.name == name:
+                return profile, False
+        profile = self.simulation.add_profile(name, **(defaults or {}))
+        self.add(profile)
+        return profile, True
+
+class SimulatedAppliance:
+    def __init__(self, simulation, id, home, name, maximum_delay=timezone.timedelta(seconds=3600)):
+        self.simulation = simulation
+        self.id = id
+        self.home = home
+        self.name = name
+        self.maximum_delay = maximum_delay
+        self.profiles = SimulatedProfileSet(simulation)
+
+    @property
+    def home_id(self):
+        return self.home.id
+
+    def __str__(self):
+        return self.name
+
+class SimulatedBattery:
+    def __init__(self, simulation, id, home, appliance, total_energy_capacity, continuous_power, last_full_charge_time, depth_of_discharge=1):
+        self.simulation = simulation
+        self.id = id
+        self.home = home
+        self.appliance = appliance
+        self.total_energy_capacity = total_energy_capacity
+        self.continuous_power = continuous_power
+        self.last_full_charge_time = last_full_charge_time
+        self.depth_of_discharge = depth_of_discharge
+
+    @property
+    def appliance_id(self):
+        return self.appliance.id
+
+    def set_last_full_charge_time(self, last_full_charge_time):
+        self.last_full_charge_time = last_full_charge_time
+
+    def __str__(self):
+        return "Battery Storage System"
+
+class SimulatedPhotovoltaicSystem:
+    def __init__(self, simulation, id, home, matrix):
+        self.simulation = simulation
+        self.id = id
+        self.home = home
+        self.table = ProductionTable(matrix)
+
+    def __str__(self):
+        return "Photovoltaic System"
+
+# Stands for a HomeSnapshot: appliances and profiles are always at hand
+class SimulatedHome:
+    def __init__(self, simulation, id, consumption_threshold, strategy=PEAK_SHAVING):
+        self.simulation = simulation
+        self.id = id
+        self.outside_id = None
+        self.consumption_threshold = consumption_threshold
+        self.accept_recommendations = False
+        self.strategy = strategy
+        self.is_running = False
+        self.appliances = {}
+
+    def set_outside_id(self, new_val):
+        self.outside_id = new_val
+
+    def set_consumption_threshold(self, new_val):
+        self.consumption_threshold = new_val
+
+    def set_accept_recommendations(self, new_val):
+        self.accept_recommendations = new_val
+
+    def set_strategy(self, new_val):
+        self.strategy = new_val
+
+    def set_running(self, new_val):
+        self.is_running = new_val
+
+    def compare_BSS_appliance(self, appliance):
+        if not hasattr(self, "batterystoragesystem"):
+            return False
+        else:
+            return self.batterystoragesystem.appliance.id == appliance.id
+
+    def attach(self, execution):
+        return execution
+
+    def __str__(self):
+        return "Home"
+
+class SimulatedExecution:
+    def __init__(self, simulation, id, home, appliance, profile, request_time, start_time=None, end_time=None,
+        previous_progress_time=timezone.timedelta(), previous_waiting_time=timezone.timedelta()):
+        self.simulation = simulation
+        self.id = id
+        self.home = home
+        self.appliance = appliance
+        self.profile = profile
+        self.request_time = request_time
+        self.start_time = start_time
+        self.end_time = end_time
+        self.previous_progress_time = previous_progress_time
+        self.previous_waiting_time = previous_waiting_time
+        self.is_started = False
+        self.is_interrupted = False
+        self.is_finished = False
+
+    @property
+    def home_id(self):
+        return self.home.id
+
+    @property
+    def appliance_id(self):
+        return self.appliance.id
+
+    @property
+    def profile_id(self):
+        return self.profile.id
+
+    def save(self):
+        self.simulation.save(self)
+
+    def delete(self):
+        self.simulation.delete(self)
+
+    def start(self):
+        self.start_time = self.simulation.now()
+        if self.end_time is None:
+            if self.profile.maximum_duration_of_usage is not None:
+                self.end_time = self.start_time + self.profile.maximum_duration_of_usage - self.previous_progress_time
+            else:
+                self.end_time = INF_DATE
+        self.is_started = True
+        self.save()
+
+    def interrupt(self):
+        self.end_time = self.simulation.now()
+        self.is_interrupted = True
+        self.save()
+
+    def finish(self):
+        self.end_time = self.simulation.now()
+        self.is_finished = True
+        self.save()
+
+    def set_started(self):
+        self.is_started = True
+        self.save()
+
+    def set_finished(self):
+        self.is_finished = True
+        self.save()
+
+    def set_start_time(self, start_time):
+        self.start_time = start_time
+        if self.end_time is None:
+            if self.profile.maximum_duration_of_usage is not None:
+                self.end_time = self.start_time + self.profile.maximum_duration_of_usage - self.previous_progress_time
+            else:
+                self.end_time = INF_DATE
+        self.save()
+
+    def set_end_time(self, end_time):
+        self.end_time = end_time
+        self.save()
+
+    def set_request_time(self, request_time):
+        self.request_time = request_time
+        self.save()
+
+    def status(self):
+        if self.is_finished:
+            return "Finished"
+        elif self.is_interrupted:
+            return "Interrupted"
+        elif self.is_started:
+            return "Started"
+        else:
+            return "Pending"
+
+    def __str__(self):
+        request_time = self.request_time.strftime("%d/%m/%Y, %H:%M:%S")
+        return f"Execution of {self.appliance.name} requested at {request_time}. Status: {self.status()}"
+
+class Simulation:
+    def __init__(self, clock=None):
+        self.clock = clock
+        self.scheduler = EventScheduler(clock)
+        self.homes = {}
+        self.appliances = {}
+        self.profiles = {}
+        self.executions = {}
+        self.states = {}
+        self.checkpoints = {}
+        self.timers = {}
+        self.last_ids = {}
+
+    def now(self):
+        return self.clock.now() if self.clock is not None else timezone.now()
+
+    def get_id(self, kind, id=None):
+        if id is None:
+            id = self.last_ids.get(kind, 0) + 1
+        self.last_ids[kind] = max(self.last_ids.get(kind, 0), id)
+        return id
+
+    def add_home(self, consumption_threshold, strategy=PEAK_SHAVING, id=None):
+        home = SimulatedHome(self, self.get_id("home", id), consumption_threshold, strategy)
+        self.homes[home.id] = home
+        self.states[home.id] = state.HomeState(home.id, MIN_DATE, [])
+        return home
+
+    def add_profile(self, name, schedulability, priority, rated_power, maximum_duration_of_usage=None, hidden=False, id=None):
+        profile = SimulatedProfile(self.get_id("profile", id), name, schedulability, priority, rated_power, maximum_duration_of_usage, hidden)
+        self.profiles[profile.id] = profile
+        return profile
+
+    def add_appliance(self, home, name, profiles=(), maximum_delay=timezone.timedelta(seconds=3600), id=None):
+        appliance = SimulatedAppliance(self, self.get_id("appliance", id), home, name, maximum_delay)
+        appliance.profiles.add(*profiles)
+        self.appliances[appliance.id] = home.appliances[appliance.id] = appliance
+        return appliance
+
+    def add_battery(self, home, total_energy_capacity, continuous_power, last_full_charge_time=None, depth_of_discharge=1,
+        appliance=None, id=None):
+        if last_full_charge_time is None:
+            last_full_charge_time = self.now()
+        if appliance is None:
+            appliance = self.add_appliance(home, "Battery Storage System", maximum_delay=timezone.timedelta(seconds=60))
+        home.batterystoragesystem = SimulatedBattery(self, self.get_id("battery", id), home, appliance,
+            total_energy_capacity, continuous_power, last_full_charge_time, depth_of_discharge)
+        return home.batterystoragesystem
+
+    # Production matrix holds the average power generated by (month - 1, hour)
+    def add_photovoltaic_system(self, home, matrix, id=None):
+        home.photovoltaicsystem = SimulatedPhotovoltaicSystem(self, self.get_id("photovoltaic_system", id), home, matrix)
+        return home.photovoltaicsystem
+
+    # Home, appliances, profiles, BSS and PV system copied from the database, keeping their ids
+    def copy_home(self, home_id):
+        snapshot = HomeSnapshot.load(home_id)
+        home = self.add_home(snapshot.consumption_threshold, snapshot.strategy, snapshot.id)
+        for appliance in snapshot.appliances.values():
+            profiles = [self.profiles.get(profile.id) or self.add_profile(profile.name, profile.schedulability, profile.priority,
+                profile.rated_power, profile.maximum_duration_of_usage, profile.hidden, profile.id) for profile in appliance.profiles.all()]
+            self.add_appliance(home, appliance.name, profiles, appliance.maximum_delay, appliance.id)
+        if hasattr(snapshot, "batterystoragesystem"):
+            battery = snapshot.batterystoragesystem
+            self.add_battery(home, battery.total_energy_capacity, battery.continuous_power, battery.last_full_charge_time,
+                battery.depth_of_discharge, home.appliances[battery.appliance_id], battery.id)
+        if hasattr(snapshot, "photovoltaicsystem"):
+            system = snapshot.photovoltaicsystem
+            self.add_photovoltaic_system(home, ProductionTable.load(system.id).matrix, system.id)
+        return home
+
+    def create_execution(self, home, appliance, profile, request_time=None, **fields):
+        if request_time is None:
+            request_time = self.now()
+        execution = SimulatedExecution(self, self.get_id("execution"), home, appliance, profile, request_time, **fields)
+        self.executions[execution.id] = execution
+        self.save(execution, created=True)
+        return execution
+
+    # Same bookkeeping as the model signals in processor.state
+    def save(self, execution, created=False):
+        self.states[execution.home_id].update(execution)
+        self.drop_outdated_checkpoints(execution, execution.start_time if created else execution.end_time)
+
+    def delete(self, execution):
+        self.executions.pop(execution.id, None)
+        self.states[execution.home_id].remove(execution.id)
+        self.drop_outdated_checkpoints(execution, execution.start_time)
+
+    def drop_outdated_checkpoints(self, execution, time):
+        home = execution.home
+        if time is not None and home.compare_BSS_appliance(execution.appliance):
+            checkpoints = self.get_checkpoints(home.batterystoragesystem)
+            checkpoints[:] = [checkpoint for checkpoint in checkpoints if checkpoint[0] <= time]
+
+    def get_state(self, home):
+        return self.states[home.id]
+
+    def get_production_table(self, system):
+        return system.table
+
+    def get_checkpoints(self, battery):
+        return self.checkpoints.setdefault(battery.id, [])
+
+    def save_checkpoint(self, battery, time, energy):
+        checkpoints = self.get_checkpoints(battery)
+        checkpoints[:] = [checkpoint for checkpoint in checkpoints if checkpoint[0] != time and checkpoint[0] >= time - SCHEDULING_HORIZON]
+        insort(checkpoints, (time, energy))
+        return (time, energy)
+
+    # Latest ending execution of an appliance, as ordered by end time in the database
+    def get_last_execution(self, appliance, condition=None):
+        executions = [execution for execution in self.executions.values()
+            if execution.appliance_id == appliance.id and (condition is None or condition(execution))]
+        return max(executions, key=lambda e: (e.end_time is not None, e.end_time or MIN_DATE, e.id), default=None)
+
+    # Schedules each execution at its request time, in the given order
+    def run(self, executions):
+        return [core.schedule_execution(execution, execution.request_time, debug=True) for execution in executions]
+
+    # Recurring jobs of every home, as started in production
+    def start(self):
+        for home in self.homes.values():
+            core.start_home(home)
+
+    # Execution scheduled when the clock reaches its request time
+    def request(self, execution):
+        self.scheduler.add_job(core.schedule_execution, 'date', [execution, execution.request_time],
+            id=f"home_{execution.home_id}_execution_{execution.id}_request", run_date=execution.request_time)
+
+    def run_until(self, end_time):
+        return self.scheduler.run_until(end_time)
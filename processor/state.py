@@ -0,0 +1,364 @@
+import heapq
+import threading
+import time as clock
+from bisect import bisect_left, bisect_right
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from coordinator.models import Home, Execution, Profile, Appliance, BatteryStorageSystem, BatteryCheckpoint
+from processor.timeline import LoadTimeline
+from processor.intervals import IntervalTree
+from processor.battery import BatteryLedger
+from processor.tools import is_simulated
+import processor.shards as shards
+from processor.priority import calculate_weighted_priority
+from coordinator.settings import SCHEDULING_HORIZON, COORDINATOR_SYNC_INTERVAL
+
+'''
+In-memory scheduling state of each home, built once from the database and kept
+up to date by model signals as executions are created, started, interrupted or finished.
+States only hold executions ending at or after their "since" time, and are rebuilt
+if an earlier time is requested. Executions that ended more than a scheduling horizon before the
+time requested are dropped, unless a battery ledger of the home still starts before them.
+Changes made inside a transaction are applied at once, so it reads its own writes, and confirmed
+by a callback run when it commits. A rollback discards the callbacks of the changes it undid, and
+the state of a home with a discarded confirmation is rebuilt on its next read.
+Only the process running a home sees every change to it. Elsewhere, as in the admin or another
+shard, states are rebuilt when the home they are read for was marked as changed after them, or,
+for the writes of the process running it, which are not marked, once COORDINATOR_SYNC_INTERVAL
+seconds old.
+Battery checkpoints are loaded once per battery and kept up to date the same way. Checkpoints older
+than a scheduling horizon are deleted as new ones are saved (see processor.external_energy), so the
+list of each battery stays bounded.
+'''
+# Battery ledgers kept per home, least recently used dropped first, as each one follows every execution update
+MAXIMUM_LEDGERS = 4
+
+lock = threading.RLock()
+states = {}
+checkpoints = {}
+battery_appliances = None
+# commit callbacks of the changes each home's state, or each battery's checkpoints, hold from open
+# transactions, with their connections
+uncommitted = {}
+
+class HomeState:
+    def __init__(self, home_id, since, executions=None, changed=None):
+        self.home_id = home_id
+        self.since = since
+        # Home.state_changed and monotonic clock when built, to tell when a copy of another process is outdated
+        self.changed = changed
+        self.built = clock.monotonic()
+        if executions is None:
+            executions = list(Execution.objects.filter(home_id=home_id, start_time__isnull=False, end_time__gte=since)
+                .select_related('profile', 'appliance'))
+        self.index = IntervalTree(executions)
+        self.timeline = LoadTimeline(executions)
+        self.ledgers = {}
+        self.entries = {}
+        self.pending = {}
+        self.starts = []
+        self.started_by = None
+        self.ordered = None
+        self.sequence = 0
+        for execution in executions:
+            self.enqueue(execution)
+
+    def update(self, execution):
+        if execution.end_time is not None and execution.end_time < self.since:
+            self.remove(execution.id)
+        else:
+            self.index.add(execution)
+            self.timeline.add(execution)
+            self.enqueue(execution)
+            for ledger in self.ledgers.values():
+                ledger.add(execution)
+
+    def remove(self, execution_id):
+        self.index.remove(execution_id)
+        self.timeline.remove(execution_id)
+        self.entries.pop(execution_id, None)
+        if self.pending.pop(execution_id, None) is not None:
+            self.ordered = None
+        for ledger in self.ledgers.values():
+            ledger.remove(execution_id)
+
+    # Drops executions ending before time, along with the ledgers starting before it
+    def prune(self, time):
+        for execution_id, (_, end_time, _) in list(self.timeline.executions.items()):
+            if end_time < time:
+                self.remove(execution_id)
+        self.ledgers = {key: ledger for key, ledger in self.ledgers.items() if key[3] >= time}
+        self.since = time
+
+    # Latest time executions can be dropped before, keeping those the battery ledgers read
+    def get_pruning_time(self, since):
+        return min([since - SCHEDULING_HORIZON] + [key[3] for key in self.ledgers])
+
+    # Scheduled executions are queued by weighted priority, which no longer depends on the current time
+    # once a start time is set. Ties keep the end time order of unfinished executions.
+    # Executions that started by the last time read are dropped from the pending entries, found through
+    # a heap by start time, so reads only sort what is still pending, and only after it changed.
+    # Replaced entries stay in that heap until it is compacted.
+    def enqueue(self, execution):
+        self.entries.pop(execution.id, None)
+        if self.pending.pop(execution.id, None) is not None:
+            self.ordered = None
+        if execution.start_time is None or execution.end_time is None:
+            return
+        priority = calculate_weighted_priority(execution, execution.start_time)
+        self.sequence += 1
+        entry = (-priority, execution.end_time, execution.id, self.sequence, execution)
+        self.entries[execution.id] = entry
+        if self.started_by is None or execution.start_time > self.started_by:
+            self.pending[execution.id] = entry
+            self.ordered = None
+            heapq.heappush(self.starts, (execution.start_time, self.sequence, execution.id))
+            if len(self.starts) > 2 * len(self.pending) + 32:
+                self.starts = [(entry[-1].start_time, entry[3], entry[2]) for entry in self.pending.values()]
+                heapq.heapify(self.starts)
+
+    def drop_started(self, time):
+        if self.started_by is not None and time < self.started_by:
+            self.pending = {id: entry for id, entry in self.entries.items() if entry[-1].start_time > time}
+            self.starts = [(entry[-1].start_time, entry[3], entry[2]) for entry in self.pending.values()]
+            heapq.heapify(self.starts)
+            self.ordered = None
+        while self.starts and self.starts[0][0] <= time:
+            _, sequence, execution_id = heapq.heappop(self.starts)
+            entry = self.pending.get(execution_id)
+            if entry is not None and entry[3] == sequence:
+                del self.pending[execution_id]
+                self.ordered = None
+        self.started_by = time
+
+    # Executions starting after time, highest weighted priority first
+    def get_pending_executions(self, time):
+        self.drop_started(time)
+        if self.ordered is None:
+            self.ordered = sorted(self.pending.values())
+        return [entry[-1] for entry in self.ordered]
+
+def get_state(home, since):
+    if is_simulated(home):
+        return home.simulation.get_state(home)
+    with lock:
+        state = states.get(home.id)
+        if drop_rolled_back(home.id) and state is not None:
+            since, state = min(since, state.since), None
+        changed = getattr(home, "state_changed", None)
+        if state is not None and not shards.keeps(home.id) and is_outdated(state, changed):
+            since, state = min(since, state.since), None
+        if state is None or since < state.since:
+            state = states[home.id] = HomeState(home.id, since if state is None else min(since, state.since), changed=changed)
+        elif state.get_pruning_time(since) - state.since > SCHEDULING_HORIZON:
+            state.prune(state.get_pruning_time(since))
+        return state
+
+def is_outdated(state, changed):
+    if changed is not None and (state.changed is None or changed > state.changed):
+        return True
+    return clock.monotonic() - state.built > COORDINATOR_SYNC_INTERVAL
+
+# Records a change to the state of a home, or to ("battery", id) checkpoints, confirmed once its transaction commits
+def track(home_id):
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return
+    def confirm():
+        with lock:
+            confirmations = uncommitted.get(home_id, [])
+            confirmations[:] = [confirmation for confirmation in confirmations if confirmation[1] is not confirm]
+            if not confirmations:
+                uncommitted.pop(home_id, None)
+    with lock:
+        uncommitted.setdefault(home_id, []).append((connection, confirm))
+    transaction.on_commit(confirm)
+
+# Forgets the changes to the state of a home that were rolled back, their confirmations no longer
+# waiting for a commit, and returns whether there were any
+def drop_rolled_back(home_id):
+    confirmations = uncommitted.get(home_id)
+    if not confirmations:
+        return False
+    waiting = {}
+    for connection, _ in confirmations:
+        if connection not in waiting:
+            waiting[connection] = {entry[1] for entry in connection.run_on_commit}
+    kept = [confirmation for confirmation in confirmations if confirmation[1] in waiting[confirmation[0]]]
+    if len(kept) == len(confirmations):
+        return False
+    if kept:
+        uncommitted[home_id] = kept
+    else:
+        del uncommitted[home_id]
+    return True
+
+def get_timeline(home, since):
+    return get_state(home, since).timeline
+
+def get_index(home, since):
+    return get_state(home, since).index
+
+# Checkpoints of a battery as (time, energy), sorted by time
+def get_checkpoints(battery):
+    if is_simulated(battery):
+        return battery.simulation.get_checkpoints(battery)
+    return get_checkpoints_by_id(battery.id)
+
+def get_checkpoints_by_id(battery_id):
+    with lock:
+        if drop_rolled_back(("battery", battery_id)):
+            checkpoints.pop(battery_id, None)
+        if battery_id not in checkpoints:
+            checkpoints[battery_id] = list(BatteryCheckpoint.objects.filter(battery_id=battery_id).order_by('time').values_list('time', 'energy'))
+        return checkpoints[battery_id]
+
+# Ledger starting at the latest checkpoint not after time and not before the last full charge
+def get_battery_ledger(home, time=None):
+    battery = home.batterystoragesystem
+    start_time, energy = battery.last_full_charge_time, battery.total_energy_capacity
+    with lock:
+        battery_checkpoints = get_checkpoints(battery)
+        index = len(battery_checkpoints) if time is None else bisect_right(battery_checkpoints, (time, float("inf")))
+        if index > 0 and battery_checkpoints[index - 1][0] >= start_time:
+            start_time, energy = battery_checkpoints[index - 1]
+        state = get_state(home, start_time)
+        key = (battery.appliance_id, battery.last_full_charge_time, battery.total_energy_capacity, start_time, energy)
+        ledger = state.ledgers.pop(key, None)
+        if ledger is not None:
+            state.ledgers[key] = ledger
+        else:
+            if len(state.ledgers) >= MAXIMUM_LEDGERS:
+                state.ledgers.pop(next(iter(state.ledgers)))
+            executions = state.index.search(start_time, None, closed=True)
+            ledger = state.ledgers[key] = BatteryLedger(battery.appliance_id, battery.last_full_charge_time,
+                battery.total_energy_capacity, executions, start_time, energy)
+        return ledger
+
+def get_pending_executions(home, time):
+    with lock:
+        return get_state(home, time).get_pending_executions(time)
+
+def invalidate(home_id=None):
+    with lock:
+        if home_id is None:
+            states.clear()
+        else:
+            states.pop(home_id, None)
+
+# Drops the state and battery checkpoints of a home, as after changes made by another process
+def invalidate_home(home):
+    global battery_appliances
+    with lock:
+        states.pop(home.id, None)
+        if hasattr(home, "batterystoragesystem"):
+            checkpoints.pop(home.batterystoragesystem.id, None)
+        battery_appliances = None
+
+@receiver(post_save, sender=Execution, dispatch_uid="update_home_state")
+def update_home_state(sender, instance, **kwargs):
+    with lock:
+        track(instance.home_id)
+        state = states.get(instance.home_id)
+        if state is not None:
+            state.update(instance)
+
+@receiver(post_delete, sender=Execution, dispatch_uid="remove_from_home_state")
+def remove_from_home_state(sender, instance, **kwargs):
+    with lock:
+        track(instance.home_id)
+        state = states.get(instance.home_id)
+        if state is not None:
+            state.remove(instance.id)
+
+def get_battery_id(appliance_id):
+    global battery_appliances
+    with lock:
+        if battery_appliances is None:
+            battery_appliances = dict(BatteryStorageSystem.objects.filter(appliance__isnull=False).values_list('appliance_id', 'id'))
+        return battery_appliances.get(appliance_id)
+
+# Earliest time the energy of a battery execution changed: its start when created or removed,
+# and otherwise the earlier of the old and new values of the times that moved, as the instance
+# was loaded or last saved with. Instances built by hand fall back to their start.
+def get_changed_time(instance, created):
+    saved = instance.saved_values
+    if created or saved is None:
+        return instance.start_time
+    start_time, end_time, profile_id = saved
+    times = []
+    if start_time != instance.start_time or profile_id != instance.profile_id:
+        times += [start_time, instance.start_time]
+    if end_time != instance.end_time:
+        times += [end_time, instance.end_time]
+    return min([time for time in times if time is not None], default=None)
+
+# Checkpoints after that time no longer hold
+@receiver(post_save, sender=Execution, dispatch_uid="drop_outdated_checkpoints")
+@receiver(post_delete, sender=Execution, dispatch_uid="drop_outdated_checkpoints_on_delete")
+def drop_outdated_checkpoints(sender, instance, created=True, **kwargs):
+    battery_id = get_battery_id(instance.appliance_id)
+    if battery_id is None:
+        return
+    time = get_changed_time(instance, created)
+    if time is None:
+        return
+    with lock:
+        battery_checkpoints = get_checkpoints_by_id(battery_id)
+        outdated = battery_checkpoints and battery_checkpoints[-1][0] > time
+    if outdated:
+        BatteryCheckpoint.objects.filter(battery_id=battery_id, time__gt=time).delete()
+
+# Saved and deleted checkpoints update the loaded list in place
+@receiver(post_save, sender=BatteryCheckpoint, dispatch_uid="add_checkpoint")
+def add_checkpoint(sender, instance, **kwargs):
+    with lock:
+        battery_checkpoints = checkpoints.get(instance.battery_id)
+        if battery_checkpoints is not None:
+            track(("battery", instance.battery_id))
+            remove_checkpoint(battery_checkpoints, instance.time)
+            battery_checkpoints.insert(bisect_left(battery_checkpoints, (instance.time,)), (instance.time, instance.energy))
+
+@receiver(post_delete, sender=BatteryCheckpoint, dispatch_uid="drop_checkpoint")
+def drop_checkpoint(sender, instance, **kwargs):
+    with lock:
+        battery_checkpoints = checkpoints.get(instance.battery_id)
+        if battery_checkpoints is not None:
+            track(("battery", instance.battery_id))
+            remove_checkpoint(battery_checkpoints, instance.time)
+
+def remove_checkpoint(battery_checkpoints, time):
+    index = bisect_left(battery_checkpoints, (time,))
+    if index < len(battery_checkpoints) and battery_checkpoints[index][0] == time:
+        del battery_checkpoints[index]
+
+@receiver(post_save, sender=BatteryStorageSystem, dispatch_uid="reset_battery_checkpoints")
+@receiver(post_delete, sender=BatteryStorageSystem, dispatch_uid="drop_battery_checkpoints")
+def reset_battery_checkpoints(sender, instance, **kwargs):
+    global battery_appliances
+    with lock:
+        checkpoints.pop(instance.id, None)
+        battery_appliances = None
+
+@receiver(post_save, sender=Home, dispatch_uid="reset_home_state")
+def reset_home_state(sender, instance, created, **kwargs):
+    if created:
+        invalidate(instance.id)
+
+@receiver(post_delete, sender=Home, dispatch_uid="drop_home_state")
+def drop_home_state(sender, instance, **kwargs):
+    invalidate(instance.id)
+
+@receiver(post_save, sender=Profile, dispatch_uid="reset_states_on_profile_change")
+def reset_states_on_profile_change(sender, instance, created, **kwargs):
+    if not created:
+        for home_id in shards.get_profile_home_ids(instance):
+            invalidate(home_id)
+
+@receiver(post_save, sender=Appliance, dispatch_uid="reset_home_state_on_appliance_change")
+def reset_home_state_on_appliance_change(sender, instance, created, **kwargs):
+    if not created:
+        invalidate(instance.home_id)
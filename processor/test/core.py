@@ -1,16 +1,19 @@
 import processor.core as core
 
-def start_execution_job(id):
-    return core.start_execution_job(id)
+def start_execution_job(id, simulation=None):
+    return core.start_execution_job(id, simulation)
 
-def finish_execution_job(id):
-    return core.finish_execution_job(id)
+def finish_execution_job(id, simulation=None):
+    return core.finish_execution_job(id, simulation)
 
-def schedule_battery_charge_job(id):
-	return core.schedule_battery_charge_job(id)
+def schedule_battery_charge_job(id, simulation=None):
+	return core.schedule_battery_charge_job(id, simulation)
 
-def send_consumption_schedule_job(id):
-	return core.send_consumption_schedule_job(id)
+def save_battery_checkpoint_job(id, simulation=None):
+    return core.save_battery_checkpoint_job(id, simulation)
+
+def send_consumption_schedule_job(id, simulation=None):
+	return core.send_consumption_schedule_job(id, simulation)
 
 def get_unfinished_executions(home, request_time):
     return core.get_unfinished_executions(home, request_time)
@@ -33,6 +36,15 @@ def get_power_consumption(home, time, queryset=None):
 def get_maximum_consumption_within(home, start_time, end_time, queryset=None):
     return core.get_maximum_consumption_within(home, start_time, end_time, queryset)
 
+def get_minimum_consumption_within(home, start_time, end_time, queryset=None):
+    return core.get_minimum_consumption_within(home, start_time, end_time, queryset)
+
+def get_maximum_consumption_for_duration(home, start_times, duration):
+    return core.get_maximum_consumption_for_duration(home, start_times, duration)
+
+def calculate_execution_duration(execution):
+    return core.calculate_execution_duration(execution)
+
 def calculate_execution_end_time(execution, start_time, duration=None):
     return core.calculate_execution_end_time(execution, start_time, duration)
 
@@ -42,6 +54,9 @@ def choose_execution_time(execution, minimum_start_time=None):
 def get_available_execution_times(execution, minimum_start_time=None, include_bss=False, include_shiftable=False):
     return core.get_available_execution_times(execution, minimum_start_time, include_bss, include_shiftable)
 
+def get_available_execution_times_by_strategy(execution, minimum_start_time=None):
+    return core.get_available_execution_times_by_strategy(execution, minimum_start_time)
+
 def get_consumption_reference_times_within(home, start_time, end_time, queryset=None):
     return core.get_consumption_reference_times_within(home, start_time, end_time, queryset)
 
@@ -60,6 +75,9 @@ def propose_schedule_execution(execution, request_time=None):
 def schedule_execution(execution, request_time=None):
     return core.schedule_execution(execution, request_time, debug=True)
 
+def schedule_executions(home, executions, request_time=None):
+    return core.schedule_executions(home, executions, request_time, debug=True)
+
 def shift_executions(execution, start_time, request_time=None):
     return core.shift_executions(execution, start_time, request_time, debug=True)
 
@@ -75,9 +93,18 @@ def check_high_consumption(home, start_time):
 def calculate_weighted_priority(execution, current_time):
     return core.calculate_weighted_priority(execution, current_time)
 
+def get_pending_executions_by_priority(home, current_time):
+    return core.get_pending_executions_by_priority(home, current_time)
+
+def get_anticipation_power_bound(home, start_time, end_time):
+    return core.get_anticipation_power_bound(home, start_time, end_time)
+
 def anticipate_pending_executions(home, current_time):
     return core.anticipate_pending_executions(home, current_time, debug=True)
 
+def get_home_snapshot(home_id, time=None):
+    return core.get_home_snapshot(home_id, time)
+
 def start_aggregator_client(home, accept_recommendations=True):
     return core.start_aggregator_client(home, accept_recommendations)
 
@@ -91,4 +118,7 @@ def change_threshold(home, threshold):
     return core.change_threshold(home, threshold)
 
 def start():
-    return core.start()
\ No newline at end of file
+    return core.start()
+
+def start_home(home):
+    return core.start_home(home)
\ No newline at end of file
@@ -51,9 +51,15 @@ def get_last_battery_discharge(home):
 def get_battery_energy(home, time=None):
     return ext.get_battery_energy(home, time)
 
+def save_battery_checkpoint(home, time=None):
+    return ext.save_battery_checkpoint(home, time)
+
 def get_allocable_battery_energy_charge(home, day_periods):
     return ext.get_allocable_battery_energy_charge(home, day_periods)
 
+def get_maximum_possible_battery_energy_charge(home, start_time):
+    return ext.get_maximum_possible_battery_energy_charge(home, start_time)
+
 def get_battery_power_charge(home, time):
     return ext.get_battery_power_charge(home, time)
 
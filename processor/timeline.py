@@ -0,0 +1,110 @@
+from bisect import bisect_right, insort
+from collections import deque
+
+from home.settings import INF_DATE
+
+'''
+LoadTimeline class
+Step function of the power drawn by a set of executions.
+Each execution adds its rated power on [start_time, end_time).
+Breakpoints are kept sorted, so power at a time is a binary search
+and peak/minimum within a period only walk the breakpoints inside it.
+'''
+class LoadTimeline:
+    def __init__(self, executions=()):
+        self.executions = {}
+        self.times = []
+        self.deltas = {}
+        self.levels = []
+        self.outdated = False
+        for execution in executions:
+            self.add(execution)
+
+    def add(self, execution):
+        self.remove(execution.id)
+        if execution.start_time is None or execution.end_time is None:
+            return
+        power = execution.profile.rated_power
+        self.executions[execution.id] = (execution.start_time, execution.end_time, power)
+        self.shift(execution.start_time, power)
+        self.shift(execution.end_time, -power)
+
+    def remove(self, execution_id):
+        if execution_id in self.executions:
+            start_time, end_time, power = self.executions.pop(execution_id)
+            self.shift(start_time, -power)
+            self.shift(end_time, power)
+
+    def shift(self, time, power):
+        if time not in self.deltas:
+            insort(self.times, time)
+            self.deltas[time] = 0
+        self.deltas[time] += power
+        if self.deltas[time] == 0:
+            del self.deltas[time]
+            self.times.pop(bisect_right(self.times, time) - 1)
+        self.outdated = True
+
+    # levels[i] is the power drawn on [times[i], times[i+1])
+    def get_levels(self):
+        if self.outdated:
+            levels = []
+            power = 0
+            for time in self.times:
+                power += self.deltas[time]
+                levels.append(power)
+            self.levels = levels
+            self.outdated = False
+        return self.levels
+
+    def get_power_at(self, time):
+        levels = self.get_levels()
+        index = bisect_right(self.times, time) - 1
+        return levels[index] if index >= 0 else 0
+
+    # Power values taken within [start_time, end_time], end included as in reference time lists
+    def get_levels_within(self, start_time, end_time):
+        levels = self.get_levels()
+        first = bisect_right(self.times, start_time) - 1
+        if end_time is None or end_time == INF_DATE or end_time < start_time:
+            last = len(self.times) - 1 if end_time is None or end_time == INF_DATE else first
+        else:
+            last = bisect_right(self.times, end_time) - 1
+        values = levels[max(first, 0):last + 1]
+        if first < 0:
+            values.append(0)
+        return values
+
+    def get_maximum_within(self, start_time, end_time):
+        return max(self.get_levels_within(start_time, end_time) + [0])
+
+    def get_minimum_within(self, start_time, end_time):
+        minimum = min(self.get_levels_within(start_time, end_time))
+        return minimum if minimum > 0 else 0
+
+    # Peak power within [start_time, start_time + duration] for every start time, in a single sweep.
+    # Start times must be sorted; a duration of None means the window never ends.
+    def get_maximum_within_windows(self, start_times, duration):
+        values = [0] + self.get_levels()
+        peaks = []
+        if duration is None:
+            suffix_maximum = values[:]
+            for i in range(len(values) - 2, -1, -1):
+                suffix_maximum[i] = max(values[i], suffix_maximum[i + 1])
+            for start_time in start_times:
+                peaks.append(max(suffix_maximum[bisect_right(self.times, start_time)], 0))
+            return peaks
+        window = deque()
+        last = 0
+        for start_time in start_times:
+            first = bisect_right(self.times, start_time)
+            end = bisect_right(self.times, start_time + duration) if duration.total_seconds() > 0 else first
+            while last <= end:
+                while window and values[window[-1]] <= values[last]:
+                    window.pop()
+                window.append(last)
+                last += 1
+            while window[0] < first:
+                window.popleft()
+            peaks.append(max(values[window[0]], 0))
+        return peaks
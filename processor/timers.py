@@ -0,0 +1,77 @@
+import heapq
+import threading
+
+from processor.tools import is_simulated
+
+'''
+Per-home event timers.
+The start and finish times of the executions of a home are kept in memory, in a heap by time.
+A single scheduler job per home wakes at the earliest of them (see processor.core.arm_home_timer),
+handles every event due at that moment and re-arms for the next one, so the job store holds one
+job per home instead of two per execution, and rescheduling an execution only updates its timer.
+Rescheduled and removed events stay in the heap and are skipped when they reach the top.
+'''
+START = "start"
+FINISH = "finish"
+
+lock = threading.Lock()
+timers = {}
+
+class HomeTimer:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.events = {}
+        self.queue = []
+        self.sequence = 0
+        self.armed = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, execution_id, kind, time):
+        with self.lock:
+            self.events[(execution_id, kind)] = time
+            self.sequence += 1
+            heapq.heappush(self.queue, (time, self.sequence, execution_id, kind))
+
+    def remove(self, execution_id, kind):
+        with self.lock:
+            self.events.pop((execution_id, kind), None)
+
+    def get_time(self, execution_id, kind):
+        return self.events.get((execution_id, kind))
+
+    def get_next_time(self):
+        with self.lock:
+            while self.queue:
+                time, _, execution_id, kind = self.queue[0]
+                if self.events.get((execution_id, kind)) == time:
+                    return time
+                heapq.heappop(self.queue)
+            return None
+
+    # Events due by time as (execution id, kind), in time order, removed from the timer
+    def pop_due(self, time):
+        with self.lock:
+            due = []
+            while (next_time := self.get_next_time()) is not None and next_time <= time:
+                _, _, execution_id, kind = heapq.heappop(self.queue)
+                del self.events[(execution_id, kind)]
+                due.append((execution_id, kind))
+            return due
+
+# Timers of simulated homes are kept by their simulation
+def get_timer(home):
+    registry = home.simulation.timers if is_simulated(home) else timers
+    with lock:
+        timer = registry.get(home.id)
+        if timer is None:
+            timer = registry[home.id] = HomeTimer()
+        return timer
+
+def clear(home_id=None):
+    with lock:
+        if home_id is None:
+            timers.clear()
+        else:
+            timers.pop(home_id, None)
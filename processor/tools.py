@@ -1,13 +1,22 @@
 from math import floor
 from django.utils import timezone
 
-def is_now(date):
-    now = timezone.now()
+# Within a minute of the current time of item, see current_time
+def is_now(date, item=None):
+    now = current_time(item)
     difference = (date - now).total_seconds()
     if abs(difference) < 60:
         return True
     return False
 
+# Records of processor.simulation carry the simulation they belong to
+def is_simulated(item):
+    return getattr(item, "simulation", None) is not None
+
+# Simulated records follow the clock of their simulation
+def current_time(item=None):
+    return item.simulation.now() if is_simulated(item) else timezone.now()
+
 def compact_periods(periods):
     new_periods = {}
     if periods:
@@ -0,0 +1,94 @@
+from math import ceil
+from django.utils import timezone
+
+import processor.state as state
+import processor.external_energy as ext
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Optional NumPy backend for the scheduler.
+A home's planned load is sampled at every breakpoint of its load timeline and at the start and end
+of every candidate window, so each window covers whole steps and its peak is the same as on the
+timeline itself. Thresholds for candidate windows are taken from hourly production values, matching
+the scalar path. Window queries are answered for all candidates at once with sparse tables, which
+amounts to a vectorized rolling maximum/minimum.
+'''
+available = np is not None
+
+MICROSECOND = timezone.timedelta(microseconds=1)
+
+class SparseTable:
+    def __init__(self, values, function):
+        self.function = function
+        self.size = len(values)
+        fill = values.min() if function is np.maximum else values.max()
+        levels = [values]
+        span = 1
+        while span * 2 <= self.size:
+            previous = levels[-1]
+            level = np.full(self.size, fill, dtype=values.dtype)
+            level[:self.size - span] = function(previous[:self.size - span], previous[span:])
+            levels.append(level)
+            span *= 2
+        self.table = np.stack(levels)
+
+    # Inclusive [first, last] index ranges, as arrays
+    def query(self, first, last):
+        level = np.floor(np.log2(last - first + 1)).astype(int)
+        return self.function(self.table[level, first], self.table[level, last - (1 << level) + 1])
+
+'''
+WindowArrays class
+Load and production of a home for windows of the same duration starting at sorted start times,
+where a duration of None means the windows never end.
+'''
+class WindowArrays:
+    def __init__(self, home, start_times, duration):
+        self.home = home
+        self.start_times = start_times
+        self.duration = duration
+        self.origin = start_times[0]
+        timeline = state.get_timeline(home, self.origin)
+        breakpoints = self.get_offsets(timeline.times)
+        starts = self.get_offsets(start_times)
+        ends = starts if not self.has_length() else self.get_offsets([time + duration for time in start_times])
+        self.points = np.unique(np.concatenate([breakpoints[breakpoints > 0], starts, ends]))
+        values = np.array([0] + timeline.get_levels(), dtype=np.int64)
+        self.load = values[np.searchsorted(breakpoints, self.points, side="right")]
+        self.first = np.searchsorted(self.points, starts)
+        self.last = np.searchsorted(self.points, ends)
+        self.first_hour = self.origin.replace(minute=0, second=0, microsecond=0)
+
+    def has_length(self):
+        return self.duration is not None and self.duration.total_seconds() > 0
+
+    # Microseconds from the first start time
+    def get_offsets(self, times):
+        return np.array([(time - self.origin) // MICROSECOND for time in times], dtype=np.int64)
+
+    # Peak load within [start_time, start_time + duration] for every start time
+    def get_peak_consumptions(self):
+        if self.duration is None:
+            peaks = np.maximum.accumulate(self.load[::-1])[::-1][self.first]
+        else:
+            peaks = SparseTable(self.load, np.maximum).query(self.first, self.last)
+        return np.maximum(peaks, 0)
+
+    # Lowest threshold within the window, sampling production hourly from each start time
+    # for at most two days, exactly as ext.get_power_threshold_within does
+    def get_minimum_thresholds(self):
+        window = timezone.timedelta(days=2) if self.duration is None else min(self.duration, timezone.timedelta(days=2))
+        hours = ceil(window.total_seconds() / 3600)
+        if hours <= 0:
+            return np.full(len(self.start_times), self.home.consumption_threshold)
+        first = (np.array([(time - self.first_hour).total_seconds() for time in self.start_times]) // 3600).astype(int)
+        production = np.array([ext.get_power_production(self.home, self.first_hour + timezone.timedelta(hours=i))
+            for i in range(first[-1] + hours)])
+        return self.home.consumption_threshold + SparseTable(production, np.minimum).query(first, first + hours - 1)
+
+def get_window_arrays(home, start_times, duration):
+    return WindowArrays(home, start_times, duration)
@@ -0,0 +1,179 @@
+import queue
+import inspect
+import logging
+import functools
+import threading
+from concurrent.futures import Future
+
+from django import db
+from django.db import transaction
+
+import processor.metrics as metrics
+from coordinator.settings import HOME_WORKERS, HOME_QUEUE_SIZE
+
+'''
+Per-home serial executors.
+Every home has a mailbox of tasks, run one at a time and in order by a shared pool of worker threads,
+so calls that change a home never run concurrently while different homes run in parallel.
+Tasks either return their result to the caller (execute) or run in the background (submit). A
+background task submitted while another of the same name is still waiting in the mailbox replaces
+its arguments instead of queuing again, so several finishes in a home lead to a single re-plan.
+At most HOME_QUEUE_SIZE tasks wait at once; further callers block until one has run. Calls made
+by a task for its own home run directly. Tasks may submit tasks to other homes but not wait on
+them, as every worker could end up waiting on a home queued behind it.
+Workers use their own database connections, so they cannot see rows a caller has not committed
+yet and, on SQLite, would wait on its write lock. Tasks submitted inside a transaction are therefore
+only queued once it commits, and calls made inside one that wait for their result run on the
+calling thread, which holds the executor of the home until they return.
+Workers are threads: they keep homes from waiting on each other, but Python code still runs one
+thread at a time, so the pool does not scale computation with cores.
+'''
+logger = logging.getLogger(__name__)
+
+lock = threading.Lock()
+idle = threading.Condition(lock)
+homes = queue.Queue()
+mailboxes = {}
+running = set()
+threads = []
+slots = threading.Semaphore(HOME_QUEUE_SIZE)
+local = threading.local()
+
+class Task:
+    def __init__(self, function, args, kwargs, bounded):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.bounded = bounded
+        self.future = Future()
+
+    def run(self):
+        try:
+            self.future.set_result(self.function(*self.args, **self.kwargs))
+        except Exception as error:
+            self.future.set_exception(error)
+        finally:
+            if self.bounded:
+                slots.release()
+
+def get_current_home():
+    return getattr(local, "home_id", None)
+
+# Calls without a home, or from the executor of the home, are made directly
+def runs_directly(home_id):
+    return home_id is None or home_id == get_current_home()
+
+# Runs function on the executor of the home and returns its result
+def execute(home_id, function, *args, **kwargs):
+    if runs_directly(home_id):
+        return function(*args, **kwargs)
+    if get_current_home() is not None:
+        raise RuntimeError(f"The executor of home {get_current_home()} cannot wait on the executor of home {home_id}.")
+    if db.connection.in_atomic_block:
+        return hold(home_id, function, args, kwargs)
+    return post(home_id, object(), function, args, kwargs).future.result()
+
+# Runs function on the calling thread as the executor of the home, once no worker is running it
+def hold(home_id, function, args, kwargs):
+    with idle:
+        while home_id in running:
+            idle.wait()
+        running.add(home_id)
+    local.home_id = home_id
+    try:
+        return function(*args, **kwargs)
+    finally:
+        local.home_id = None
+        with idle:
+            running.discard(home_id)
+            if mailboxes.get(home_id):
+                homes.put(home_id)
+            idle.notify_all()
+
+# Queues function on the executor of the home; returns False when merged into a task waiting with the same name.
+# Inside a transaction, the task is queued once it commits and None is returned.
+def submit(home_id, name, function, *args, **kwargs):
+    if db.connection.in_atomic_block:
+        transaction.on_commit(lambda: submit(home_id, name, function, *args, **kwargs))
+        return None
+    task = post(home_id, name, function, args, kwargs)
+    metrics.increment("home_tasks_total", task=name, outcome="queued" if task is not None else "coalesced")
+    return task is not None
+
+def post(home_id, key, function, args, kwargs):
+    # workers never wait for a slot, as only they release them
+    bounded = slots.acquire(blocking=get_current_home() is None)
+    with lock:
+        mailbox = mailboxes.setdefault(home_id, {})
+        task = mailbox.get(key)
+        if task is not None:
+            task.function, task.args, task.kwargs = function, args, kwargs
+            if bounded:
+                slots.release()
+            return None
+        if not mailbox and home_id not in running:
+            homes.put(home_id)
+        task = mailbox[key] = Task(function, args, kwargs, bounded)
+        start()
+    return task
+
+def start():
+    while len(threads) < HOME_WORKERS:
+        thread = threading.Thread(target=work, name=f"home-worker-{len(threads)}", daemon=True)
+        threads.append(thread)
+        thread.start()
+
+def work():
+    while True:
+        home_id = homes.get()
+        local.home_id = home_id
+        try:
+            run(home_id)
+        finally:
+            local.home_id = None
+            db.connection.close()
+            homes.task_done()
+
+# Runs the tasks of a home, then those posted for it in the meantime.
+# Homes held by a caller are queued again once it is done with them.
+def run(home_id):
+    with lock:
+        if home_id in running:
+            return
+        running.add(home_id)
+    while True:
+        with lock:
+            mailbox = mailboxes.pop(home_id, None)
+            if not mailbox:
+                running.discard(home_id)
+                idle.notify_all()
+                return
+        for key, task in mailbox.items():
+            name = key if isinstance(key, str) else task.function.__name__
+            with metrics.timer("home_task", task=name):
+                task.run()
+            if task.future.exception() is not None and isinstance(key, str):
+                logger.error(f"Task {name} of home {home_id} failed.", exc_info=task.future.exception())
+
+# Blocks until every queued task has run
+def join():
+    homes.join()
+
+# Runs the decorated function on the executor of the home get_home_id returns for its arguments,
+# or directly when it returns None or the call comes from that executor.
+# Without wait, calls are submitted under the function name.
+def serial(get_home_id, wait=True):
+    def decorator(function):
+        signature = inspect.signature(function)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            home_id = get_home_id(arguments.arguments)
+            if runs_directly(home_id):
+                return function(*args, **kwargs)
+            if wait:
+                return execute(home_id, function, *args, **kwargs)
+            submit(home_id, function.__name__, function, *args, **kwargs)
+        return wrapper
+    return decorator